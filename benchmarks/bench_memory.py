@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Memory benchmark of events held in a buffer.
+
+Buffers ``--count`` events (1M by default) as ``{'event', 'properties'}``
+dicts, the way :class:`~mixpanel.batch.EventBatcher` used to, and as
+:class:`~mixpanel.events.Event` records, each in a child process of its
+own, and reports the memory they take, the time to buffer them and the
+time to serialize them in batches of 50.
+
+    $ python benchmarks/bench_memory.py [--count N]
+"""
+from __future__ import absolute_import
+
+import gc
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mixpanel import serializers
+from mixpanel.events import Event
+
+
+def make_properties(i):
+    # Decoded messages and web requests hand over fresh keys for each event
+    return {
+        ''.join(['distinct', '_id']): 'user-%d' % (i % 10000),
+        ''.join(['ti', 'me']): 1367411415 + i,
+        ''.join(['u', 'rl']): '/account/settings/',
+        ''.join(['refer', 'rer']): 'https://example.com/',
+        ''.join(['pl', 'an']): 'pro',
+        }
+
+def as_dict(i, token):
+    props = dict(make_properties(i))
+    props.setdefault('token', token)
+    return {'event': ''.join(['Viewed ', 'page']), 'properties': props}
+
+def as_record(i, token):
+    return Event(''.join(['Viewed ', 'page']), make_properties(i), token)
+
+KINDS = [
+    ('dict', as_dict, serializers.dumps),
+    ('Event', as_record, lambda event: event.encode()),
+    ]
+
+
+def rss():
+    """
+    Returns the resident memory of the process in bytes.
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def measure(make, encode, count, conn):
+    gc.collect()
+    before = rss()
+    started = time.time()
+    events = [make(i, 'e3bc4100330c35722740fb8c6f5abddc') for i in xrange(count)]
+    buffered = time.time() - started
+    gc.collect()
+    used = rss() - before
+
+    started = time.time()
+    for start in xrange(0, count, 50):
+        '[%s]' % ','.join(encode(event) for event in events[start:start + 50])
+    encoded = time.time() - started
+    conn.send((used, buffered, encoded))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [--count N]")
+    parser.add_option('-n', '--count', type='int', default=1000000,
+                      help="events to buffer (default %default)")
+    options, args = parser.parse_args()
+
+    print "%-8s %12s %12s %14s %14s" % (
+        'kind', 'memory (MB)', 'bytes/event', 'buffer (s)', 'serialize (s)')
+    for label, make, encode in KINDS:
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=measure,
+                                          args=(make, encode, options.count, child))
+        process.start()
+        used, buffered, encoded = parent.recv()
+        process.join()
+        print "%-8s %12.1f %12d %14.2f %14.2f" % (
+            label, used / 1e6, used // options.count, buffered, encoded)
+
+
+if __name__ == '__main__':
+    main()
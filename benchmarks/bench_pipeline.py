@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+Benchmark of the tracking pipeline against a local fake Mixpanel server.
+
+Starts :mod:`fake_mixpanel` in a child process, drives one of the tracking
+tasks at a configurable rate and reports throughput, latency percentiles,
+bytes sent and client CPU time per event. Tasks run either eagerly in
+caller threads (``--mode eager``) or through an in-process Celery worker
+fed by the in-memory broker (``--mode celery``).
+
+    $ python benchmarks/bench_pipeline.py --task event --count 2000 --latency 0.02
+    $ python benchmarks/bench_pipeline.py --task batch --mode celery --pool --method POST
+"""
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_mixpanel import FakeMixpanelServer
+from mixpanel import tasks
+from mixpanel.conf import settings as mp_settings
+
+TASKS = ('event', 'people', 'funnel', 'batch')
+
+
+def _serve(options, conn):
+    server = FakeMixpanelServer(('127.0.0.1', 0), options.latency,
+                                options.error_rate, options.reject_rate)
+    conn.send(server.address)
+    server.serve_forever()
+
+def start_server(options):
+    """
+    Runs the fake server in a child process so it doesn't count towards the
+    client's CPU time. Returns the process and the server's address.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(options, child))
+    process.daemon = True
+    process.start()
+    return process, parent.recv()
+
+def server_stats(address):
+    return json.loads(urllib2.urlopen('http://%s/_stats' % address).read())
+
+
+def make_call(options, i):
+    """
+    Returns ``(task, args, kwargs, events)`` for the ``i``-th call.
+    """
+    distinct_id = 'user-%d' % (i % 1000)
+    props = {'distinct_id': distinct_id, 'url': '/page/%d/' % i,
+             'referrer': 'https://www.example.com/', 'plan': 'premium'}
+    if options.task == 'event':
+        return tasks.event_tracker, ('Viewed page', props), {}, 1
+    if options.task == 'people':
+        return tasks.people_tracker, (distinct_id,), {'add': {'page views': 1}}, 1
+    if options.task == 'funnel':
+        step = 'step %d' % (i % 3)
+        return tasks.funnel_event_tracker, ('Signup', step, 'step 2', props), {}, 1
+    events = [{'event': 'Viewed page', 'properties': dict(props, n=n)}
+              for n in xrange(options.batch_size)]
+    return tasks.event_batch_tracker, (events,), {}, options.batch_size
+
+
+def run_eager(options):
+    """
+    Calls the tasks directly from ``--threads`` threads.
+    Returns a list of ``(latency, ok, events)`` tuples.
+    """
+    samples = []
+    lock = threading.Lock()
+    counter = iter(xrange(options.count))
+    start = time.time()
+
+    def work():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            _pace(options, start, i)
+            task, args, kwargs, events = make_call(options, i)
+            began = time.time()
+            try:
+                task(*args, **kwargs)
+                ok = True
+            except tasks.FailedEventRequest:
+                ok = False
+            with lock:
+                samples.append((time.time() - began, ok, events))
+
+    threads = [threading.Thread(target=work) for _ in xrange(options.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def run_celery(options):
+    """
+    Enqueues the tasks on the in-memory broker and consumes them with a solo
+    worker running in this process. Latency runs from ``apply_async`` until
+    the task finishes in the worker, including any retries.
+    Returns a list of ``(latency, ok, events)`` tuples.
+    """
+    from celery import current_app
+    from celery.signals import task_postrun
+    from celery.utils import uuid
+
+    current_app.conf.update(
+        BROKER_URL='memory://',
+        BROKER_TRANSPORT_OPTIONS={'polling_interval': 0.001},
+        CELERY_ACCEPT_CONTENT=['pickle', 'json'],
+        CELERY_IGNORE_RESULT=True,
+        CELERYD_PREFETCH_MULTIPLIER=0,
+        )
+
+    sent = {}
+    samples = []
+    done = threading.Event()
+
+    def finished(task_id=None, state=None, **kwargs):
+        if state == 'RETRY' or task_id not in sent:
+            return
+        began, events = sent.pop(task_id)
+        samples.append((time.time() - began, state == 'SUCCESS', events))
+        if len(samples) == options.count:
+            done.set()
+    task_postrun.connect(finished, weak=False)
+
+    worker = current_app.WorkController(pool_cls='solo', concurrency=1,
+                                        loglevel='WARNING')
+    thread = threading.Thread(target=worker.start)
+    thread.daemon = True
+    thread.start()
+
+    start = time.time()
+    for i in xrange(options.count):
+        _pace(options, start, i)
+        task, args, kwargs, events = make_call(options, i)
+        task_id = uuid()
+        sent[task_id] = (time.time(), events)
+        task.apply_async(args, kwargs, task_id=task_id)
+    done.wait()
+    worker.stop()
+    thread.join()
+    return samples
+
+def _pace(options, start, i):
+    if options.rate:
+        delay = start + float(i) / options.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def report(options, samples, wall, cpu, stats):
+    events = sum(n for latency, ok, n in samples)
+    delivered = sum(n for latency, ok, n in samples if ok)
+    latencies = sorted(latency for latency, ok, n in samples)
+
+    print "task: %s, mode: %s, calls: %d, events: %d" % (
+        options.task, options.mode, len(samples), events)
+    print "  delivered:     %d events (%d failed calls)" % (
+        delivered, sum(1 for latency, ok, n in samples if not ok))
+    print "  wall time:     %.2f s" % wall
+    print "  throughput:    %.1f events/s" % (events / wall)
+    print "  latency (ms):  p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % tuple(
+        percentile(latencies, p) * 1000 for p in (50, 90, 99, 100))
+    print "  http requests: %d (%d errors, %d rejected)" % (
+        stats['requests'], stats['failed'], stats['rejected'])
+    print "  bytes sent:    %d (%.1f per event)" % (
+        stats['bytes'], float(stats['bytes']) / max(events, 1))
+    print "  cpu:           %.1f us per event" % (cpu / max(events, 1) * 1e6)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--task', choices=TASKS, default='event',
+                      help="one of %s (default %%default)" % ', '.join(TASKS))
+    parser.add_option('--mode', choices=('eager', 'celery'), default='eager')
+    parser.add_option('--count', type='int', default=1000,
+                      help="number of task calls (default %default)")
+    parser.add_option('--rate', type='float', default=0,
+                      help="task calls per second, 0 for no limit")
+    parser.add_option('--threads', type='int', default=4,
+                      help="caller threads in eager mode (default %default)")
+    parser.add_option('--batch-size', type='int', default=50,
+                      help="events per call for --task batch")
+    parser.add_option('--latency', type='float', default=0,
+                      help="fake server response delay in seconds")
+    parser.add_option('--error-rate', type='float', default=0,
+                      help="share of requests failing with HTTP 503")
+    parser.add_option('--reject-rate', type='float', default=0,
+                      help="share of requests answered with 0")
+    parser.add_option('--pool', action='store_true',
+                      help="enable MIXPANEL_CONNECTION_POOL")
+    parser.add_option('--method', default='GET',
+                      help="MIXPANEL_REQUEST_METHOD (default %default)")
+    parser.add_option('--gzip', action='store_true',
+                      help="enable MIXPANEL_GZIP_REQUESTS")
+    parser.add_option('--serializer', default=mp_settings.MIXPANEL_SERIALIZER,
+                      help="MIXPANEL_SERIALIZER (default %default)")
+    options, args = parser.parse_args()
+
+    process, address = start_server(options)
+    try:
+        mp_settings.MIXPANEL_API_TOKEN = 'benchmark'
+        mp_settings.MIXPANEL_API_SERVER = address
+        mp_settings.MIXPANEL_API_SCHEME = 'http'
+        mp_settings.MIXPANEL_CONNECTION_POOL = options.pool
+        mp_settings.MIXPANEL_REQUEST_METHOD = options.method
+        mp_settings.MIXPANEL_GZIP_REQUESTS = options.gzip
+        mp_settings.MIXPANEL_SERIALIZER = options.serializer
+        mp_settings.MIXPANEL_RETRY_DELAY = 0
+
+        run = run_eager if options.mode == 'eager' else run_celery
+        times = os.times()
+        wall = time.time()
+        samples = run(options)
+        wall = time.time() - wall
+        cpu = sum(os.times()[:2]) - sum(times[:2])
+        report(options, samples, wall, cpu, server_stats(address))
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the JSON serializers in :mod:`mixpanel.serializers`.
+
+Encodes representative payloads (a small event, an event with a large
+property dict and a full batch of events) with every installed serializer,
+plus the base64 step used by GET requests, and reports the time per encode.
+
+    $ python benchmarks/bench_serializers.py [--number N]
+"""
+from __future__ import absolute_import
+
+import base64
+import datetime
+import decimal
+import optparse
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mixpanel import serializers
+
+
+def small_event():
+    return {
+        'event': 'Viewed page',
+        'properties': {
+            'token': 'e3bc4100330c35722740fb8c6f5abddc',
+            'distinct_id': 'c9533b5b-d69e-479a-ae5f-42dd7a9752a0',
+            'time': 1367411415,
+            'url': '/account/settings/',
+            },
+        }
+
+def large_event():
+    event = small_event()
+    props = event['properties']
+    for i in xrange(200):
+        props['string_%d' % i] = 'value %d with some padding text' % i
+        props['number_%d' % i] = i * 1.5
+    props['created'] = datetime.datetime(2013, 5, 1, 12, 30, 15)
+    props['price'] = decimal.Decimal('19.99')
+    props['order_id'] = uuid.UUID('c9533b5b-d69e-479a-ae5f-42dd7a9752a0')
+    props['tags'] = ['tag%d' % i for i in xrange(50)]
+    return event
+
+def batch():
+    return [large_event() if i % 10 == 0 else small_event() for i in xrange(50)]
+
+PAYLOADS = [
+    ('small event', small_event()),
+    ('large event', large_event()),
+    ('batch of 50', batch()),
+    ]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [--number N]")
+    parser.add_option('-n', '--number', type='int', default=2000,
+                      help="encodes per measurement (default %default)")
+    options, args = parser.parse_args()
+
+    available = []
+    for name in sorted(serializers.SERIALIZERS):
+        try:
+            available.append((name, serializers.get_serializer(name)))
+        except serializers.UnknownSerializer:
+            print "%-10s not installed" % name
+    print
+
+    print "%-12s %-12s %12s %12s %10s" % (
+        'payload', 'serializer', 'dumps (us)', '+b64 (us)', 'bytes')
+    for label, payload in PAYLOADS:
+        for name, dumps in available:
+            encode = lambda: dumps(payload)
+            encode_b64 = lambda: base64.b64encode(dumps(payload))
+            plain = min(timeit.repeat(encode, number=options.number, repeat=3))
+            b64 = min(timeit.repeat(encode_b64, number=options.number, repeat=3))
+            print "%-12s %-12s %12.1f %12.1f %10d" % (
+                label, name,
+                plain / options.number * 1e6,
+                b64 / options.number * 1e6,
+                len(encode()))
+        print
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+A local HTTP stand-in for ``api.mixpanel.com``.
+
+Accepts tracking requests on any path, by GET or POST (optionally
+gzip-compressed), and answers ``1`` or ``0`` like Mixpanel does. Latency,
+the share of failed (HTTP 503) requests and the share of rejected (``0``)
+requests are configurable, and the server counts the requests, events and
+bytes it receives. ``GET /_stats`` returns those counters as JSON.
+
+Run it standalone with::
+
+    $ python benchmarks/fake_mixpanel.py --port 8000 --latency 0.05
+
+then point mixpanel-celery at it with ``MIXPANEL_API_SERVER = 'localhost:8000'``
+and ``MIXPANEL_API_SCHEME = 'http'``.
+"""
+from __future__ import absolute_import
+
+import base64
+import BaseHTTPServer
+import gzip
+import json
+import optparse
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+from cStringIO import StringIO
+
+
+class Stats(object):
+    """Counters updated by the request handler threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.events = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes = 0
+
+    def snapshot(self):
+        with self.lock:
+            return dict(requests=self.requests, events=self.events,
+                        failed=self.failed, rejected=self.rejected,
+                        bytes=self.bytes)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            return self._respond(200, json.dumps(self.server.stats.snapshot()))
+        self._track(urlparse.urlparse(self.path).query, len(self.path))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        size = len(self.path) + length
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self._track(body, size)
+
+    def _track(self, query, size):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        events = _count_events(query)
+        roll = random.random()
+        with server.stats.lock:
+            server.stats.requests += 1
+            server.stats.bytes += size
+            if roll < server.error_rate:
+                server.stats.failed += 1
+                status, content = 503, 'Service Unavailable'
+            elif roll < server.error_rate + server.reject_rate:
+                server.stats.rejected += 1
+                status, content = 200, '0'
+            else:
+                server.stats.events += events
+                status, content = 200, '1'
+
+        self._respond(status, content)
+
+    def _respond(self, status, content):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _count_events(query):
+    try:
+        data = urlparse.parse_qs(query)['data'][0]
+    except (KeyError, IndexError):
+        return 0
+    if not data.lstrip().startswith(('{', '[')):
+        data = base64.b64decode(data)
+    try:
+        decoded = json.loads(data)
+    except ValueError:
+        return 0
+    return len(decoded) if isinstance(decoded, list) else 1
+
+
+class FakeMixpanelServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded fake api server.
+
+    ``latency`` is the number of seconds to wait before answering,
+    ``error_rate`` the share of requests answered with HTTP 503 and
+    ``reject_rate`` the share answered with ``0``.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 reject_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.stats = Stats()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--latency', type='float', default=0,
+                      help="seconds to wait before answering")
+    parser.add_option('--error-rate', type='float', default=0,
+                      help="share of requests answered with HTTP 503")
+    parser.add_option('--reject-rate', type='float', default=0,
+                      help="share of requests answered with 0")
+    options, args = parser.parse_args()
+
+    server = FakeMixpanelServer((options.host, options.port), options.latency,
+                                options.error_rate, options.reject_rate)
+    print "Fake Mixpanel listening on http://%s" % server.address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print server.stats.snapshot()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""In-process batching of events before they are sent to Mixpanel"""
+from __future__ import absolute_import
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from . import conf
+from .conf import settings as mp_settings
+from .events import Event
+from .properties import stamp
+
+log = logging.getLogger(__name__)
+
+# Batchers still holding items when the process exits are flushed then
+_batchers = weakref.WeakSet()
+
+
+class _Batcher(object):
+    """
+    Buffers items and hands them to ``flush`` once there are ``max_size`` of
+    them or the oldest is ``max_age`` seconds old.
+
+    Age is checked whenever an item is added, and by a daemon timer started
+    with the first item of each batch, so a batch is flushed on time even if
+    nothing else is added. Batches left when the process exits are flushed
+    by an ``atexit`` hook.
+    """
+
+    def __init__(self, flush, max_size=None, max_age=None, clock=time.time):
+        conf.load()
+        self._flush = flush
+        self.max_size = max_size or mp_settings.MIXPANEL_BATCH_SIZE
+        if max_age is None:
+            max_age = mp_settings.MIXPANEL_BATCH_INTERVAL
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = None
+        self._timer = None
+        self._reset()
+        _batchers.add(self)
+
+    def __len__(self):
+        return len(self._items)
+
+    def flush(self):
+        """
+        Sends all buffered items.
+        Returns the results of ``flush``, in the order the items were added.
+        """
+        with self._lock:
+            items = self._take()
+        if not items:
+            return []
+        return self._flush(items)
+
+    def flush_if_due(self):
+        """
+        Flushes the buffered items if the oldest one has reached ``max_age``.
+        Returns the results of ``flush`` if flushed, else None.
+        """
+        with self._lock:
+            if not self._items or not self._due():
+                return None
+            items = self._take()
+        return self._flush(items)
+
+    def _add(self, *args):
+        with self._lock:
+            if not self._items:
+                self._started = self._clock()
+                self._schedule(self.max_age)
+            self._append(*args)
+            if len(self._items) < self.max_size and not self._due():
+                return None
+            items = self._take()
+        return self._flush(items)
+
+    def _due(self):
+        return self._clock() - self._started >= self.max_age
+
+    def _take(self):
+        items = self._flushable()
+        self._reset()
+        self._started = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return items
+
+    def _schedule(self, delay):
+        if not self.max_age:
+            return
+        self._timer = threading.Timer(delay, self._flush_when_due)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_when_due(self):
+        with self._lock:
+            # Superseded by the timer of a newer batch
+            if threading.current_thread() is not self._timer or not self._items:
+                return
+            if not self._due():
+                self._schedule(self.max_age - (self._clock() - self._started))
+                return
+            items = self._take()
+        try:
+            self._flush(items)
+        except Exception:
+            log.exception("Failed to flush %d batched items", len(items))
+
+
+class EventBatcher(_Batcher):
+    """
+    Collects events and hands them to ``flush`` in batches.
+
+    A batch is flushed as soon as it holds ``max_size`` events or its oldest
+    event is more than ``max_age`` seconds old. Age is checked whenever an
+    event is added, by a timer, and by :meth:`flush_if_due`.
+
+    Events are buffered as compact :class:`~mixpanel.events.Event` records.
+    ``flush`` is called with the list of them and must return one result
+    per event. It defaults to running
+    :func:`~mixpanel.tasks.event_batch_tracker` in-process.
+    """
+
+    def __init__(self, flush=None, max_size=None, max_age=None, clock=time.time):
+        if flush is None:
+            from .tasks import event_batch_tracker as flush
+        super(EventBatcher, self).__init__(flush, max_size, max_age, clock)
+
+    def add(self, event_name, properties=None, token=None):
+        """
+        Buffers an event.
+        Returns the per-event results if this triggered a flush, else None.
+        """
+        if mp_settings.MIXPANEL_STAMP_EVENTS:
+            # Stamp the time the event occurred, not the time it is sent
+            properties = stamp(dict(properties or {}))
+        return self._add(Event(event_name, properties, token or None))
+
+    def _append(self, event):
+        self._items.append(event)
+
+    def _flushable(self):
+        return self._items
+
+    def _reset(self):
+        self._items = []
+
+
+class PeopleBatcher(_Batcher):
+    """
+    Collects people updates, coalescing those for the same user, and hands
+    them to ``flush`` in batches.
+
+    Within a batch, an update is merged into the user's latest one when both
+    have the same operation, and kept as a new update otherwise, so that the
+    updates are still applied in the order they were made. ``$set`` values
+    are overwritten by later ones, ``$set_once`` values are kept from the
+    first, ``$add`` increments are summed, ``$union`` lists and ``$unset``
+    names are merged, and repeated ``$delete`` updates collapse. An
+    ``$unset`` or ``$delete`` thus only removes what was set before it.
+    ``$append`` and ``$remove`` updates are kept as they are, since repeating
+    them matters. Different operations are never combined into one update,
+    since Mixpanel accepts only one operation per update. The batch is
+    flushed once it holds ``max_size`` updates or its oldest is ``max_age``
+    seconds old.
+
+    ``flush`` is called with the list of ``/engage/`` update dicts and must
+    return one result per update. It defaults to running
+    :func:`~mixpanel.tasks.people_batch_tracker` in-process.
+    """
+
+    def __init__(self, flush=None, max_size=None, max_age=None, clock=time.time):
+        if flush is None:
+            from .tasks import people_batch_tracker as flush
+        super(PeopleBatcher, self).__init__(flush, max_size, max_age, clock)
+
+    def set(self, distinct_id, properties, token=None):
+        """
+        Buffers a ``$set`` of ``properties`` for the user.
+        Returns the per-update results if this triggered a flush, else None.
+        """
+        return self.update(distinct_id, {'$set': properties}, token)
+
+    def add(self, distinct_id, increments, token=None):
+        """
+        Buffers an ``$add`` of ``increments`` for the user.
+        Returns the per-update results if this triggered a flush, else None.
+        """
+        return self.update(distinct_id, {'$add': increments}, token)
+
+    def update(self, distinct_id, operations, token=None):
+        """
+        Buffers the user's ``operations``, a dict mapping operations such as
+        ``'$set_once'`` or ``'$union'`` to their values.
+        Returns the per-update results if this triggered a flush, else None.
+        """
+        from .tasks import _build_people_params
+        updates = _build_people_params(distinct_id, operations, token)
+        results = []
+        for update in updates:
+            result = self._add(update)
+            if result is not None:
+                results.extend(result)
+        return results or None
+
+    def _append(self, update):
+        operation = [k for k in update if k not in ('$token', '$distinct_id')][0]
+        value = update[operation]
+        user = (update['$token'], update['$distinct_id'])
+        # Only the user's latest update can take this one without changing
+        # the order in which Mixpanel applies them
+        key = self._latest.get(user)
+        if key is None or key[2] != operation or operation in ('$append', '$remove'):
+            key = user + (operation, len(self._items))
+            self._latest[user] = key
+        merged = self._items.get(key)
+        if merged is None:
+            if operation == '$union':
+                # Copy the lists, since later unions extend them
+                value = dict((name, list(values)) for name, values in value.iteritems())
+            self._items[key] = value
+        elif operation == '$set':
+            merged.update(value)
+        elif operation == '$set_once':
+            for name, v in value.iteritems():
+                merged.setdefault(name, v)
+        elif operation == '$add':
+            for name, v in value.iteritems():
+                merged[name] = merged.get(name, 0) + v
+        elif operation == '$union':
+            for name, values in value.iteritems():
+                existing = merged.setdefault(name, [])
+                existing.extend(v for v in values if v not in existing)
+        elif operation == '$unset':
+            merged.extend(name for name in value if name not in merged)
+
+    def _flushable(self):
+        return [{'$token': key[0], '$distinct_id': key[1], key[2]: value}
+                for key, value in self._items.iteritems()]
+
+    def _reset(self):
+        self._items = OrderedDict()
+        self._latest = {}
+
+
+@atexit.register
+def _flush_all():
+    for batcher in list(_batchers):
+        try:
+            batcher.flush()
+        except Exception:
+            log.exception("Failed to flush batched items at exit")
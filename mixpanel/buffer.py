@@ -0,0 +1,110 @@
+"""Client-side buffering of events into a single Celery message per flush"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .batch import EventBatcher
+from . import conf
+from .conf import settings as mp_settings
+from . import routing
+
+
+class EventBuffer(EventBatcher):
+    """
+    Buffers events in the calling process and enqueues them as a single
+    :func:`~mixpanel.tasks.event_batch_tracker` message when flushed, rather
+    than enqueueing one :func:`~mixpanel.tasks.event_tracker` message each.
+
+    The buffer is flushed when it holds ``max_size`` events, when its oldest
+    event is ``max_age`` seconds old, by calling :meth:`flush`, or when the
+    process exits. Flushing
+    returns the enqueued task's ``AsyncResult``. Used as a context manager,
+    the buffer is flushed when the block exits, which suits buffering the
+    events of one web request or job::
+
+        with EventBuffer() as buf:
+            buf.add('Viewed page', {'distinct_id': user.id})
+            buf.add('Clicked button', {'distinct_id': user.id})
+
+    ``token`` is passed to the task for events without one. Other keyword
+    arguments are passed on to ``apply_async``, e.g. ``queue``.
+    """
+
+    def __init__(self, max_size=None, max_age=None, token=None, clock=time.time, **options):
+        conf.load()
+        if max_size is None:
+            max_size = mp_settings.MIXPANEL_BUFFER_MAX_EVENTS
+        if max_age is None:
+            max_age = mp_settings.MIXPANEL_BUFFER_MAX_AGE
+        self.token = token
+        self.options = options
+        super(EventBuffer, self).__init__(self._enqueue, max_size, max_age, clock)
+
+    def flush(self):
+        """
+        Enqueues all buffered events as one message.
+        Returns the ``AsyncResult``, or None if there was nothing to send.
+        """
+        with self._lock:
+            events = self._take()
+        if not events:
+            return None
+        return self._flush(events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def _enqueue(self, events):
+        from .tasks import event_batch_tracker
+        # Messages hold plain dicts, which any task serializer can encode
+        events = [event.to_dict() for event in events]
+        if self.token:
+            return event_batch_tracker.apply_async(
+                args=[events], kwargs={'token': self.token}, **self.options)
+        return event_batch_tracker.apply_async(args=[events], **self.options)
+
+
+_local = threading.local()
+
+def get_buffer(token=None):
+    """
+    Returns the calling thread's shared :class:`EventBuffer` for ``token``,
+    creating it if needed. Each token has its own buffer, enqueued on the
+    ``queue`` of its MIXPANEL_TOKEN_SETTINGS if it has one, so a batch holds
+    the events of a single project. Call :func:`flush` at the end of each
+    request.
+    """
+    conf.load()
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    buf = buffers.get(token)
+    if buf is None:
+        options = {}
+        queue = routing.token_setting(token, 'queue')
+        if queue:
+            options['queue'] = queue
+        buf = buffers[token] = EventBuffer(token=token, **options)
+    return buf
+
+def track(event_name, properties=None, token=None):
+    """
+    Buffers an event in the calling thread's shared buffer for ``token``.
+    """
+    return get_buffer(token).add(event_name, properties)
+
+def flush():
+    """
+    Flushes all of the calling thread's shared buffers.
+    Returns the ``AsyncResult`` of each message enqueued.
+    """
+    results = []
+    for buf in getattr(_local, 'buffers', {}).values():
+        result = buf.flush()
+        if result is not None:
+            results.append(result)
+    return results
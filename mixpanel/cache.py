@@ -0,0 +1,56 @@
+"""Bounded in-process caches"""
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping holding at most ``max_size`` entries, evicting the
+    least recently used one when full. Entries also expire ``ttl`` seconds
+    after they were set, unless ``ttl`` is None.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        """
+        Returns the value of ``key``, or ``default`` if it is missing or expired.
+        """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            expires, value = item
+            if expires is not None and expires <= self._clock():
+                return default
+            # Re-insert to mark it as the most recently used
+            self._items[key] = item
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            expires = None if self.ttl is None else self._clock() + self.ttl
+            self._items[key] = (expires, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
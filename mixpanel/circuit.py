@@ -0,0 +1,139 @@
+"""Circuit breaker that stops sending while the api server is failing"""
+from __future__ import absolute_import
+
+import os
+import tempfile
+import threading
+import time
+
+from . import conf
+from .conf import settings as mp_settings
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive request failures and opens after ``threshold`` of them.
+
+    While open, :meth:`allow` refuses requests for ``reset_timeout`` seconds.
+    After that a single trial request is let through (the half-open state):
+    if it succeeds the circuit closes again, otherwise it re-opens for
+    another ``reset_timeout``. A trial that reports neither, e.g. because
+    its task was killed, is given up on after ``reset_timeout`` too, and
+    another one is let through.
+
+    The breaker is shared by the threads of a worker process. When
+    ``state_file`` is given, opening the circuit also records the time it
+    re-closes in that file, so every worker process on the host that uses the
+    same file stops sending as well.
+    """
+
+    def __init__(self, threshold=None, reset_timeout=None, state_file=None,
+                 clock=time.time):
+        self.threshold = threshold or mp_settings.MIXPANEL_CIRCUIT_FAILURE_THRESHOLD
+        if reset_timeout is None:
+            reset_timeout = mp_settings.MIXPANEL_CIRCUIT_RESET_TIMEOUT
+        self.reset_timeout = reset_timeout
+        self.state_file = state_file
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0
+        self._trial_until = 0
+        self._file_mtime = None
+        self._file_open_until = 0
+
+    def allow(self):
+        """
+        Returns True if a request may be sent now.
+        """
+        now = self._clock()
+        with self._lock:
+            open_until = max(self._open_until, self._read_state())
+            if now < open_until:
+                return False
+            if open_until and self._failures >= self.threshold:
+                # Half-open: let one trial request through at a time
+                if now < self._trial_until:
+                    return False
+                self._trial_until = now + self.reset_timeout
+            return True
+
+    def retry_after(self):
+        """
+        Returns the number of seconds until the circuit lets requests through.
+        """
+        with self._lock:
+            open_until = max(self._open_until, self._read_state())
+            if open_until and self._failures >= self.threshold:
+                # A trial is pending, or will be once the circuit half-opens
+                open_until = max(open_until, self._trial_until)
+        return max(0, open_until - self._clock())
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_until = 0
+            if self._open_until:
+                self._open_until = 0
+                self._write_state(0)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_until = 0
+            if self._failures >= self.threshold:
+                self._open_until = self._clock() + self.reset_timeout
+                self._write_state(self._open_until)
+
+    def _read_state(self):
+        if not self.state_file:
+            return 0
+        try:
+            mtime = os.stat(self.state_file).st_mtime
+        except OSError:
+            return 0
+        if mtime != self._file_mtime:
+            try:
+                with open(self.state_file) as f:
+                    self._file_open_until = float(f.read() or 0)
+            except (IOError, ValueError):
+                self._file_open_until = 0
+            self._file_mtime = mtime
+        return self._file_open_until
+
+    def _write_state(self, open_until):
+        if not self.state_file:
+            return
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written value
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(repr(open_until))
+        os.rename(path, self.state_file)
+        self._file_mtime = None
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+def get_breaker():
+    """
+    Returns the worker process's circuit breaker, or None if
+    MIXPANEL_CIRCUIT_BREAKER is disabled.
+    """
+    global _breaker
+    if not mp_settings.MIXPANEL_CIRCUIT_BREAKER:
+        return None
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                state_file=mp_settings.MIXPANEL_CIRCUIT_STATE_FILE)
+        return _breaker
+
+@conf.on_reload
+def _reset():
+    # Pick up new thresholds and state files
+    global _breaker
+    with _breaker_lock:
+        _breaker = None
@@ -0,0 +1,108 @@
+"""Loading of the settings from Celery, Django and the environment
+
+The defaults in :mod:`mixpanel.conf.settings` are overridden by the
+``MIXPANEL_*`` settings of, in increasing order of precedence:
+
+* the configuration of the current Celery app,
+* Django's settings, when Django is configured,
+* environment variables, whose values are parsed as JSON unless the setting
+  is a string or defaults to ``None``, e.g. ``MIXPANEL_MAX_RETRIES=10`` or
+  ``MIXPANEL_RATE_LIMITS='{"/track/": [400, 800]}'``.
+
+They are read once, before the first task runs or the first buffer, batcher,
+sender or import is created, and again by :func:`reload`. Settings assigned
+directly to :mod:`mixpanel.conf.settings` apply until then.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+
+import simplejson
+
+from . import settings
+
+DEFAULTS = dict((name, value) for name, value in vars(settings).items()
+                if name.startswith('MIXPANEL_'))
+
+_lock = threading.Lock()
+_loaded = None
+_hooks = []
+
+
+def load():
+    """
+    Reads the settings from their sources unless that was done already.
+    """
+    if _loaded is not None:
+        return
+    with _lock:
+        if _loaded is not None:
+            return
+        _apply(_read())
+    _run_hooks()
+
+def reload():
+    """
+    Reads the settings from their sources again, reverting settings no
+    longer set to their defaults, and calls the :func:`on_reload` hooks.
+    """
+    with _lock:
+        _apply(_read())
+    _run_hooks()
+
+def on_reload(hook):
+    """
+    Registers ``hook`` to be called without arguments after the settings
+    are loaded or reloaded. Returns ``hook``, so it can be used as a
+    decorator.
+    """
+    _hooks.append(hook)
+    return hook
+
+def _apply(values):
+    global _loaded
+    for name in set(_loaded or ()) - set(values):
+        setattr(settings, name, DEFAULTS[name])
+    for name, value in values.iteritems():
+        setattr(settings, name, value)
+    _loaded = values
+
+def _run_hooks():
+    for hook in list(_hooks):
+        hook()
+
+def _read():
+    values = {}
+    for source in (_celery_config, _django_settings, _environ):
+        values.update(source())
+    return values
+
+def _celery_config():
+    from celery import current_app
+    conf = current_app.conf
+    return dict((name, conf[name]) for name in DEFAULTS if name in conf)
+
+def _django_settings():
+    try:
+        from django.conf import settings as django_settings
+    except ImportError:
+        return {}
+    if not (django_settings.configured or os.environ.get('DJANGO_SETTINGS_MODULE')):
+        return {}
+    return dict((name, getattr(django_settings, name)) for name in DEFAULTS
+                if hasattr(django_settings, name))
+
+def _environ():
+    return dict((name, _parse(os.environ[name], DEFAULTS[name])) for name in DEFAULTS
+                if name in os.environ)
+
+def _parse(value, default):
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if default is None or isinstance(default, basestring):
+        return value
+    try:
+        return simplejson.loads(value)
+    except ValueError:
+        return value
@@ -51,6 +51,17 @@ MIXPANEL_API_TIMEOUT = 5
 """
 MIXPANEL_API_SERVER = 'api.mixpanel.com'
 
+"""
+.. data:: MIXPANEL_API_SCHEME
+
+    URL scheme used to reach the api server, ``'https'`` or ``'http'``. Plain
+    HTTP is only useful for talking to a local stand-in, such as the one in
+    ``benchmarks/fake_mixpanel.py``.
+
+    Defaults to ``'https'``.
+"""
+MIXPANEL_API_SCHEME = 'https'
+
 """
 .. data:: MIXPANEL_TRACKING_ENDPOINT
 
@@ -85,3 +96,556 @@ MIXPANEL_DATA_VARIABLE = 'data'
     just a normal event.
 """
 MIXPANEL_FUNNEL_EVENT_ID = 'mp_funnel'
+
+"""
+.. data:: MIXPANEL_BATCH_SIZE
+
+    Maximum number of events sent to the tracking endpoint in a single
+    request by the batching tasks. Mixpanel accepts at most 50 events per
+    request.
+
+    Defaults to 50 events.
+"""
+MIXPANEL_BATCH_SIZE = 50
+
+"""
+.. data:: MIXPANEL_BATCH_INTERVAL
+
+    Number of seconds an :class:`~mixpanel.batch.EventBatcher` may hold on to
+    buffered events before they are flushed, even if the batch isn't full.
+
+    Defaults to 10 seconds.
+"""
+MIXPANEL_BATCH_INTERVAL = 10
+
+"""
+.. data:: MIXPANEL_CONNECTION_POOL
+
+    Whether to send requests over a per-process pool of keep-alive HTTPS
+    connections to ``MIXPANEL_API_SERVER``, instead of opening a new
+    connection for every request. The pool is shared by all of the tracking
+    tasks and is safe to use with Celery's prefork pool.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_CONNECTION_POOL = False
+
+"""
+.. data:: MIXPANEL_POOL_SIZE
+
+    Maximum number of idle connections kept open by each worker process.
+
+    Defaults to 4 connections.
+"""
+MIXPANEL_POOL_SIZE = 4
+
+"""
+.. data:: MIXPANEL_POOL_IDLE_TIMEOUT
+
+    Number of seconds a pooled connection may sit idle before it is closed
+    instead of being reused.
+
+    Defaults to 60 seconds.
+"""
+MIXPANEL_POOL_IDLE_TIMEOUT = 60
+
+"""
+.. data:: MIXPANEL_POOL_RECONNECT_ON_RESET
+
+    Whether a request that fails because the server closed a pooled
+    connection before receiving it is retried once on a new connection,
+    rather than failing the task. Timeouts are never retried this way.
+
+    Defaults to ``True``.
+"""
+MIXPANEL_POOL_RECONNECT_ON_RESET = True
+
+"""
+.. data:: MIXPANEL_REQUEST_METHOD
+
+    HTTP method used to send tracking data. With ``'GET'`` the data is
+    base64-encoded into the querystring. With ``'POST'`` the JSON data is sent
+    as-is in a form-encoded request body, which is smaller and isn't subject
+    to URL length limits. Batches of events are always POSTed.
+
+    Defaults to ``'GET'``.
+"""
+MIXPANEL_REQUEST_METHOD = 'GET'
+
+"""
+.. data:: MIXPANEL_GZIP_REQUESTS
+
+    Whether POSTed request bodies are gzip-compressed (and sent with
+    ``Content-Encoding: gzip``). Has no effect on GET requests.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_GZIP_REQUESTS = False
+
+"""
+.. data:: MIXPANEL_SENDER_CONCURRENCY
+
+    Maximum number of requests a :class:`~mixpanel.sender.ConcurrentSender`
+    (and so a single batch task) has in flight at once. Set it to 1 to send
+    requests one after another in the calling thread.
+
+    Defaults to 10 requests.
+"""
+MIXPANEL_SENDER_CONCURRENCY = 10
+
+"""
+.. data:: MIXPANEL_BUFFER_MAX_EVENTS
+
+    Number of events an :class:`~mixpanel.buffer.EventBuffer` collects before
+    enqueueing them as a single batch task message. The batch task splits
+    them into requests of ``MIXPANEL_BATCH_SIZE`` events.
+
+    Defaults to 500 events.
+"""
+MIXPANEL_BUFFER_MAX_EVENTS = 500
+
+"""
+.. data:: MIXPANEL_BUFFER_MAX_AGE
+
+    Number of seconds an :class:`~mixpanel.buffer.EventBuffer` may hold on to
+    events before enqueueing them, even if it isn't full.
+
+    Defaults to 5 seconds.
+"""
+MIXPANEL_BUFFER_MAX_AGE = 5
+
+"""
+.. data:: MIXPANEL_SERIALIZER
+
+    Name of the JSON serializer used to encode tracking data: one of
+    ``'simplejson'``, ``'json'`` (the standard library's C-accelerated
+    encoder), ``'ujson'`` or ``'orjson'``. The latter two must be installed
+    separately. All of them encode ``datetime``, ``date``, ``Decimal`` and
+    ``UUID`` property values.
+
+    Defaults to ``'simplejson'``.
+"""
+MIXPANEL_SERIALIZER = 'simplejson'
+
+"""
+.. data:: MIXPANEL_RETRY_BACKOFF
+
+    Whether the delay before each retry doubles, starting from
+    ``MIXPANEL_RETRY_DELAY`` and up to ``MIXPANEL_RETRY_BACKOFF_MAX``.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_RETRY_BACKOFF = False
+
+"""
+.. data:: MIXPANEL_RETRY_BACKOFF_MAX
+
+    Maximum number of seconds to wait before a retry when
+    ``MIXPANEL_RETRY_BACKOFF`` is enabled.
+
+    Defaults to 1 hour.
+"""
+MIXPANEL_RETRY_BACKOFF_MAX = 60*60
+
+"""
+.. data:: MIXPANEL_RETRY_JITTER
+
+    Whether retry delays are randomized (to between half and all of the
+    delay), so tasks that failed together don't all retry at the same moment.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_RETRY_JITTER = False
+
+"""
+.. data:: MIXPANEL_CIRCUIT_BREAKER
+
+    Whether each worker process stops sending requests for a while after
+    ``MIXPANEL_CIRCUIT_FAILURE_THRESHOLD`` consecutive failures, instead of
+    waiting on requests that are likely to fail too.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_CIRCUIT_BREAKER = False
+
+"""
+.. data:: MIXPANEL_CIRCUIT_FAILURE_THRESHOLD
+
+    Number of consecutive failed requests that opens the circuit breaker.
+
+    Defaults to 5 failures.
+"""
+MIXPANEL_CIRCUIT_FAILURE_THRESHOLD = 5
+
+"""
+.. data:: MIXPANEL_CIRCUIT_RESET_TIMEOUT
+
+    Number of seconds the circuit breaker stays open before a trial request
+    is let through.
+
+    Defaults to 60 seconds.
+"""
+MIXPANEL_CIRCUIT_RESET_TIMEOUT = 60
+
+"""
+.. data:: MIXPANEL_CIRCUIT_STATE_FILE
+
+    Path of a file used to share the circuit breaker's state between the
+    worker processes of a host. When unset, each process has its own circuit.
+
+    Defaults to ``None``.
+"""
+MIXPANEL_CIRCUIT_STATE_FILE = None
+
+"""
+.. data:: MIXPANEL_PARKING_QUEUE
+
+    Name of the queue that tasks are sent to while the circuit breaker is
+    open. They are delayed until the circuit lets requests through again, and
+    this doesn't count against ``MIXPANEL_MAX_RETRIES``. A worker must
+    consume this queue. When unset, such tasks are retried like any other
+    failure.
+
+    Defaults to ``None``.
+"""
+MIXPANEL_PARKING_QUEUE = None
+
+"""
+.. data:: MIXPANEL_SPOOL_DIR
+
+    Directory of an on-disk spool for requests that couldn't be delivered.
+    When set, requests are written to the spool once their task runs out of
+    retries, and while the circuit breaker is open, instead of being lost or
+    occupying broker messages. The :func:`~mixpanel.tasks.spool_replay` task
+    sends them once the api server recovers.
+
+    Defaults to ``None``, which disables the spool.
+"""
+MIXPANEL_SPOOL_DIR = None
+
+"""
+.. data:: MIXPANEL_SPOOL_SEGMENT_BYTES
+
+    Size at which a spool segment file is sealed and a new one is started.
+    Fully sent segments are deleted by the replay task.
+
+    Defaults to 4 MiB.
+"""
+MIXPANEL_SPOOL_SEGMENT_BYTES = 4*1024*1024
+
+"""
+.. data:: MIXPANEL_SPOOL_MAX_BYTES
+
+    Maximum disk space used by the spool. Requests that don't fit are
+    dropped, with a warning.
+
+    Defaults to 512 MiB.
+"""
+MIXPANEL_SPOOL_MAX_BYTES = 512*1024*1024
+
+"""
+.. data:: MIXPANEL_SPOOL_REPLAY_LIMIT
+
+    Maximum number of requests sent by a single run of the replay task.
+
+    Defaults to 10000 requests.
+"""
+MIXPANEL_SPOOL_REPLAY_LIMIT = 10000
+
+"""
+.. data:: MIXPANEL_RATE_LIMITS
+
+    Client-side rate limits per api endpoint, as a dict mapping endpoints to
+    ``(events_per_second, burst)`` tuples, e.g.
+    ``{'/track/': (400, 800), '/engage/': (100, 200)}``. Requests that would
+    exceed a limit wait until they fit instead of failing. Limits apply per
+    worker process and are shared by its threads.
+
+    Defaults to no limits.
+"""
+MIXPANEL_RATE_LIMITS = {}
+
+"""
+.. data:: MIXPANEL_TOKEN_RATE_LIMITS
+
+    Client-side rate limits per api token, in the same format as
+    ``MIXPANEL_RATE_LIMITS``. Both limits apply to requests matching both.
+
+    Defaults to no limits.
+"""
+MIXPANEL_TOKEN_RATE_LIMITS = {}
+
+"""
+.. data:: MIXPANEL_API_KEY
+
+    API key for your Mixpanel project, required by the import endpoint to
+    record historical events. You can find it next to the API token.
+
+    Defaults to ``None``.
+"""
+MIXPANEL_API_KEY = None
+
+"""
+.. data:: MIXPANEL_IMPORT_ENDPOINT
+
+    URL endpoint for importing historical events. defaults to ``/import/``
+
+    Mind the slashes.
+"""
+MIXPANEL_IMPORT_ENDPOINT = '/import/'
+
+"""
+.. data:: MIXPANEL_IMPORT_SENDERS
+
+    Number of requests :mod:`mixpanel.importer` has in flight at once.
+
+    Defaults to 4 requests.
+"""
+MIXPANEL_IMPORT_SENDERS = 4
+
+"""
+.. data:: MIXPANEL_TOKEN_SETTINGS
+
+    Settings per api token, for workers that track several projects, as a
+    dict mapping tokens to dicts of:
+
+    ``queue``
+        Celery queue for the project's tasks, used by
+        :class:`mixpanel.routing.TokenRouter` and the project's
+        :func:`mixpanel.buffer.get_buffer` buffer.
+    ``batch_size``
+        Replaces ``MIXPANEL_BATCH_SIZE`` for the project's batches.
+    ``timeout``
+        Replaces ``MIXPANEL_API_TIMEOUT`` for the project's requests.
+
+    e.g. ``{'hot-token': {'queue': 'mixpanel-hot', 'timeout': 2}}``. Rate
+    limits per token are set with ``MIXPANEL_TOKEN_RATE_LIMITS``. Tasks
+    without a ``token`` use the settings of ``MIXPANEL_API_TOKEN``.
+
+    Defaults to no per-token settings.
+"""
+MIXPANEL_TOKEN_SETTINGS = {}
+
+"""
+.. data:: MIXPANEL_METRICS
+
+    Backend receiving the metrics listed in :mod:`mixpanel.metrics`:
+    ``'prometheus'``, ``'statsd'``, or the dotted path of a class
+    implementing :class:`~mixpanel.metrics.NullBackend`'s methods.
+
+    Defaults to ``None``, which discards them.
+"""
+MIXPANEL_METRICS = None
+
+"""
+.. data:: MIXPANEL_STATSD_HOST
+
+    Host of the StatsD server used by the ``'statsd'`` metrics backend.
+
+    Defaults to ``'localhost'``.
+"""
+MIXPANEL_STATSD_HOST = 'localhost'
+
+"""
+.. data:: MIXPANEL_STATSD_PORT
+
+    UDP port of the StatsD server.
+
+    Defaults to 8125.
+"""
+MIXPANEL_STATSD_PORT = 8125
+
+"""
+.. data:: MIXPANEL_STATSD_PREFIX
+
+    Prefix of the metric names sent to StatsD.
+
+    Defaults to ``'mixpanel'``.
+"""
+MIXPANEL_STATSD_PREFIX = 'mixpanel'
+
+"""
+.. data:: MIXPANEL_LOG_EVENTS
+
+    Whether the tasks log every event and update they record at INFO level.
+    Turn it off at high volumes, where the log lines cost more than they
+    tell; failures and retries are still logged.
+
+    Defaults to ``True``.
+"""
+MIXPANEL_LOG_EVENTS = True
+
+"""
+.. data:: MIXPANEL_SAMPLE_RATES
+
+    Fractions of events to send per event name, e.g. ``{'Viewed page':
+    0.1}``. Whether an event is sent depends on a hash of its
+    ``distinct_id`` and name, so a user's events of that name are either all
+    sent or all dropped. Sent events hold their rate in the
+    ``MIXPANEL_SAMPLE_RATE_PROPERTY`` property, to scale counts back up.
+
+    Defaults to sending all events.
+"""
+MIXPANEL_SAMPLE_RATES = {}
+
+"""
+.. data:: MIXPANEL_SAMPLE_RATE_PROPERTY
+
+    Name of the property holding the sample rate of sampled events.
+
+    Defaults to ``'sample_rate'``.
+"""
+MIXPANEL_SAMPLE_RATE_PROPERTY = 'sample_rate'
+
+"""
+.. data:: MIXPANEL_DEDUPE_CACHE_SIZE
+
+    Number of ``$insert_id`` values each worker process remembers from the
+    events it sent, dropping later events with the same ``$insert_id`` and
+    token, such as those of retried client requests. ``0`` disables
+    deduplication.
+
+    Defaults to 0.
+"""
+MIXPANEL_DEDUPE_CACHE_SIZE = 0
+
+"""
+.. data:: MIXPANEL_DEDUPE_TTL
+
+    Number of seconds an ``$insert_id`` is remembered for.
+
+    Defaults to 3600 seconds.
+"""
+MIXPANEL_DEDUPE_TTL = 3600
+
+"""
+.. data:: MIXPANEL_SUPER_PROPERTIES
+
+    Properties added to every event, unless the event sets them itself.
+    Callable values are called once per process. See
+    :mod:`mixpanel.properties`.
+
+    Defaults to no super properties.
+"""
+MIXPANEL_SUPER_PROPERTIES = {}
+
+"""
+.. data:: MIXPANEL_PROPERTY_ENRICHER
+
+    Dotted path of a function called with a ``distinct_id`` that returns
+    properties to add to that user's events, e.g.
+    ``'myapp.analytics.user_properties'``. Event properties take precedence.
+
+    Defaults to ``None``.
+"""
+MIXPANEL_PROPERTY_ENRICHER = None
+
+"""
+.. data:: MIXPANEL_ENRICHMENT_CACHE_SIZE
+
+    Number of users whose enrichment each worker process caches.
+
+    Defaults to 10000 users.
+"""
+MIXPANEL_ENRICHMENT_CACHE_SIZE = 10000
+
+"""
+.. data:: MIXPANEL_ENRICHMENT_TTL
+
+    Number of seconds enrichment results are cached for.
+
+    Defaults to 300 seconds.
+"""
+MIXPANEL_ENRICHMENT_TTL = 300
+
+"""
+.. data:: MIXPANEL_MAX_REQUEST_BYTES
+
+    Largest request the api accepts, counting the serialized data before
+    any base64 or gzip encoding. Batches are split to stay below it, and
+    larger requests fail with :class:`~mixpanel.tasks.PayloadTooLarge`
+    instead of being retried.
+
+    Defaults to 2 MiB.
+"""
+MIXPANEL_MAX_REQUEST_BYTES = 2 * 1024 * 1024
+
+"""
+.. data:: MIXPANEL_MAX_EVENT_BYTES
+
+    Largest serialized event or people update the api accepts. Larger ones
+    are truncated if ``MIXPANEL_TRUNCATE_LENGTH`` is set, and otherwise
+    rejected: single tasks fail with
+    :class:`~mixpanel.tasks.PayloadTooLarge`, and batches drop them,
+    reporting False for them.
+
+    Defaults to 1 MiB.
+"""
+MIXPANEL_MAX_EVENT_BYTES = 1024 * 1024
+
+"""
+.. data:: MIXPANEL_TRUNCATE_LENGTH
+
+    Number of characters string values of oversized events are cut to,
+    e.g. 255, which is as much as Mixpanel keeps of them anyway.
+
+    Defaults to 0, which rejects oversized events.
+"""
+MIXPANEL_TRUNCATE_LENGTH = 0
+
+"""
+.. data:: MIXPANEL_VERBOSE
+
+    Whether to ask the api for verbose JSON responses, so the reason a
+    request was rejected is logged, and responses listing the records that
+    failed yield a result per event.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_VERBOSE = False
+
+"""
+.. data:: MIXPANEL_STAMP_EVENTS
+
+    Whether events get a ``time``, in milliseconds since the epoch, and a
+    unique ``$insert_id`` when their task is enqueued or they are buffered,
+    unless they have them, or else when a worker builds them. Events
+    then keep their occurrence time however long they are queued, and
+    Mixpanel discards the duplicates that retries may send. Retried tasks
+    and spooled requests keep the stamps of the first attempt.
+
+    Defaults to ``False``.
+"""
+MIXPANEL_STAMP_EVENTS = False
+
+"""
+.. data:: MIXPANEL_INSERT_ID_GENERATOR
+
+    Name of a function returning a new ``$insert_id`` string of at most 36
+    letters, digits and dashes, e.g. ``'myapp.tracking:new_insert_id'``.
+
+    Defaults to ``None``, which uses :func:`mixpanel.properties.insert_id`.
+"""
+MIXPANEL_INSERT_ID_GENERATOR = None
+
+"""
+.. data:: MIXPANEL_TRANSPORT
+
+    Name of the transport requests are sent with: ``'urllib'``,
+    ``'pooled'``, ``'memory'``, ``'file'`` or the name of a
+    :class:`~mixpanel.transports.Transport` class. See
+    :mod:`mixpanel.transports`.
+
+    Defaults to ``None``, which uses ``'pooled'`` if
+    ``MIXPANEL_CONNECTION_POOL`` is set and ``'urllib'`` otherwise.
+"""
+MIXPANEL_TRANSPORT = None
+
+"""
+.. data:: MIXPANEL_TRANSPORT_FILE
+
+    Path of the file the ``'file'`` transport appends requests to.
+
+    Defaults to ``None``, which writes them to standard output.
+"""
+MIXPANEL_TRANSPORT_FILE = None
@@ -0,0 +1,175 @@
+"""Compact records of events held in memory before they are sent
+
+An :class:`Event` keeps the properties every event has in attributes rather
+than in a dict of its own, and shares the name and property keys it was
+created with, so the many events held by a buffer cost a fraction of the
+memory of ``{'event': ..., 'properties': {...}}`` dicts. Records serialize
+straight to the JSON Mixpanel expects::
+
+    >>> Event('Signed up', {'distinct_id': 42, 'plan': 'pro'}).encode()
+    '{"event":"Signed up","properties":{"distinct_id":42,"plan":"pro"}}'
+"""
+from __future__ import absolute_import
+
+from . import serializers
+
+#: Properties kept in attributes of their own
+FIELDS = ('token', 'distinct_id', 'time')
+
+# Names and property keys shared by all the records of the process, up to
+# a bound so that generated keys can't grow it forever
+_interned = {}
+_MAX_INTERNED = 10000
+
+
+def _intern(value):
+    shared = _interned.get(value)
+    if shared is not None:
+        return shared
+    if len(_interned) < _MAX_INTERNED and isinstance(value, basestring):
+        _interned[value] = value
+    return value
+
+
+# Encodings of the names and tokens most events share
+_encoded = {}
+
+def _dumps_shared(value, dumps):
+    key = (value, dumps)
+    data = _encoded.get(key)
+    if data is None:
+        data = dumps(value)
+        if len(_encoded) < _MAX_INTERNED:
+            _encoded[key] = data
+    return data
+
+def _dumps_scalar(value, dumps):
+    # Integers are their own JSON, sparing a call to the serializer
+    if type(value) in (int, long):
+        return str(value)
+    return dumps(value)
+
+
+class Event(object):
+    """
+    An event named ``name``. The ``token``, ``distinct_id`` and ``time``
+    properties are kept in attributes, taking their values from
+    ``properties`` if it has them, and ``properties`` holds the others, or
+    is None if there are none.
+
+    Records are read-only once created, and copies share their
+    ``properties``. For code expecting event dicts, ``event['event']`` and
+    ``event['properties']`` work too, the latter building a new dict, and a
+    record equals the dict returned by :meth:`to_dict`.
+    """
+
+    __slots__ = ('name', 'token', 'distinct_id', 'time', 'properties')
+
+    def __init__(self, name, properties=None, token=None, distinct_id=None, time=None):
+        extra = None
+        if properties:
+            extra = {}
+            for key, value in properties.iteritems():
+                if key == 'token':
+                    token = value
+                elif key == 'distinct_id':
+                    distinct_id = value
+                elif key == 'time':
+                    time = value
+                else:
+                    extra[_intern(key)] = value
+        self.name = _intern(name)
+        self.token = token
+        self.distinct_id = distinct_id
+        self.time = time
+        self.properties = extra or None
+
+    @classmethod
+    def from_dict(cls, event):
+        """
+        Returns the record of an ``{'event', 'properties'}`` dict.
+        """
+        return cls(event['event'], event.get('properties'))
+
+    def to_dict(self):
+        """
+        Returns the event as a new ``{'event', 'properties'}`` dict.
+        """
+        props = dict(self.properties or ())
+        for field in FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                props[field] = value
+        return {'event': self.name, 'properties': props}
+
+    def with_token(self, token):
+        """
+        Returns a copy of the record whose token is ``token``.
+        """
+        event = Event.__new__(Event)
+        event.name = self.name
+        event.token = token
+        event.distinct_id = self.distinct_id
+        event.time = self.time
+        event.properties = self.properties
+        return event
+
+    def encode(self, dumps=None):
+        """
+        Returns the event serialized as JSON by ``dumps``, which defaults to
+        the configured serializer, without building its dict.
+        """
+        dumps = dumps or serializers.get_serializer()
+        fields = []
+        if self.token is not None:
+            fields.append('"token":' + _dumps_shared(self.token, dumps))
+        if self.distinct_id is not None:
+            fields.append('"distinct_id":' + _dumps_scalar(self.distinct_id, dumps))
+        if self.time is not None:
+            fields.append('"time":' + _dumps_scalar(self.time, dumps))
+        if self.properties:
+            fields.append(dumps(self.properties)[1:-1])
+        return '{"event":%s,"properties":{%s}}' % (_dumps_shared(self.name, dumps),
+                                                    ','.join(fields))
+
+    def __getitem__(self, key):
+        if key == 'event':
+            return self.name
+        if key == 'properties':
+            return self.to_dict()['properties']
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in ('event', 'properties')
+
+    def __eq__(self, other):
+        if isinstance(other, Event):
+            other = other.to_dict()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (Event, (self.name, self.properties, self.token, self.distinct_id, self.time))
+
+    def __repr__(self):
+        return '<Event %r %r>' % (self.name, self.to_dict()['properties'])
+
+
+def as_dict(event):
+    """
+    Returns ``event`` as a dict if it is an :class:`Event`, else unchanged.
+    """
+    return event.to_dict() if isinstance(event, Event) else event
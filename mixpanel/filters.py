@@ -0,0 +1,101 @@
+"""Sampling and deduplication of events before they are sent"""
+from __future__ import absolute_import
+
+import hashlib
+import random
+import threading
+
+from .cache import LRUCache
+from .conf import settings as mp_settings
+from . import metrics
+
+
+def enabled():
+    """
+    Returns True if events may be sampled or deduplicated.
+    """
+    return bool(mp_settings.MIXPANEL_SAMPLE_RATES or mp_settings.MIXPANEL_DEDUPE_CACHE_SIZE)
+
+def sample_rate(event_name):
+    """
+    Returns the fraction of ``event_name`` events that are sent.
+    """
+    return mp_settings.MIXPANEL_SAMPLE_RATES.get(event_name, 1)
+
+def in_sample(event_name, distinct_id, rate):
+    """
+    Returns True if the ``event_name`` events of ``distinct_id`` are within
+    the sample of size ``rate``. The choice only depends on the user and
+    event name, so a user's events are either all sent or all dropped.
+    Events without a ``distinct_id`` are sampled at random.
+    """
+    if rate >= 1:
+        return True
+    if distinct_id is None:
+        return random.random() < rate
+    key = ('%s:%s' % (distinct_id, event_name)).encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16) < rate * 0x100000000
+
+def keep_event(event, seen=None):
+    """
+    Returns True if the built ``{'event', 'properties'}`` dict should be
+    sent, stamping the sample rate into its properties if it is sampled.
+
+    Events are dropped if they fall outside the MIXPANEL_SAMPLE_RATES sample
+    of their name, or if an event with the same token and ``$insert_id``
+    was sent recently by this worker, or is in ``seen``, a set of those
+    already kept from the current batch.
+    """
+    name, props = event['event'], event['properties']
+    rate = sample_rate(name)
+    if rate < 1:
+        if not in_sample(name, props.get('distinct_id'), rate):
+            metrics.get_metrics().incr('mixpanel_events_sampled_out_total')
+            return False
+        props[mp_settings.MIXPANEL_SAMPLE_RATE_PROPERTY] = rate
+
+    insert_id = props.get('$insert_id')
+    cache = get_dedupe_cache()
+    if insert_id is not None and cache is not None:
+        key = (props.get('token'), insert_id)
+        if key in cache or (seen is not None and key in seen):
+            metrics.get_metrics().incr('mixpanel_events_deduplicated_total')
+            return False
+        if seen is not None:
+            seen.add(key)
+    return True
+
+def mark_sent(params):
+    """
+    Remembers the ``$insert_id`` of the events in a request's ``params``
+    that Mixpanel accepted, so that duplicates are dropped.
+    """
+    cache = get_dedupe_cache()
+    if cache is None:
+        return
+    for event in params if isinstance(params, list) else [params]:
+        props = event.get('properties')
+        if props and '$insert_id' in props:
+            cache.set((props.get('token'), props['$insert_id']), True)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_dedupe_cache():
+    """
+    Returns the worker process's cache of sent ``$insert_id`` values, or None
+    if MIXPANEL_DEDUPE_CACHE_SIZE is 0.
+    """
+    global _cache
+    size = mp_settings.MIXPANEL_DEDUPE_CACHE_SIZE
+    if not size:
+        return None
+    ttl = mp_settings.MIXPANEL_DEDUPE_TTL
+    cache = _cache
+    if cache is not None and cache.max_size == size and cache.ttl == ttl:
+        return cache
+    with _cache_lock:
+        if _cache is None or _cache.max_size != size or _cache.ttl != ttl:
+            _cache = LRUCache(size, ttl)
+        return _cache
@@ -0,0 +1,69 @@
+"""Funnel sessions sending the steps of a user's funnel as one ordered batch"""
+from __future__ import absolute_import
+
+import time
+
+from .buffer import EventBuffer
+from . import conf
+from .conf import settings as mp_settings
+from . import routing
+
+
+class FunnelSession(EventBuffer):
+    """
+    Buffers the steps of one user's ``funnel`` and enqueues them as a single
+    :func:`~mixpanel.tasks.event_batch_tracker` message, rather than one
+    :func:`~mixpanel.tasks.funnel_event_tracker` message per step, which
+    may be sent out of order once retried::
+
+        with FunnelSession('Signup', 'Confirmed', {'distinct_id': user.id}) as funnel:
+            funnel.step('Viewed form')
+            funnel.step('Submitted form', {'referrer': referrer})
+            funnel.step('Confirmed')
+
+    ``properties`` must contain the ``distinct_id``, and are validated once
+    by the constructor, which raises
+    :class:`~mixpanel.tasks.InvalidFunnelProperties` otherwise. Each step
+    gets a ``time`` in milliseconds that is greater than that of the step
+    before it, so Mixpanel orders the steps as they were taken even when
+    they are sent in several requests.
+
+    The session is flushed like an :class:`~mixpanel.buffer.EventBuffer`,
+    once it holds MIXPANEL_BATCH_SIZE steps, one request's worth, by
+    default. Other keyword arguments are passed on to ``apply_async``, and
+    the ``queue`` of the token's MIXPANEL_TOKEN_SETTINGS is used unless one
+    is given.
+    """
+
+    def __init__(self, funnel, goal, properties, token=None, max_size=None,
+                 max_age=None, clock=time.time, **options):
+        from .tasks import _add_funnel_props
+
+        conf.load()
+        self.funnel = funnel
+        self.goal = goal
+        self._props = _add_funnel_props(properties, funnel, None, goal)
+        self._last_time = None
+        if 'queue' not in options:
+            queue = routing.token_setting(token, 'queue')
+            if queue:
+                options['queue'] = queue
+        super(FunnelSession, self).__init__(
+            max_size or mp_settings.MIXPANEL_BATCH_SIZE, max_age, token, clock=clock,
+            **options)
+
+    def step(self, step, properties=None):
+        """
+        Buffers the funnel's next ``step``, with ``properties`` added to
+        those of the session.
+        Returns the ``AsyncResult`` if this triggered a flush, else None.
+        """
+        props = dict(self._props)
+        if properties:
+            props.update(properties)
+        props['step'] = step
+        stamp = props.get('time') or int(self._clock() * 1000)
+        if self._last_time is not None and stamp <= self._last_time:
+            stamp = self._last_time + 1
+        props['time'] = self._last_time = stamp
+        return self.add(mp_settings.MIXPANEL_FUNNEL_EVENT_ID, props)
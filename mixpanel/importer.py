@@ -0,0 +1,165 @@
+"""Bulk import of historical events through the Mixpanel import endpoint
+
+Events are streamed from any iterable, such as a JSON-lines file, and sent
+in batches by a few concurrent senders, holding only a bounded number of
+batches in memory. From the command line::
+
+    $ python -m mixpanel.importer --token TOKEN --api-key KEY events.jsonl
+    $ zcat events.jsonl.gz | python -m mixpanel.importer --token TOKEN --api-key KEY -
+"""
+from __future__ import absolute_import
+
+import itertools
+import optparse
+import sys
+import time
+
+import simplejson
+
+from . import conf
+from .conf import settings as mp_settings
+from .sender import ConcurrentSender
+from . import tasks
+
+
+class MissingApiKey(Exception):
+    """The import endpoint requires MIXPANEL_API_KEY"""
+
+
+class ImportStats(object):
+    """Counts of the events handled by :func:`import_events`"""
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self.started = clock()
+        self.sent = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def elapsed(self):
+        return self._clock() - self.started
+
+    @property
+    def rate(self):
+        """
+        Returns the number of events handled per second so far.
+        """
+        return (self.sent + self.rejected + self.failed) / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        return "%d imported, %d rejected, %d failed in %.1fs (%.0f events/s)" % (
+            self.sent, self.rejected, self.failed, self.elapsed, self.rate)
+
+
+class ProgressPrinter(object):
+    """
+    A ``progress`` callback for :func:`import_events` that writes the stats
+    to ``stream`` at most once every ``interval`` seconds.
+    """
+
+    def __init__(self, stream=None, interval=1):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self._last = 0
+
+    def __call__(self, stats, final=False):
+        now = time.time()
+        if final or now - self._last >= self.interval:
+            self._last = now
+            self.stream.write("\r%s%s" % (stats, '\n' if final else ''))
+            self.stream.flush()
+
+
+def read_events(lines):
+    """
+    Yields the events in ``lines`` of JSON, skipping blank lines.
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield simplejson.loads(line)
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def import_events(events, token=None, api_key=None, batch_size=None,
+                  senders=None, progress=None):
+    """
+    Imports ``events``, an iterable of ``{'event', 'properties'}`` dicts whose
+    properties include the ``time`` each event happened.
+    Returns an :class:`ImportStats`.
+
+    ``token`` overrides MIXPANEL_API_TOKEN for events without one, as with
+    :func:`~mixpanel.tasks.event_tracker`. ``api_key`` overrides
+    MIXPANEL_API_KEY. Up to ``senders`` requests of ``batch_size`` events are
+    in flight at once, and at most twice that many batches are read ahead.
+    Events too large to import count as rejected.
+    ``progress`` is called with the stats after every round of requests.
+    """
+    conf.load()
+    api_key = api_key or mp_settings.MIXPANEL_API_KEY
+    if not api_key:
+        raise MissingApiKey("Importing events requires MIXPANEL_API_KEY")
+    batch_size = batch_size or mp_settings.MIXPANEL_BATCH_SIZE
+    senders = senders or mp_settings.MIXPANEL_IMPORT_SENDERS
+    endpoint = mp_settings.MIXPANEL_IMPORT_ENDPOINT
+
+    sender = ConcurrentSender(senders, post=True, query={'api_key': api_key})
+    stats = ImportStats()
+    events = (tasks._build_event(event, token) for event in events)
+    for window in _chunked(events, batch_size * senders * 2):
+        batches, oversized = tasks._encode_batches(window, batch_size)
+        stats.rejected += len(oversized)
+        requests = [([window[i] for i in indexes], endpoint, data)
+                    for indexes, data in batches]
+        for (batch, endpoint, data), result in zip(requests, sender.send_many(requests)):
+            if isinstance(result, list):
+                stats.sent += result.count(True)
+                stats.rejected += result.count(False)
+            elif result is True:
+                stats.sent += len(batch)
+            elif isinstance(result, tasks.FailedEventRequest):
+                stats.failed += len(batch)
+            else:
+                stats.rejected += len(batch)
+        if progress:
+            progress(stats)
+    return stats
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [FILE|-]")
+    parser.add_option('--token', help="api token (default MIXPANEL_API_TOKEN)")
+    parser.add_option('--api-key', help="api key (default MIXPANEL_API_KEY)")
+    parser.add_option('--batch-size', type='int',
+                      help="events per request (default MIXPANEL_BATCH_SIZE)")
+    parser.add_option('--senders', type='int',
+                      help="concurrent requests (default MIXPANEL_IMPORT_SENDERS)")
+    parser.add_option('--quiet', action='store_true', help="don't print progress")
+    options, args = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error("expected a single file")
+
+    if not args or args[0] == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args[0])
+    progress = None if options.quiet else ProgressPrinter()
+    try:
+        stats = import_events(read_events(lines), options.token, options.api_key,
+                              options.batch_size, options.senders, progress)
+    except MissingApiKey as e:
+        parser.error(str(e))
+    if progress:
+        progress(stats, final=True)
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Pluggable metrics about the events sent to Mixpanel
+
+The tasks report these metrics to the backend named by MIXPANEL_METRICS:
+
+``mixpanel_events_enqueued_total``
+    Events and people updates enqueued as tasks, including by
+    :mod:`mixpanel.buffer`.
+``mixpanel_events_sent_total``, ``mixpanel_events_failed_total``
+    Events in requests that reached Mixpanel, or failed to.
+``mixpanel_events_retried_total``
+    Events in requests retried later, including spooled and parked ones.
+``mixpanel_events_sampled_out_total``, ``mixpanel_events_deduplicated_total``
+    Events dropped by :mod:`mixpanel.filters`.
+``mixpanel_batch_size``
+    Histogram of the number of events per request.
+``mixpanel_serialization_seconds``
+    Histogram of the time spent encoding each request.
+``mixpanel_request_seconds``
+    Histogram of the latency of each HTTP request.
+``mixpanel_request_bytes_total``
+    Bytes sent in requests, counting the path and the body.
+"""
+from __future__ import absolute_import
+
+import bisect
+import socket
+import threading
+
+from celery.utils.imports import symbol_by_name
+
+from .conf import settings as mp_settings
+
+BACKENDS = {
+    'prometheus': 'mixpanel.metrics:PrometheusBackend',
+    'statsd': 'mixpanel.metrics:StatsdBackend',
+}
+
+
+class NullBackend(object):
+    """
+    Discards all metrics. Backends implement the same two methods.
+    """
+
+    def incr(self, name, value=1):
+        """
+        Adds ``value`` to the counter ``name``.
+        """
+
+    def observe(self, name, value):
+        """
+        Records ``value`` in the histogram ``name``.
+        """
+
+
+class PrometheusBackend(NullBackend):
+    """
+    Keeps the metrics of the process in memory and renders them in the
+    Prometheus text exposition format. Durations are in seconds.
+
+    Expose :meth:`render` from your web application, or call
+    :meth:`start_http_server` in each worker process.
+    """
+
+    SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                buckets = (self.SECONDS_BUCKETS if name.endswith('_seconds')
+                           else self.SIZE_BUCKETS)
+                # Bucket counts, then the sum of the values
+                histogram = self._histograms[name] = (buckets, [0] * (len(buckets) + 1), [0])
+            buckets, counts, total = histogram
+            counts[bisect.bisect_left(buckets, value)] += 1
+            total[0] += value
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.iteritems()):
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s %s' % (name, value))
+            for name, (buckets, counts, total) in sorted(self._histograms.iteritems()):
+                lines.append('# TYPE %s histogram' % name)
+                cumulative = 0
+                for bound, count in zip(buckets, counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+                cumulative += counts[-1]
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, cumulative))
+                lines.append('%s_sum %s' % (name, total[0]))
+                lines.append('%s_count %d' % (name, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, addr=''):
+        """
+        Serves :meth:`render` on ``port`` from a daemon thread.
+        Returns the server.
+        """
+        import BaseHTTPServer
+        backend = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = backend.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((addr, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class StatsdBackend(NullBackend):
+    """
+    Sends the metrics to a StatsD server over UDP, prefixed with ``prefix``.
+    Histograms of durations are sent as timers in milliseconds, and other
+    histograms as ``|h`` values.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or mp_settings.MIXPANEL_STATSD_HOST,
+                        port or mp_settings.MIXPANEL_STATSD_PORT)
+        if prefix is None:
+            prefix = mp_settings.MIXPANEL_STATSD_PREFIX
+        self.prefix = prefix + '.' if prefix else ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value=1):
+        self._send('%s%s:%s|c' % (self.prefix, name, value))
+
+    def observe(self, name, value):
+        if name.endswith('_seconds'):
+            self._send('%s%s:%s|ms' % (self.prefix, name[:-len('_seconds')],
+                                       round(value * 1000, 3)))
+        else:
+            self._send('%s%s:%s|h' % (self.prefix, name, value))
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            # Metrics are best effort, they must never fail a task
+            pass
+
+
+_backend = None
+_backend_name = None
+_backend_lock = threading.Lock()
+
+def get_metrics():
+    """
+    Returns the process's metrics backend, as named by MIXPANEL_METRICS.
+    """
+    global _backend, _backend_name
+    name = mp_settings.MIXPANEL_METRICS
+    if _backend is not None and _backend_name == name:
+        return _backend
+    with _backend_lock:
+        if _backend is None or _backend_name != name:
+            _backend = symbol_by_name(name, BACKENDS)() if name else NullBackend()
+            _backend_name = name
+        return _backend
@@ -0,0 +1,186 @@
+"""Keep-alive HTTP connections to the Mixpanel api server"""
+from __future__ import absolute_import
+
+import errno
+import httplib
+import os
+import socket
+import threading
+import time
+
+from . import conf
+from .conf import settings as mp_settings
+
+# Errors raised when a kept-alive connection was closed by the server
+RESET_ERRORS = (socket.error, httplib.BadStatusLine, httplib.CannotSendRequest)
+# Socket errors that only show the server never got a request while sending it
+RESET_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent connections to a single host.
+
+    At most ``size`` idle connections are kept, and connections idle for more
+    than ``idle_timeout`` seconds are closed rather than reused. When
+    ``reconnect_on_reset`` is set, a request that fails on a reused connection
+    because the server dropped it is retried once on a fresh connection. Only
+    requests the server can't have received are retried, so timeouts and
+    errors while reading the response are raised.
+
+    The pool notices when it is used from a forked child process (as with
+    Celery's prefork pool) and never reuses the parent's sockets there.
+    """
+
+    def __init__(self, host, size=None, idle_timeout=None, timeout=None,
+                 reconnect_on_reset=None, connection_class=httplib.HTTPSConnection,
+                 clock=time.time):
+        self.host = host
+        self.size = size if size is not None else mp_settings.MIXPANEL_POOL_SIZE
+        if idle_timeout is None:
+            idle_timeout = mp_settings.MIXPANEL_POOL_IDLE_TIMEOUT
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout if timeout is not None else mp_settings.MIXPANEL_API_TIMEOUT
+        if reconnect_on_reset is None:
+            reconnect_on_reset = mp_settings.MIXPANEL_POOL_RECONNECT_ON_RESET
+        self.reconnect_on_reset = reconnect_on_reset
+        self.connection_class = connection_class
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """
+        Performs a request on a pooled connection, with a ``timeout`` other
+        than the pool's if given.
+        Returns a ``(status, content, headers)`` tuple, ``headers`` being a
+        dict with lowercase names.
+        """
+        conn, reused = self._get()
+        if timeout is None:
+            timeout = self.timeout
+        sent = []
+        try:
+            status, content, response_headers, will_close = self._request(
+                conn, method, path, body, headers, timeout, sent)
+        except RESET_ERRORS as e:
+            conn.close()
+            if not (reused and self.reconnect_on_reset and _never_sent(e, sent)):
+                raise
+            conn = self._connect()
+            try:
+                status, content, response_headers, will_close = self._request(
+                    conn, method, path, body, headers, timeout)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+
+        if will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return status, content, response_headers
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+    def _request(self, conn, method, path, body, headers, timeout, sent=None):
+        # Connections are shared by requests of projects with other timeouts
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request(method, path, body, headers or {})
+        if sent is not None:
+            sent.append(True)
+        response = conn.getresponse()
+        return (response.status, response.read(), dict(response.getheaders()),
+                response.will_close)
+
+    def _connect(self):
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def _get(self):
+        now = self._clock()
+        stale = []
+        conn = None
+        with self._lock:
+            self._check_pid()
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in stale:
+            candidate.close()
+        if conn is None:
+            return self._connect(), False
+        return conn, True
+
+    def _put(self, conn):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, self._clock()))
+                return
+        conn.close()
+
+    def _check_pid(self):
+        # Sockets inherited across fork are shared with the parent; drop them
+        # without closing so the parent's connections stay usable.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+
+
+def _never_sent(exc, sent):
+    """
+    Returns True if ``exc`` shows that the server closed the connection
+    before it received the request, so that sending it again can't deliver
+    it twice.
+    """
+    if isinstance(exc, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+        return True
+    # Timeouts, including those of SSL reads, may hit requests the server got
+    return (not sent and not isinstance(exc, socket.timeout)
+            and getattr(exc, 'errno', None) in RESET_ERRNOS)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the current process's pool for MIXPANEL_API_SERVER.
+    """
+    global _pool
+    if mp_settings.MIXPANEL_API_SCHEME == 'http':
+        connection_class = httplib.HTTPConnection
+    else:
+        connection_class = httplib.HTTPSConnection
+    with _pool_lock:
+        if (_pool is None or _pool._pid != os.getpid()
+                or _pool.host != mp_settings.MIXPANEL_API_SERVER
+                or _pool.connection_class is not connection_class):
+            _pool = ConnectionPool(mp_settings.MIXPANEL_API_SERVER,
+                                   connection_class=connection_class)
+        return _pool
+
+@conf.on_reload
+def _reset():
+    # Pick up new sizes and timeouts
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.clear()
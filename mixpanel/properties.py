@@ -0,0 +1,156 @@
+"""Super properties and per-user enrichment merged into every event
+
+Super properties are sent with every event, like those registered by
+Mixpanel's client libraries. They are set by MIXPANEL_SUPER_PROPERTIES or
+:func:`register`, and merged by the process building the events, which is
+the worker running the tasks. Values may be callables, which are called
+once per process::
+
+    MIXPANEL_SUPER_PROPERTIES = {
+        'app_version': '2.3.1',
+        'host': socket.gethostname,
+    }
+
+MIXPANEL_PROPERTY_ENRICHER names a function returning properties for a
+``distinct_id``, e.g. from the user's account, whose results are cached.
+
+With MIXPANEL_STAMP_EVENTS, events are also stamped with their time and a
+unique ``$insert_id`` by :func:`stamp`.
+"""
+from __future__ import absolute_import
+
+import binascii
+import itertools
+import os
+import threading
+import time
+
+from celery.utils.imports import symbol_by_name
+from celery.utils.log import get_logger
+
+from .cache import LRUCache
+from .conf import settings as mp_settings
+
+log = get_logger(__name__)
+
+#: Properties set by :func:`stamp`
+STAMPS = ('time', '$insert_id')
+
+_registered = {}
+_lock = threading.Lock()
+_resolved = None
+_resolved_from = None
+
+
+def register(**properties):
+    """
+    Adds super properties to the process's events.
+    """
+    global _resolved
+    with _lock:
+        _registered.update(properties)
+        _resolved = None
+
+def unregister(*names):
+    """
+    Removes super properties added by :func:`register`.
+    """
+    global _resolved
+    with _lock:
+        for name in names:
+            _registered.pop(name, None)
+        _resolved = None
+
+def super_properties():
+    """
+    Returns the super properties, with callable values replaced by their
+    result. The result is computed once and must not be modified.
+    """
+    global _resolved, _resolved_from
+    configured = mp_settings.MIXPANEL_SUPER_PROPERTIES
+    resolved = _resolved
+    if resolved is not None and _resolved_from is configured:
+        return resolved
+    with _lock:
+        if _resolved is None or _resolved_from is not configured:
+            properties = dict(configured)
+            properties.update(_registered)
+            for name, value in properties.iteritems():
+                if callable(value):
+                    properties[name] = value()
+            _resolved, _resolved_from = properties, configured
+        return _resolved
+
+def enrichment(distinct_id):
+    """
+    Returns the properties MIXPANEL_PROPERTY_ENRICHER adds to the events of
+    ``distinct_id``, which must not be modified. Results are kept for
+    MIXPANEL_ENRICHMENT_TTL seconds. Errors of the enricher are logged and
+    don't stop the event from being sent.
+    """
+    enricher = mp_settings.MIXPANEL_PROPERTY_ENRICHER
+    if not enricher or distinct_id is None:
+        return {}
+    cache = get_enrichment_cache()
+    properties = cache.get(distinct_id)
+    if properties is None:
+        try:
+            properties = symbol_by_name(enricher)(distinct_id) or {}
+        except Exception as e:
+            log.warning("Enriching %r failed: %r", distinct_id, e)
+            return {}
+        cache.set(distinct_id, properties)
+    return properties
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_enrichment_cache():
+    """
+    Returns the worker process's cache of enrichment results.
+    """
+    global _cache
+    size = mp_settings.MIXPANEL_ENRICHMENT_CACHE_SIZE
+    ttl = mp_settings.MIXPANEL_ENRICHMENT_TTL
+    cache = _cache
+    if cache is not None and cache.max_size == size and cache.ttl == ttl:
+        return cache
+    with _cache_lock:
+        if _cache is None or _cache.max_size != size or _cache.ttl != ttl:
+            _cache = LRUCache(size, ttl)
+        return _cache
+
+
+def stamp(props):
+    """
+    Adds a ``time`` in milliseconds and an ``$insert_id`` to ``props`` if
+    MIXPANEL_STAMP_EVENTS is set and it lacks them. Returns ``props``.
+    """
+    if mp_settings.MIXPANEL_STAMP_EVENTS:
+        if 'time' not in props:
+            props['time'] = int(time.time() * 1000)
+        if '$insert_id' not in props:
+            generator = mp_settings.MIXPANEL_INSERT_ID_GENERATOR
+            props['$insert_id'] = symbol_by_name(generator)() if generator else insert_id()
+    return props
+
+_ids = None
+_ids_lock = threading.Lock()
+
+def insert_id():
+    """
+    Returns a new ``$insert_id``: a random prefix drawn once per process,
+    followed by the hex count of the ids the process returned before. This
+    takes a fraction of the time of a UUID, and stays unique across forks
+    since the prefix is drawn again in the child.
+    """
+    global _ids
+    pid = os.getpid()
+    ids = _ids
+    if ids is None or ids[0] != pid:
+        with _ids_lock:
+            if _ids is None or _ids[0] != pid:
+                _ids = (pid, binascii.hexlify(os.urandom(10)), itertools.count())
+            ids = _ids
+    return '%s%x' % (ids[1], next(ids[2]))
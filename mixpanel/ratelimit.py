@@ -0,0 +1,116 @@
+"""Client-side rate limiting of requests to the Mixpanel api"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .conf import settings as mp_settings
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket allowing ``rate`` events per second on
+    average, with bursts of up to ``capacity`` events.
+
+    :meth:`acquire` never fails: when there aren't enough tokens it reserves
+    them anyway and sleeps until they would have been refilled. Callers are
+    thereby queued in the order they arrived, and sustained throughput stays
+    at ``rate``.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def acquire(self, n=1):
+        """
+        Takes ``n`` tokens, sleeping until they are available.
+        Returns the number of seconds slept.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Holds one :class:`TokenBucket` per limited endpoint and per limited api
+    token, created from MIXPANEL_RATE_LIMITS and MIXPANEL_TOKEN_RATE_LIMITS.
+    """
+
+    def __init__(self, endpoint_limits=None, token_limits=None):
+        if endpoint_limits is None:
+            endpoint_limits = mp_settings.MIXPANEL_RATE_LIMITS
+        if token_limits is None:
+            token_limits = mp_settings.MIXPANEL_TOKEN_RATE_LIMITS
+        self.endpoint_limits = endpoint_limits
+        self.token_limits = token_limits
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def throttle(self, params, endpoint):
+        """
+        Waits until the events in ``params`` (one request, which may hold a
+        list of events) may be sent to ``endpoint``.
+        Returns the number of seconds waited.
+        """
+        items = params if isinstance(params, list) else [params]
+        waited = 0
+        if endpoint in self.endpoint_limits:
+            waited += self._bucket('endpoint', self.endpoint_limits, endpoint).acquire(len(items))
+        if self.token_limits:
+            counts = {}
+            for item in items:
+                token = _token(item)
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.iteritems():
+                if token in self.token_limits:
+                    waited += self._bucket('token', self.token_limits, token).acquire(count)
+        return waited
+
+    def _bucket(self, kind, limits, key):
+        try:
+            return self._buckets[kind, key]
+        except KeyError:
+            pass
+        with self._lock:
+            if (kind, key) not in self._buckets:
+                rate, burst = limits[key]
+                self._buckets[kind, key] = TokenBucket(rate, burst)
+            return self._buckets[kind, key]
+
+
+def _token(params):
+    if '$token' in params:
+        return params['$token']
+    return (params.get('properties') or {}).get('token')
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """
+    Returns the worker process's rate limiter, or None if no limits are set.
+    """
+    global _limiter
+    if not (mp_settings.MIXPANEL_RATE_LIMITS or mp_settings.MIXPANEL_TOKEN_RATE_LIMITS):
+        return None
+    with _limiter_lock:
+        if (_limiter is None
+                or _limiter.endpoint_limits is not mp_settings.MIXPANEL_RATE_LIMITS
+                or _limiter.token_limits is not mp_settings.MIXPANEL_TOKEN_RATE_LIMITS):
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,60 @@
+"""Per-token settings and queue routing for workers serving several projects"""
+from __future__ import absolute_import
+
+from .conf import settings as mp_settings
+
+# Position of the ``token`` argument of each task
+TOKEN_ARGS = {
+    'mixpanel.tasks.event_tracker': 2,
+    'mixpanel.tasks.people_tracker': 4,
+    'mixpanel.tasks.funnel_event_tracker': 4,
+    'mixpanel.tasks.event_batch_tracker': 1,
+    'mixpanel.tasks.people_batch_tracker': 1,
+    'mixpanel.tasks.event_fanout_tracker': 3,
+}
+
+
+def token_setting(token, name, default=None):
+    """
+    Returns the ``name`` setting of ``token`` from MIXPANEL_TOKEN_SETTINGS,
+    or ``default`` if it has none. ``token`` defaults to MIXPANEL_API_TOKEN.
+    """
+    settings = mp_settings.MIXPANEL_TOKEN_SETTINGS
+    if not settings:
+        return default
+    return settings.get(token or mp_settings.MIXPANEL_API_TOKEN, {}).get(name, default)
+
+def params_token(params):
+    """
+    Returns the api token of a request's ``params``, which may be a list of
+    events or updates of a single project.
+    """
+    if isinstance(params, list):
+        params = params[0] if params else {}
+    if '$token' in params:
+        return params['$token']
+    return (params.get('properties') or {}).get('token')
+
+
+class TokenRouter(object):
+    """
+    A Celery router sending the tracking tasks of each token to the
+    ``queue`` in its MIXPANEL_TOKEN_SETTINGS, so a busy project doesn't hold
+    up the others. Enable it with::
+
+        CELERY_ROUTES = ('mixpanel.routing.TokenRouter',)
+
+    Tasks of tokens without a queue are left to the other routes.
+    """
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        if task not in TOKEN_ARGS:
+            return None
+        token = (kwargs or {}).get('token')
+        position = TOKEN_ARGS[task]
+        if token is None and args and len(args) > position:
+            token = args[position]
+        queue = token_setting(token, 'queue')
+        if queue:
+            return {'queue': queue}
+        return None
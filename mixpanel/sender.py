@@ -0,0 +1,87 @@
+"""Concurrent delivery of many tracking requests from a single process"""
+from __future__ import absolute_import
+
+import threading
+from Queue import Queue, Empty
+
+from . import conf
+from .conf import settings as mp_settings
+from . import tasks
+
+
+class ConcurrentSender(object):
+    """
+    Sends tracking requests using up to ``concurrency`` threads at once.
+    ``post`` and ``query`` are passed on to each request.
+
+    Each request is bounded by MIXPANEL_API_TIMEOUT, like requests sent by
+    the tasks. The threads only live for the duration of a :meth:`send_many`
+    call, so a sender is safe to share and to use across forks. Under gevent
+    or eventlet worker pools, where threading is monkey-patched, the requests
+    run as cooperative greenlets instead.
+    """
+
+    def __init__(self, concurrency=None, post=None, query=None):
+        conf.load()
+        self.concurrency = concurrency or mp_settings.MIXPANEL_SENDER_CONCURRENCY
+        self.post = post
+        self.query = query
+
+    def send(self, params, endpoint=None, data=None):
+        """
+        Sends a single request, whose ``params`` may already be serialized
+        as ``data``.
+        Returns True if mixpanel accepted it.
+        """
+        endpoint = endpoint or mp_settings.MIXPANEL_TRACKING_ENDPOINT
+        return tasks._send_request(params, endpoint, post=self.post, query=self.query,
+                                   data=data)
+
+    def send_many(self, requests):
+        """
+        Sends ``(params, endpoint)`` requests concurrently and waits for them.
+        Requests may also be ``(params, endpoint, data)`` triples.
+        Returns a list with, for each request, the result of
+        :meth:`send`, or the :class:`~mixpanel.tasks.FailedEventRequest` or
+        :class:`~mixpanel.tasks.RejectedRequest` raised if it couldn't be sent.
+        """
+        requests = list(requests)
+        results = [None] * len(requests)
+        if self.concurrency <= 1 or len(requests) <= 1:
+            for i, request in enumerate(requests):
+                results[i] = self._send(request)
+        else:
+            self._send_threaded(requests, results)
+
+        for result in results:
+            if (isinstance(result, Exception) and not isinstance(
+                    result, (tasks.FailedEventRequest, tasks.RejectedRequest))):
+                raise result
+        return results
+
+    def _send_threaded(self, requests, results):
+        queue = Queue()
+        for item in enumerate(requests):
+            queue.put(item)
+
+        def work():
+            while True:
+                try:
+                    i, request = queue.get_nowait()
+                except Empty:
+                    return
+                results[i] = self._send(request)
+
+        threads = [threading.Thread(target=work)
+                   for _ in xrange(min(self.concurrency, len(requests)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _send(self, request):
+        try:
+            return self.send(*request)
+        except Exception as e:
+            return e
@@ -0,0 +1,103 @@
+"""JSON serializers used to encode tracking data"""
+from __future__ import absolute_import
+
+import datetime
+import decimal
+import json
+import uuid
+
+import simplejson
+
+from .conf import settings as mp_settings
+
+
+class UnknownSerializer(Exception):
+    """MIXPANEL_SERIALIZER names a serializer that isn't available"""
+
+
+def default(obj):
+    """
+    Converts values that JSON can't represent into ones Mixpanel understands.
+    """
+    if isinstance(obj, datetime.datetime):
+        offset = obj.utcoffset()
+        if offset is not None:
+            # Mixpanel reads times without an offset as UTC
+            obj = obj.replace(tzinfo=None) - offset
+        return obj.strftime('%Y-%m-%dT%H:%M:%S')
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+def _convert(obj):
+    """
+    Returns ``obj`` with any values :func:`default` handles converted, for
+    serializers that don't support a ``default`` hook.
+    """
+    if isinstance(obj, dict):
+        return dict((k, _convert(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_convert(v) for v in obj]
+    if isinstance(obj, (basestring, int, long, float, bool)) or obj is None:
+        return obj
+    return default(obj)
+
+
+def _simplejson():
+    encoder = simplejson.JSONEncoder(separators=(',', ':'), default=default)
+    return encoder.encode
+
+def _json():
+    # Only the C-accelerated encoder is used when no indent is given
+    encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+    return encoder.encode
+
+def _ujson():
+    import ujson
+    return lambda obj: ujson.dumps(_convert(obj))
+
+def _orjson():
+    import orjson
+    # Datetimes are left to default, which converts them like for the others
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    return lambda obj: orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+SERIALIZERS = {
+    'simplejson': _simplejson,
+    'json': _json,
+    'ujson': _ujson,
+    'orjson': _orjson,
+}
+
+_cache = {}
+
+def get_serializer(name=None):
+    """
+    Returns the ``dumps`` function of the serializer called ``name``, which
+    defaults to MIXPANEL_SERIALIZER.
+    """
+    name = name or mp_settings.MIXPANEL_SERIALIZER
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+    try:
+        factory = SERIALIZERS[name]
+    except KeyError:
+        raise UnknownSerializer("Unknown serializer: %r" % name)
+    try:
+        dumps = factory()
+    except ImportError as e:
+        raise UnknownSerializer("Serializer %r is not installed: %s" % (name, e))
+    _cache[name] = dumps
+    return dumps
+
+def dumps(obj):
+    """
+    Returns ``obj`` encoded as JSON by the configured serializer.
+    """
+    return get_serializer()(obj)
@@ -0,0 +1,224 @@
+"""Durable on-disk spool for requests that couldn't be delivered"""
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import mmap
+import os
+import threading
+import time
+
+import simplejson
+
+from .conf import settings as mp_settings
+from . import serializers
+
+
+class SpoolFull(Exception):
+    """The spool has reached MIXPANEL_SPOOL_MAX_BYTES"""
+
+
+class Spool(object):
+    """
+    An append-only spool of ``(params, endpoint)`` requests in ``directory``.
+
+    Each process appends JSON lines to its own segment file, named so that
+    segments sort in the order they were started. Once a segment reaches
+    ``segment_bytes`` it is sealed and a new one is started. :meth:`replay`
+    reads segments through ``mmap``, remembers how far it got in a small
+    position file next to each segment, and deletes segments once they are
+    fully sent and no longer written to.
+
+    ``max_bytes`` bounds the disk space the spool uses. It is enforced per
+    process, counting what was on disk when the process last started a
+    segment or found the spool full, so several writers may briefly exceed
+    it together.
+    """
+
+    def __init__(self, directory, segment_bytes=None, max_bytes=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes or mp_settings.MIXPANEL_SPOOL_SEGMENT_BYTES
+        self.max_bytes = max_bytes or mp_settings.MIXPANEL_SPOOL_MAX_BYTES
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._size = self._disk_usage()
+
+    def append(self, params, endpoint):
+        """
+        Writes a request to the spool.
+        Raises :class:`SpoolFull` if there is no room left for it.
+        """
+        line = serializers.dumps({'endpoint': endpoint, 'params': params}) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                # Never share a segment with the process we were forked from
+                self._file, self._pid = None, os.getpid()
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._rotate()
+            if self._size + len(line) > self.max_bytes:
+                # Other processes may have replayed and removed segments
+                self._size = self._disk_usage()
+                if self._size + len(line) > self.max_bytes:
+                    raise SpoolFull("Spool %s is full" % self.directory)
+            self._file.write(line)
+            self._file.flush()
+            self._size += len(line)
+
+    def replay(self, send, batch_size=None, limit=None):
+        """
+        Passes spooled requests to ``send`` in order, as lists of up to
+        ``batch_size`` ``(params, endpoint)`` pairs that share an endpoint.
+        Stops early once ``limit`` requests were sent, or when ``send``
+        raises, in which case that batch is kept for the next replay.
+        Returns the number of requests sent.
+
+        Only one replay runs at a time per spool directory; others return 0.
+        """
+        batch_size = batch_size or mp_settings.MIXPANEL_BATCH_SIZE
+        lock = open(os.path.join(self.directory, 'replay.lock'), 'w')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return 0
+            sent = 0
+            for name in self._segments():
+                if limit is not None and sent >= limit:
+                    break
+                sent += self._replay_segment(name, send, batch_size,
+                                             None if limit is None else limit - sent)
+            return sent
+        finally:
+            lock.close()
+
+    def _replay_segment(self, name, send, batch_size, limit):
+        path = os.path.join(self.directory, name)
+        pos_path = self._pos_path(name)
+        pos = self._read_pos(pos_path)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            # Sealed by its writer since we listed it; picked up next time
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+        sent = 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if pos < size:
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    for batch, end in self._batches(data, pos, batch_size, limit):
+                        send(batch)
+                        sent += len(batch)
+                        pos = end
+                        self._write_pos(pos_path, pos)
+                finally:
+                    data.close()
+        if pos >= size and not self._is_active(name):
+            self._remove(path, pos_path, size)
+        return sent
+
+    def _batches(self, data, pos, batch_size, limit):
+        """
+        Yields ``(batch, end)`` pairs, ``end`` being the offset just past the
+        batch. A trailing line that is still being written is left alone.
+        """
+        batch, endpoint, count = [], None, 0
+        while limit is None or count < limit:
+            newline = data.find('\n', pos)
+            if newline < 0:
+                break
+            record = simplejson.loads(data[pos:newline])
+            if batch and (record['endpoint'] != endpoint or len(batch) >= batch_size):
+                yield batch, pos
+                batch = []
+            batch.append((record['params'], record['endpoint']))
+            endpoint = record['endpoint']
+            pos = newline + 1
+            count += 1
+        if batch:
+            yield batch, pos
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            path = self._file.name
+            os.rename(path, path[:-len('.log')] + '.seg')
+        name = '%016x.%d.log' % (int(time.time() * 1e6), os.getpid())
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._size = self._disk_usage()
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(('.log', '.seg')))
+
+    def _is_active(self, name):
+        """
+        Returns True if the segment may still be appended to.
+        """
+        if name.endswith('.seg'):
+            return False
+        pid = int(name.split('.')[1])
+        if pid == os.getpid():
+            return self._file is not None and self._file.name.endswith(name)
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def _remove(self, path, pos_path, size):
+        for p in (path, pos_path):
+            try:
+                os.remove(p)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        with self._lock:
+            self._size = max(0, self._size - size)
+
+    def _pos_path(self, name):
+        # Shared by a segment's .log and .seg names, so sealing keeps it
+        return os.path.join(self.directory, name.rsplit('.', 1)[0] + '.pos')
+
+    def _read_pos(self, pos_path):
+        try:
+            with open(pos_path) as f:
+                return int(f.read() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_pos(self, pos_path, pos):
+        tmp = '%s.%d' % (pos_path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(str(pos))
+        os.rename(tmp, pos_path)
+
+    def _disk_usage(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in self._segments())
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+def get_spool():
+    """
+    Returns the spool in MIXPANEL_SPOOL_DIR, or None if it isn't set.
+    """
+    global _spool
+    directory = mp_settings.MIXPANEL_SPOOL_DIR
+    if not directory:
+        return None
+    with _spool_lock:
+        if _spool is None or _spool.directory != directory:
+            _spool = Spool(directory)
+        return _spool
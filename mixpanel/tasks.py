@@ -1,20 +1,89 @@
 from __future__ import absolute_import
 
-import urllib
-import urllib2
 import base64
 import copy
+import hashlib
+import inspect
+import random
+import time
+from cStringIO import StringIO
 
-from celery.task import task
+import simplejson
+
+from celery.exceptions import Ignore, Retry
+from celery.signals import task_prerun
+from celery.task import Task, task
 from celery.utils.log import get_task_logger
 log = get_task_logger(__name__)
 
-import simplejson
-
+from . import conf
 from .conf import settings as mp_settings
+from .events import Event, as_dict
+from .properties import STAMPS, enrichment, stamp, super_properties
+from . import circuit
+from . import filters
+from . import metrics
+from . import ratelimit
+from . import routing
+from . import serializers
+from . import spool
+
 
-@task(max_retries=mp_settings.MIXPANEL_MAX_RETRIES)
-def people_tracker(distinct_id, set=None, add=None, extra=None, token=None):
+class _Setting(object):
+    """
+    An attribute reading the setting ``name`` whenever it is accessed. Unlike
+    a property, it also works on the class, where Celery 3 reads some
+    attributes of its compatible tasks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        return getattr(mp_settings, self.name)
+
+class MixpanelTask(Task):
+    """
+    Base of the tasks, which reads MIXPANEL_MAX_RETRIES when retrying rather
+    than at import.
+
+    Tasks sending an event set ``properties_arg`` to the position of their
+    ``properties`` argument, which then gets its ``time`` and
+    ``$insert_id`` when the task is enqueued, if MIXPANEL_STAMP_EVENTS is
+    set, rather than when a worker gets to it.
+
+    Tasks sending events or people updates set ``count_enqueued``, and add
+    those they are enqueued with to ``mixpanel_events_enqueued_total``: one,
+    or as many as the list argument named ``events_arg`` holds.
+    """
+    abstract = True
+    max_retries = _Setting('MIXPANEL_MAX_RETRIES')
+    properties_arg = None
+    count_enqueued = False
+    events_arg = None
+
+    # A classmethod, like the methods of Celery 3's compatible tasks
+    @classmethod
+    def apply_async(cls, args=None, kwargs=None, *rest, **options):
+        if cls.properties_arg is not None:
+            args, kwargs = _stamp_args(args, kwargs, cls.properties_arg)
+        # Retried and parked tasks are published again with their retries
+        if cls.count_enqueued and 'retries' not in options:
+            metrics.get_metrics().incr('mixpanel_events_enqueued_total',
+                                       _enqueued_count(cls, args, kwargs))
+        return super(MixpanelTask, cls).apply_async(args, kwargs, *rest, **options)
+
+@task_prerun.connect
+def _load_settings(sender=None, **kwargs):
+    # Overriding Task.__call__ instead would make Celery 3 push a new request
+    # on top of the worker's, hiding the retries from _retry
+    if isinstance(sender, MixpanelTask):
+        conf.load()
+
+@task(base=MixpanelTask, count_enqueued=True)
+def people_tracker(distinct_id, set=None, add=None, extra=None, token=None,
+                   set_once=None, append=None, union=None, remove=None,
+                   unset=None, delete=False):
     """
     Sends people analytics to mixpanel through the API.
     Returns True if mixpanel accepted the request.
@@ -24,20 +93,38 @@ def people_tracker(distinct_id, set=None, add=None, extra=None, token=None):
     ``add`` is a dict of people values to increment.
     ``extra`` is top-level params to add to the generated dict.
     ``token`` overrides MIXPANEL_API_TOKEN (optional).
+    ``set_once`` is a dict of people values to set unless already set.
+    ``append`` is a dict of values to append to list properties.
+    ``union`` is a dict of lists of values to merge into list properties.
+    ``remove`` is a dict of values to remove from list properties.
+    ``unset`` is a list of people properties to remove.
+    ``delete`` deletes the profile if True.
+
+    Mixpanel takes a single operation per update, so when several are given
+    they are sent as a batch of updates in one request, in the order of
+    PEOPLE_OPERATIONS.
     """
-    log.info("Recording person: %r" % distinct_id)
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording person: %r", distinct_id)
 
-    params = _build_people_params(distinct_id, set, add, token)
-    params.update(extra or {})
+    operations = _people_operations(set=set, add=add, set_once=set_once,
+                                    append=append, union=union, remove=remove,
+                                    unset=unset, delete=delete)
+    updates = _build_people_params(distinct_id, operations, token)
+    for update in updates:
+        update.update(extra or {})
+    params = updates[0] if len(updates) == 1 else updates
 
     try:
         result = _send_request(params, mp_settings.MIXPANEL_PEOPLE_TRACKING_ENDPOINT)
     except FailedEventRequest as e:
         log.info("Event failed. Retrying: user <%s>" % distinct_id)
-        raise people_tracker.retry(exc=e, countdown=mp_settings.MIXPANEL_RETRY_DELAY)
+        raise _retry(people_tracker, e,
+                     requests=[(update, mp_settings.MIXPANEL_PEOPLE_TRACKING_ENDPOINT)
+                               for update in updates])
     return result
 
-@task(max_retries=mp_settings.MIXPANEL_MAX_RETRIES)
+@task(base=MixpanelTask, properties_arg=1, count_enqueued=True)
 def event_tracker(event_name, properties=None, token=None):
     """
     Tracks an event occurrence to mixpanel through the API.
@@ -46,20 +133,28 @@ def event_tracker(event_name, properties=None, token=None):
     ``event_name`` is the event name to record.
     ``properties`` is a dict of key/value pairs (optional).
     ``token`` overrides MIXPANEL_API_TOKEN (optional).
+
+    Events that :func:`~mixpanel.filters.keep_event` drops, because they are
+    sampled out or duplicates, aren't sent and count as accepted.
     """
-    log.info("Recording event: <%s>" % event_name)
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording event: <%s>", event_name)
 
     props = _build_props(properties, token)
     params = {'event': event_name, 'properties': props}
+    if filters.enabled() and not filters.keep_event(params):
+        return True
 
     try:
         result = _send_request(params)
     except FailedEventRequest as e:
         log.info("Event failed. Retrying: %r" % event_name)
-        raise event_tracker.retry(exc=e, countdown=mp_settings.MIXPANEL_RETRY_DELAY)
+        args, kwargs = _stamped_args(event_tracker, properties, props, 'properties', 1)
+        raise _retry(event_tracker, e, args, kwargs,
+                     requests=[(params, mp_settings.MIXPANEL_TRACKING_ENDPOINT)])
     return result
 
-@task(max_retries=mp_settings.MIXPANEL_MAX_RETRIES)
+@task(base=MixpanelTask, properties_arg=3, count_enqueued=True)
 def funnel_event_tracker(funnel, step, goal, properties, token=None):
     """
     Tracks an event occurrence to mixpanel through the API.
@@ -71,7 +166,8 @@ def funnel_event_tracker(funnel, step, goal, properties, token=None):
     ``properties`` is a dict of key/value pairs which must contain ``distinct_id``.
     ``token`` overrides MIXPANEL_API_TOKEN (optional).
     """
-    log.info("Recording funnel: %r, step: %r" % (funnel, step))
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording funnel: %r, step: %r", funnel, step)
 
     props = _build_props(properties, token)
     props = _add_funnel_props(props, funnel, step, goal)
@@ -81,11 +177,196 @@ def funnel_event_tracker(funnel, step, goal, properties, token=None):
         result = _send_request(params)
     except FailedEventRequest as e:
         log.info("Funnel failed. Retrying: %r, step: %r" % (funnel, step))
-        raise funnel_event_tracker.retry(exc=e, countdown=mp_settings.MIXPANEL_RETRY_DELAY)
+        args, kwargs = _stamped_args(funnel_event_tracker, properties, props, 'properties', 3)
+        raise _retry(funnel_event_tracker, e, args, kwargs,
+                     requests=[(params, mp_settings.MIXPANEL_TRACKING_ENDPOINT)])
     return result
 
+@task(base=MixpanelTask, count_enqueued=True, events_arg='events')
+def event_batch_tracker(events, token=None):
+    """
+    Tracks several event occurrences to mixpanel through the API, sending up
+    to MIXPANEL_BATCH_SIZE events (or the token's ``batch_size``) per request.
+    Returns a list holding, for each event, True if mixpanel accepted it.
+
+    ``events`` is a list of ``{'event': ..., 'properties': ...}`` dicts, or
+    of :class:`~mixpanel.events.Event` records when run in-process.
+    ``token`` overrides MIXPANEL_API_TOKEN for events without one (optional).
+
+    The batches are sent concurrently by a :class:`~mixpanel.sender.ConcurrentSender`.
+    If some of them fail, only their events are retried, so the retried
+    task's result covers just those events. Events are filtered like in
+    :func:`event_tracker`.
+    """
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording batch of %d events", len(events))
+    if not filters.enabled():
+        return _track_batch(event_batch_tracker, events, token,
+                            _build_event, mp_settings.MIXPANEL_TRACKING_ENDPOINT)
+
+    events = [_build_event(as_dict(event), token) for event in events]
+    seen = set()
+    keep = [filters.keep_event(event, seen) for event in events]
+    results = iter(_track_batch(event_batch_tracker,
+                                [event for event, kept in zip(events, keep) if kept],
+                                token, _build_event, mp_settings.MIXPANEL_TRACKING_ENDPOINT))
+    return [next(results) if kept else True for kept in keep]
+
+@task(base=MixpanelTask, properties_arg=2, count_enqueued=True,
+      events_arg='distinct_ids')
+def event_fanout_tracker(event_name, distinct_ids, properties=None, token=None):
+    """
+    Tracks the same event for each user in ``distinct_ids``, sending them in
+    concurrent batches like :func:`event_batch_tracker`.
+    Returns a list holding, for each user, True if mixpanel accepted the event.
+
+    ``properties`` are shared by all of the events, each getting its own
+    ``distinct_id``. They are serialized once, and each user's event is
+    made by splicing the ``distinct_id`` into them, rather than by copying
+    and serializing them again. Only users whose event failed are retried.
+    Events are sampled like in :func:`event_tracker`. With
+    MIXPANEL_STAMP_EVENTS, each event gets an ``$insert_id`` of its own,
+    spliced in the same way.
+    """
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording event <%s> for %d users", event_name, len(distinct_ids))
+    endpoint = mp_settings.MIXPANEL_TRACKING_ENDPOINT
+    props = _build_props(properties, token)
+    props.pop('distinct_id', None)
+    # Each user's event gets an $insert_id of its own, derived from the one
+    # of the template so that it is the same when retried
+    base_id = props.pop('$insert_id', None)
+
+    keep = None
+    rate = filters.sample_rate(event_name)
+    if rate < 1:
+        keep = [filters.in_sample(event_name, user, rate) for user in distinct_ids]
+        props[mp_settings.MIXPANEL_SAMPLE_RATE_PROPERTY] = rate
+    users = [user for i, user in enumerate(distinct_ids) if keep is None or keep[i]]
+    if len(users) < len(distinct_ids):
+        metrics.get_metrics().incr('mixpanel_events_sampled_out_total',
+                                   len(distinct_ids) - len(users))
+
+    template = {'event': event_name, 'properties': props}
+    def event(user):
+        user_props = dict(props, distinct_id=user)
+        if base_id is not None:
+            user_props['$insert_id'] = _fanout_insert_id(base_id, user)
+        return {'event': event_name, 'properties': user_props}
+
+    if mp_settings.MIXPANEL_PROPERTY_ENRICHER:
+        # Users get properties of their own, so they can't share an encoding
+        def encode(user):
+            user_props = _build_props(dict(properties or {}, distinct_id=user), token)
+            for name in STAMPS:
+                if name in props:
+                    user_props[name] = props[name]
+            if base_id is not None:
+                user_props['$insert_id'] = _fanout_insert_id(base_id, user)
+            if keep is not None:
+                user_props[mp_settings.MIXPANEL_SAMPLE_RATE_PROPERTY] = rate
+            return _encode({'event': event_name, 'properties': user_props})
+    else:
+        encode = _fanout_encoder(event(_PLACEHOLDER), event, base_id)
+
+    size = routing.token_setting(token, 'batch_size', mp_settings.MIXPANEL_BATCH_SIZE)
+    batches, oversized = _encode_batches(users, size, encode)
+    # The template stands in for the params of each event, which are only
+    # needed for their count and token
+    results, failed, exc = _send_batches(batches, lambda i: template, endpoint, len(users))
+    if failed:
+        log.info("Fan-out failed. Retrying %d users" % len(failed))
+        if base_id is not None:
+            props['$insert_id'] = base_id
+        raise _retry(event_fanout_tracker, exc, args=[event_name, [users[i] for i in failed]],
+                     kwargs={'properties': _keep_stamps(properties, props), 'token': token},
+                     requests=[(event(users[i]), endpoint) for i in failed])
+    if keep is None:
+        return results
+    results = iter(results)
+    return [next(results) if kept else True for kept in keep]
+
+@task(base=MixpanelTask, count_enqueued=True, events_arg='updates')
+def people_batch_tracker(updates, token=None):
+    """
+    Sends several people updates to mixpanel through the API, sending up to
+    MIXPANEL_BATCH_SIZE updates per request.
+    Returns a list holding, for each update, True if mixpanel accepted it.
+
+    ``updates`` is a list of ``/engage/`` update dicts, each holding a
+    ``$distinct_id`` and operations such as ``$set`` or ``$add``. Updates
+    with several operations are split into one update per operation, in the
+    order of PEOPLE_OPERATIONS.
+    ``token`` overrides MIXPANEL_API_TOKEN for updates without one (optional).
+
+    Failed requests are retried like in :func:`event_batch_tracker`.
+    """
+    if mp_settings.MIXPANEL_LOG_EVENTS:
+        log.info("Recording batch of %d people updates", len(updates))
+    updates = [single for update in updates for single in _split_people_update(update)]
+    return _track_batch(people_batch_tracker, updates, token,
+                        _build_people_update, mp_settings.MIXPANEL_PEOPLE_TRACKING_ENDPOINT)
+
+@task(base=MixpanelTask, ignore_result=True)
+def spool_replay(limit=None):
+    """
+    Sends the requests spooled in MIXPANEL_SPOOL_DIR, in batches of up to
+    MIXPANEL_BATCH_SIZE, stopping at the first failure.
+    Returns the number of requests sent.
+
+    ``limit`` caps the number of requests sent by this run; it defaults to
+    MIXPANEL_SPOOL_REPLAY_LIMIT.
+
+    Schedule this task periodically (e.g. with celerybeat) to drain the spool
+    once the api server recovers.
+    """
+    queue = spool.get_spool()
+    if queue is None:
+        return 0
+    breaker = circuit.get_breaker()
+    if breaker and breaker.retry_after() > 0:
+        return 0
+
+    def send(batch):
+        items = [request[0] for request in batch]
+        batches, oversized = _encode_batches(items, len(items))
+        for indexes, data in batches:
+            try:
+                _send_request([items[i] for i in indexes], batch[0][1], post=True,
+                              data=data)
+            except RejectedRequest as e:
+                log.error("Dropping %d spooled requests: %s", len(indexes), e)
+
+    if limit is None:
+        limit = mp_settings.MIXPANEL_SPOOL_REPLAY_LIMIT
+    try:
+        sent = queue.replay(send, mp_settings.MIXPANEL_BATCH_SIZE, limit)
+    except FailedEventRequest as e:
+        log.info("Spool replay stopped: %s" % e)
+        return 0
+    log.info("Replayed %d spooled requests" % sent)
+    return sent
+
+# People operations, in the order they are sent when combined
+PEOPLE_OPERATIONS = ('$set', '$set_once', '$add', '$append', '$union',
+                     '$remove', '$unset', '$delete')
+
 class FailedEventRequest(Exception):
-    """The attempted recording event failed because of a non-200 HTTP return code"""
+    """
+    The attempted recording event failed because of a timeout, a network
+    error, or an HTTP 5xx or 429 response, and may succeed when retried.
+
+    ``status`` is the HTTP status, if there was a response, and
+    ``retry_after`` the number of seconds its ``Retry-After`` header asked
+    to wait before retrying.
+    """
+    def __init__(self, message='', status=None, retry_after=None):
+        super(FailedEventRequest, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class CircuitOpen(FailedEventRequest):
+    """The request wasn't attempted because the circuit breaker is open"""
 
 class InvalidFunnelProperties(Exception):
     """Required properties were missing from the funnel-tracking call"""
@@ -93,47 +374,638 @@ class InvalidFunnelProperties(Exception):
 class InvalidPeopleProperties(Exception):
     """Invalid combination of people properties"""
 
+class RejectedRequest(Exception):
+    """
+    The api refused the request with an HTTP 4xx response other than 429,
+    so retrying it can't succeed. ``status`` is the HTTP status.
+    """
+    def __init__(self, message='', status=None):
+        super(RejectedRequest, self).__init__(message)
+        self.status = status
+
+class PayloadTooLarge(RejectedRequest):
+    """The request exceeds the size limits of the api, so it can never succeed"""
+
+def _retry(task, exc, args=None, kwargs=None, requests=None):
+    """
+    Returns the exception to raise to retry the running ``task`` after ``exc``.
+
+    The delay is the ``Retry-After`` of the response if it had one, and
+    otherwise MIXPANEL_RETRY_DELAY, doubled on every retry when
+    MIXPANEL_RETRY_BACKOFF is set and randomized by MIXPANEL_RETRY_JITTER.
+
+    If the circuit breaker is open, the ``(params, endpoint)`` ``requests``
+    are written to the spool when MIXPANEL_SPOOL_DIR is set. Otherwise, if
+    MIXPANEL_PARKING_QUEUE is set, the task is sent to the parking queue until
+    the circuit lets requests through again, without counting as a retry.
+    Once retries are exhausted, ``requests`` are spooled rather than lost.
+    """
+    if requests:
+        metrics.get_metrics().incr('mixpanel_events_retried_total',
+                                   sum(_count(params) for params, endpoint in requests))
+    request = task.request
+    if not request.called_directly:
+        circuit_open = isinstance(exc, CircuitOpen)
+        exhausted = request.retries >= task.max_retries
+        if requests and (circuit_open or exhausted) and _spool_requests(requests):
+            return Ignore()
+
+        queue = mp_settings.MIXPANEL_PARKING_QUEUE
+        if circuit_open and queue and not request.is_eager:
+            countdown = circuit.get_breaker().retry_after()
+            task.subtask_from_request(request, args, kwargs, queue=queue,
+                                      countdown=countdown,
+                                      retries=request.retries).apply_async()
+            return Retry(exc=exc, when=countdown)
+
+    countdown = getattr(exc, 'retry_after', None)
+    if countdown is None:
+        countdown = _retry_delay(request.retries)
+    return task.retry(args=args, kwargs=kwargs, exc=exc, countdown=countdown)
+
+def _spool_requests(requests):
+    """
+    Writes ``(params, endpoint)`` requests to the spool for a later
+    :func:`spool_replay`. Returns True if they were all spooled.
+    """
+    queue = spool.get_spool()
+    if queue is None:
+        return False
+    try:
+        for params, endpoint in requests:
+            queue.append(params, endpoint)
+    except spool.SpoolFull as e:
+        log.warning("%s, dropping %d requests" % (e, len(requests)))
+        return False
+    log.info("Spooled %d requests" % len(requests))
+    return True
+
+def _retry_delay(retries):
+    """
+    Returns the number of seconds to wait before retry number ``retries + 1``.
+    """
+    delay = mp_settings.MIXPANEL_RETRY_DELAY
+    if mp_settings.MIXPANEL_RETRY_BACKOFF:
+        delay = min(delay * 2 ** retries, mp_settings.MIXPANEL_RETRY_BACKOFF_MAX)
+    if mp_settings.MIXPANEL_RETRY_JITTER:
+        # Keep at least half of the delay, so retries still back off
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+    return delay
+
 def _build_props(props, token):
     """
-    Returns a new props dictionary including token.
+    Returns a new props dictionary including token, the super properties
+    and the enrichment of its ``distinct_id``.
     """
-    props = dict(props or {})
-    props.setdefault('token', token or mp_settings.MIXPANEL_API_TOKEN)
-    return props
+    conf.load()
+    supers = super_properties()
+    enriched = enrichment((props or {}).get('distinct_id'))
+    if not (supers or enriched):
+        props = dict(props or {})
+        props.setdefault('token', token or mp_settings.MIXPANEL_API_TOKEN)
+        return stamp(props)
+
+    # Layer the sources in a single new dict, later ones taking precedence
+    merged = dict(supers)
+    merged.update(enriched)
+    if token:
+        merged['token'] = token
+    if props:
+        merged.update(props)
+    merged.setdefault('token', mp_settings.MIXPANEL_API_TOKEN)
+    return stamp(merged)
+
+def _keep_stamps(properties, props):
+    """
+    Returns ``properties`` with the ``time`` and ``$insert_id`` that
+    :func:`_build_props` stamped into ``props``, so that a retry sends the
+    same. ``properties`` is returned as it is if nothing was stamped.
+    """
+    stamps = [(name, props[name]) for name in STAMPS
+              if name in props and name not in (properties or ())]
+    if not stamps:
+        return properties
+    properties = dict(properties or {})
+    properties.update(stamps)
+    return properties
+
+def _stamp_args(args, kwargs, position):
+    """
+    Returns the args and kwargs of a task being enqueued, its
+    ``properties`` argument at ``position`` stamped by :func:`stamp`.
+    """
+    conf.load()
+    if not mp_settings.MIXPANEL_STAMP_EVENTS:
+        return args, kwargs
+    args, kwargs = list(args or ()), dict(kwargs or {})
+    if len(args) > position:
+        args[position] = stamp(dict(args[position] or {}))
+    else:
+        kwargs['properties'] = stamp(dict(kwargs.get('properties') or {}))
+    return args, kwargs
+
+def _enqueued_count(task, args, kwargs):
+    """
+    Returns the number of events or updates ``task`` is enqueued with.
+    """
+    if task.events_arg is None:
+        return 1
+    position = inspect.getargspec(task.run).args.index(task.events_arg)
+    if args and len(args) > position:
+        return len(args[position])
+    return len((kwargs or {}).get(task.events_arg) or ())
+
+def _stamped_args(task, properties, props, name, position):
+    """
+    Returns the args and kwargs to retry the running ``task`` with, its
+    ``properties`` argument ``name`` at ``position`` keeping the stamps of
+    the built ``props``, or None and None if there are none to keep.
+    """
+    stamped = _keep_stamps(properties, props)
+    if stamped is properties:
+        return None, None
+    request = task.request
+    args, kwargs = list(request.args or ()), dict(request.kwargs or {})
+    if len(args) > position:
+        args[position] = stamped
+    else:
+        kwargs[name] = stamped
+    return args, kwargs
+
+def _track_batch(task, items, token, build, endpoint):
+    """
+    Sends ``items`` built by ``build(item, token)`` to ``endpoint`` in
+    concurrent batches, retrying ``task`` with just the items of the batches
+    that failed. Returns one result per item.
+    """
+    size = routing.token_setting(token, 'batch_size', mp_settings.MIXPANEL_BATCH_SIZE)
+    built = [build(item, token) for item in items]
+    batches, oversized = _encode_batches(built, size)
+    results, failed, exc = _send_batches(batches, built.__getitem__, endpoint, len(items))
+    if failed:
+        log.info("Batch failed. Retrying %d items" % len(failed))
+        raise _retry(task, exc, args=[[_retry_item(items[i], built[i]) for i in failed]],
+                     kwargs={'token': token},
+                     requests=[(as_dict(built[i]), endpoint) for i in failed])
+    return results
+
+def _retry_item(item, built):
+    """
+    Returns ``item`` to retry, keeping the stamps of the event ``built`` from it.
+    """
+    item = as_dict(item)
+    if 'event' not in item:
+        return item
+    properties = item.get('properties')
+    stamped = _keep_stamps(properties, as_dict(built)['properties'])
+    if stamped is properties:
+        return item
+    return dict(item, properties=stamped)
+
+def _send_batches(batches, params, endpoint, count):
+    """
+    Sends the ``(indexes, data)`` batches of :func:`_encode_batches`
+    concurrently, ``params(i)`` returning the params of item ``i``.
+    Returns the results of the ``count`` items, the indexes of the items
+    whose batch failed and may be retried, and the last such failure.
+    """
+    from .sender import ConcurrentSender
+
+    requests = [([params(i) for i in indexes], endpoint, data) for indexes, data in batches]
+    outcomes = ConcurrentSender(post=True).send_many(requests)
+
+    # Items too large to ever be accepted stay False
+    results = [False] * count
+    failed = []
+    exc = None
+    for (indexes, data), outcome in zip(batches, outcomes):
+        if isinstance(outcome, FailedEventRequest):
+            failed.extend(indexes)
+            exc = outcome
+        elif isinstance(outcome, RejectedRequest):
+            log.error("Dropping %d items: %s", len(indexes), outcome)
+        elif isinstance(outcome, list):
+            for i, accepted in zip(indexes, outcome):
+                results[i] = accepted
+        else:
+            for i in indexes:
+                results[i] = outcome
+    return results, failed, exc
+
+def _build_event(event, token):
+    """
+    Returns a new event dictionary whose properties include token.
+    :class:`~mixpanel.events.Event` records stay records unless they get
+    super properties or enrichment.
+    """
+    if isinstance(event, Event):
+        stamped = not mp_settings.MIXPANEL_STAMP_EVENTS or (
+            event.time is not None and '$insert_id' in (event.properties or ()))
+        if stamped and not (super_properties() or mp_settings.MIXPANEL_PROPERTY_ENRICHER):
+            if event.token:
+                return event
+            return event.with_token(token or mp_settings.MIXPANEL_API_TOKEN)
+        event = event.to_dict()
+    return {'event': event['event'],
+            'properties': _build_props(event.get('properties'), token)}
+
+def _build_people_update(update, token):
+    """
+    Returns a new people update dictionary including token.
+    """
+    update = dict(update)
+    update.setdefault('$token', token or mp_settings.MIXPANEL_API_TOKEN)
+    return update
+
+def _encode_batches(items, size, encode=None):
+    """
+    Splits ``items`` into batches of at most ``size`` items that fit in
+    MIXPANEL_MAX_REQUEST_BYTES, encoding each item only once with
+    ``encode``, which defaults to :func:`_encode`.
+    Returns a list of ``(indexes, data)`` pairs, ``data`` being the batch's
+    serialized items, and the indexes of the items too large to send.
+    """
+    encode = encode or _encode
+    size = max(1, min(size, 50))
+    limit = mp_settings.MIXPANEL_MAX_REQUEST_BYTES
+    started = time.time()
+    batches, oversized = [], []
+    indexes, encoded, length = [], [], 2
+    for i, item in enumerate(items):
+        try:
+            data = encode(item)
+        except PayloadTooLarge as e:
+            log.error("Dropping item: %s", e)
+            oversized.append(i)
+            continue
+        if indexes and (len(indexes) >= size or length + len(data) + 1 > limit):
+            batches.append((indexes, '[%s]' % ','.join(encoded)))
+            indexes, encoded, length = [], [], 2
+        indexes.append(i)
+        encoded.append(data)
+        length += len(data) + 1
+    if indexes:
+        batches.append((indexes, '[%s]' % ','.join(encoded)))
+    metrics.get_metrics().observe('mixpanel_serialization_seconds', time.time() - started)
+    return batches, oversized
+
+_PLACEHOLDER = '\x00distinct_id\x00'
+_INSERT_ID_PLACEHOLDER = '\x00$insert_id\x00'
+
+def _fanout_encoder(template, event, base_id=None):
+    """
+    Returns a function encoding the event of the user it is called with,
+    by splicing the encoded ``distinct_id``, and the ``$insert_id`` derived
+    from ``base_id`` if given, into the ``template`` event encoded once,
+    whose ``distinct_id`` is :data:`_PLACEHOLDER`. Falls back to encoding
+    ``event(user)`` when the placeholders can't be found.
+    """
+    fields = [(_PLACEHOLDER, lambda user: user)]
+    if base_id is not None:
+        props = dict(template['properties'])
+        props['$insert_id'] = _INSERT_ID_PLACEHOLDER
+        template = {'event': template['event'], 'properties': props}
+        fields.append((_INSERT_ID_PLACEHOLDER,
+                       lambda user: _fanout_insert_id(base_id, user)))
+    data = _encode(template)
+
+    # Cut the encoded template around each placeholder, in the order they occur
+    found = []
+    for placeholder, value in fields:
+        encoded = serializers.dumps(placeholder)
+        if data.count(encoded) != 1:
+            # The placeholder was cut by truncation, or occurs in another value
+            return lambda user: _encode(event(user))
+        found.append((data.index(encoded), len(encoded), value))
+    found.sort()
+    parts, values, pos = [], [], 0
+    for index, length, value in found:
+        parts.append(data[pos:index])
+        values.append(value)
+        pos = index + length
+    parts.append(data[pos:])
+    limit = mp_settings.MIXPANEL_MAX_EVENT_BYTES
+
+    def encode(user):
+        pieces = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            pieces.append(serializers.dumps(value(user)))
+            pieces.append(part)
+        data = ''.join(pieces)
+        if len(data) > limit:
+            raise PayloadTooLarge("%d bytes exceed the limit of %d bytes per event"
+                                  % (len(data), limit))
+        return data
+    return encode
 
-def _build_people_params(distinct_id, set, add, token):
+def _fanout_insert_id(base_id, user):
     """
-    Returns a new params dictionary appropriate for people tracking.
+    Returns the ``$insert_id`` of ``user``'s event in a fan-out whose
+    template got ``base_id``.
     """
-    if not set and not add:
-        raise InvalidPeopleProperties("People analytics requires either $set or $add")
-    if set and add:
-        raise InvalidPeopleProperties("Mixpanel requires $set or $add, not both")
+    return hashlib.md5(('%s:%s' % (base_id, user)).encode('utf-8')).hexdigest()
 
-    params = {}
-    params['$distinct_id'] = distinct_id
-    params['$token'] = token or mp_settings.MIXPANEL_API_TOKEN
-    if set:
-        params['$set'] = dict(set)
+def _encode(params):
+    """
+    Returns a single event or update serialized.
+    Raises :class:`PayloadTooLarge` if it exceeds MIXPANEL_MAX_EVENT_BYTES,
+    after cutting its strings to MIXPANEL_TRUNCATE_LENGTH if that is set.
+    """
+    if isinstance(params, Event):
+        data = params.encode()
     else:
-        params['$add'] = dict(add)
-    return params
+        data = serializers.dumps(params)
+    limit = mp_settings.MIXPANEL_MAX_EVENT_BYTES
+    length = mp_settings.MIXPANEL_TRUNCATE_LENGTH
+    if len(data) > limit and length:
+        data = serializers.dumps(_truncate(as_dict(params), length))
+    if len(data) > limit:
+        raise PayloadTooLarge("%d bytes exceed the limit of %d bytes per event"
+                              % (len(data), limit))
+    return data
+
+def _truncate(value, length):
+    """
+    Returns a copy of ``value`` with all strings cut to ``length`` characters.
+    """
+    if isinstance(value, basestring):
+        return value[:length]
+    if isinstance(value, dict):
+        return dict((k, _truncate(v, length)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_truncate(v, length) for v in value]
+    return value
 
-def _send_request(params, endpoint=mp_settings.MIXPANEL_TRACKING_ENDPOINT):
+def _people_operations(delete=False, **operations):
+    """
+    Returns a dict mapping people operations to values from the keyword
+    arguments of :func:`people_tracker`, e.g. ``set`` to ``$set``.
+    """
+    operations = dict(('$' + name, value) for name, value in operations.iteritems())
+    operations['$delete'] = '' if delete else None
+    return operations
+
+def _build_people_params(distinct_id, operations, token):
+    """
+    Returns a list of new params dictionaries appropriate for people
+    tracking, one per operation in ``operations``, a dict mapping operations
+    such as ``'$set'`` to their values. Operations whose value is None are
+    skipped.
+    """
+    updates = []
+    for operation in PEOPLE_OPERATIONS:
+        value = operations.get(operation)
+        if value is None:
+            continue
+        params = {}
+        params['$distinct_id'] = distinct_id
+        params['$token'] = token or mp_settings.MIXPANEL_API_TOKEN
+        if operation == '$unset':
+            params[operation] = list(value)
+        elif operation == '$delete':
+            params[operation] = value
+        else:
+            params[operation] = dict(value)
+        updates.append(params)
+
+    unknown = [op for op, value in operations.iteritems()
+               if value is not None and op not in PEOPLE_OPERATIONS]
+    if unknown:
+        raise InvalidPeopleProperties("Unknown people operations: %s" % ', '.join(unknown))
+    if not updates:
+        raise InvalidPeopleProperties("People analytics requires an operation such as $set or $add")
+    return updates
+
+def _split_people_update(update):
+    """
+    Returns a list of single-operation people updates holding the operations
+    of ``update``, each with a copy of its other params.
+    """
+    operations = dict((k, v) for k, v in update.iteritems() if k in PEOPLE_OPERATIONS)
+    if len(operations) == 1:
+        return [update]
+    common = dict((k, v) for k, v in update.iteritems() if k not in PEOPLE_OPERATIONS)
+    updates = []
+    for operation in PEOPLE_OPERATIONS:
+        if operation in operations:
+            single = dict(common)
+            single[operation] = operations[operation]
+            updates.append(single)
+    return updates
+
+def _send_request(params, endpoint=None, post=None, query=None, data=None):
     """
     Sends a an event with its properties to the api server.
     Returns True if the event was logged by Mixpanel else False.
+
+    ``params`` may also be a list of events, which mixpanel records together.
+    ``endpoint`` defaults to MIXPANEL_TRACKING_ENDPOINT.
+    If the response then lists the records that failed, as verbose
+    responses of the import endpoint do, a list with one result per event
+    is returned instead.
+    ``post`` sends the data in the request body instead of the querystring;
+    it defaults to whether MIXPANEL_REQUEST_METHOD is ``'POST'``.
+    ``query`` is a dict of other variables to send along with the data.
+    ``data`` is ``params`` already serialized, e.g. by :func:`_encode_batches`.
+
+    Raises :class:`FailedEventRequest` if the request may succeed when
+    retried, and :class:`RejectedRequest` if it can't, such as when the data
+    exceeds the size limits.
     """
-    data = base64.b64encode(simplejson.dumps(params))
-    querystring = urllib.urlencode({mp_settings.MIXPANEL_DATA_VARIABLE: data})
-    url = 'https://%s%s?%s' % (mp_settings.MIXPANEL_API_SERVER, endpoint, querystring)
+    # The HTTP stack is only imported once something is sent
+    import httplib
+    import socket
+    import urllib
+    import urllib2
+
+    conf.load()
+    endpoint = endpoint or mp_settings.MIXPANEL_TRACKING_ENDPOINT
+    if post is None:
+        post = mp_settings.MIXPANEL_REQUEST_METHOD.upper() == 'POST'
+    query = dict(query or {})
+    if mp_settings.MIXPANEL_VERBOSE:
+        query['verbose'] = 1
+    stats = metrics.get_metrics()
+
+    if data is None:
+        started = time.time()
+        if isinstance(params, list):
+            data = serializers.dumps(params)
+        else:
+            data = _encode(params)
+        stats.observe('mixpanel_serialization_seconds', time.time() - started)
+    if len(data) > mp_settings.MIXPANEL_MAX_REQUEST_BYTES:
+        raise PayloadTooLarge("%d bytes exceed the limit of %d bytes per request"
+                              % (len(data), mp_settings.MIXPANEL_MAX_REQUEST_BYTES))
+    if not post:
+        # Form bodies have no length limit, so only querystrings get the
+        # base64 inflation
+        data = base64.b64encode(data)
+    query[mp_settings.MIXPANEL_DATA_VARIABLE] = data
+
+    if post:
+        body = urllib.urlencode(query)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if mp_settings.MIXPANEL_GZIP_REQUESTS:
+            body = _gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        path = endpoint
+    else:
+        querystring = urllib.urlencode(query)
+        path, body, headers = '%s?%s' % (endpoint, querystring), None, {}
+    size = len(path) + len(body or '')
+    log.debug("Sending %d bytes to %s", size, endpoint)
+    timeout = routing.token_setting(routing.params_token(params), 'timeout',
+                                    mp_settings.MIXPANEL_API_TIMEOUT)
+
+    limiter = ratelimit.get_limiter()
+    if limiter:
+        limiter.throttle(params, endpoint)
+
+    breaker = circuit.get_breaker()
+    if breaker and not breaker.allow():
+        raise CircuitOpen("Tracking request skipped: circuit breaker is open")
+    count = _count(params)
+    stats.observe('mixpanel_batch_size', count)
+    stats.incr('mixpanel_request_bytes_total', size)
+    started = time.time()
     try:
-        response = urllib2.urlopen(url, None, mp_settings.MIXPANEL_API_TIMEOUT)
-    except urllib2.URLError as e:
+        content = _open(path, body, headers, timeout)
+    except urllib2.HTTPError as e:
+        exc = _http_error(e.code, e.read(), e.headers.getheader('Retry-After'))
+        _record_failure(breaker, stats, count, started, exc)
+        raise exc
+    except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+        _record_failure(breaker, stats, count, started)
         raise FailedEventRequest("Tracking request failed: %s" % e)
+    except (FailedEventRequest, RejectedRequest) as e:
+        _record_failure(breaker, stats, count, started, e)
+        raise
+    stats.observe('mixpanel_request_seconds', time.time() - started)
+    stats.incr('mixpanel_events_sent_total', count)
+    if breaker:
+        breaker.record_success()
+
+    result = _parse_response(content, params)
+    if result is True:
+        filters.mark_sent(params)
+    elif isinstance(result, list):
+        filters.mark_sent([p for p, accepted in zip(params, result) if accepted])
+    return result
+
+def _record_failure(breaker, stats, count, started, exc=None):
+    stats.observe('mixpanel_request_seconds', time.time() - started)
+    stats.incr('mixpanel_events_failed_total', count)
+    if breaker:
+        # The server is up if it could tell what was wrong with the request
+        if isinstance(exc, RejectedRequest):
+            breaker.record_success()
+        else:
+            breaker.record_failure()
 
+def _http_error(status, content, retry_after=None):
+    """
+    Returns the exception for an HTTP error response: a retryable
+    :class:`FailedEventRequest` for 5xx and 429 statuses, otherwise a
+    :class:`RejectedRequest`.
+    """
+    message = "Tracking request failed: HTTP %d" % status
+    error = _response_error(content)
+    if error:
+        message += ": %s" % error
+    if status == 429 or status >= 500:
+        return FailedEventRequest(message, status, _parse_retry_after(retry_after))
+    return RejectedRequest(message, status)
+
+def _parse_retry_after(value):
+    """
+    Returns the seconds to wait from a ``Retry-After`` header, which holds
+    either a number of seconds or an HTTP date, or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    # email.utils imports urllib, and with it ssl and socket
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, int(email.utils.mktime_tz(date) - time.time()))
+
+def _response_error(content):
+    """
+    Returns the error message of a verbose JSON response, or the start of
+    any other content.
+    """
+    try:
+        response = simplejson.loads(content)
+    except ValueError:
+        return (content or '')[:200]
+    if isinstance(response, dict):
+        return response.get('error') or response.get('status')
+    return content[:200]
+
+def _parse_response(content, params):
+    """
+    Returns the result of a request from its response ``content``: ``'1'``
+    or ``'0'``, or a JSON object when MIXPANEL_VERBOSE is set.
+    """
     # Successful request gets a single-byte response of "1" from mixpanel
-    return response.read() == '1'
+    if content == '1':
+        return True
+    if content[:1] != '{':
+        return False
+    try:
+        response = simplejson.loads(content)
+    except ValueError:
+        return False
+    failed = response.get('failed_records')
+    if failed and isinstance(params, list):
+        failed = set(record.get('index') for record in failed)
+        log.warning("Mixpanel rejected %d of %d records: %s", len(failed),
+                    len(params), response.get('error') or response.get('status'))
+        return [i not in failed for i in xrange(len(params))]
+    if response.get('status') in (1, 'OK', 'Ok') and not response.get('error'):
+        return True
+    log.warning("Mixpanel rejected the request: %s", response.get('error'))
+    return False
+
+def _count(params):
+    """
+    Returns the number of events or updates in a request's ``params``.
+    """
+    return len(params) if isinstance(params, list) else 1
+
+def _open(path, body=None, headers=None, timeout=None):
+    """
+    Requests ``path`` from the api server with the MIXPANEL_TRANSPORT,
+    POSTing ``body`` if given.
+    Returns the content of the response.
+    """
+    from . import transports
+
+    if timeout is None:
+        timeout = mp_settings.MIXPANEL_API_TIMEOUT
+    method = 'GET' if body is None else 'POST'
+    status, content, response_headers = transports.get_transport().request(
+        method, path, body, headers, timeout)
+    if not 200 <= status < 300:
+        raise _http_error(status, content, response_headers.get('retry-after'))
+    return content
+
+def _gzip(data):
+    """
+    Returns ``data`` compressed in gzip format.
+    """
+    import gzip
+
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
 
 def _add_funnel_props(props, funnel, step, goal):
     """
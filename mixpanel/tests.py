@@ -1,18 +1,53 @@
 from __future__ import absolute_import
 
 import base64
+import datetime
+import decimal
+import email.utils
+import gzip
+import httplib
 import json
+import mimetools
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
 import unittest
 import urllib
 import urllib2
 import urlparse
+import uuid
+from cStringIO import StringIO
 
-from celery.exceptions import RetryTaskError
+from celery.exceptions import Ignore, RetryTaskError
 
 from mock import MagicMock as Mock
 import mock
 
+from . import batch
+from . import buffer
+from . import cache
+from . import conf
+from . import circuit
+from . import events
+from . import filters
+from . import funnels
+from . import importer
+from . import metrics
+from . import pool
+from . import properties
+from . import ratelimit
+from . import routing
+from . import sender
+from . import serializers
+from . import spool
 from . import tasks
+from . import transports
 from .conf import settings as mp_settings
 
 
@@ -106,7 +141,7 @@ class PeopleTrackerTest(TestCase):
         self.assertRaises(tasks.InvalidPeopleProperties,
             tasks.people_tracker, 'foo')
         self.assertRaises(tasks.InvalidPeopleProperties,
-            tasks.people_tracker, 'foo', set={1:2}, add={3:4})
+            tasks._build_people_params, 'foo', {'$bogus': {1: 2}}, None)
         result = tasks.people_tracker('foo', set={1:2})
         self.assertEqual(result, True)
         result = tasks.people_tracker('foo', add={3:4})
@@ -138,6 +173,33 @@ class PeopleTrackerTest(TestCase):
                     },
                 })
 
+    def test_people_operations(self):
+        for kwargs, operation, value in [
+                ({'set_once': {'first_seen': 'today'}}, '$set_once', {'first_seen': 'today'}),
+                ({'append': {'actions': 'login'}}, '$append', {'actions': 'login'}),
+                ({'union': {'tags': ['a', 'b']}}, '$union', {'tags': ['a', 'b']}),
+                ({'remove': {'tags': 'a'}}, '$remove', {'tags': 'a'}),
+                ({'unset': ['plan']}, '$unset', ['plan']),
+                ({'delete': True}, '$delete', ''),
+                ]:
+            data = {'$distinct_id': 'foo', '$token': 'testmixpanel', operation: value}
+            self._test_people('foo', data=data, **kwargs)
+
+    def test_people_multiple(self):
+        self._test_people('foo',
+            set={'name': 'Aron'},
+            add={'visits': 1},
+            unset=['plan'],
+            extra={'$ignore_time': True},
+            data=[
+                {'$distinct_id': 'foo', '$token': 'testmixpanel',
+                 '$ignore_time': True, '$set': {'name': 'Aron'}},
+                {'$distinct_id': 'foo', '$token': 'testmixpanel',
+                 '$ignore_time': True, '$add': {'visits': 1}},
+                {'$distinct_id': 'foo', '$token': 'testmixpanel',
+                 '$ignore_time': True, '$unset': ['plan']},
+                ])
+
     def test_people_token(self):
         self._test_people('c9533b5b-d69e-479a-ae5f-42dd7a9752a0',
             token="footoken",
@@ -214,6 +276,28 @@ class FunnelTrackerTest(TestCase):
             )
 
 
+class PayloadSizeTest(TestCase):
+    def setUp(self):
+        super(PayloadSizeTest, self).setUp()
+        mp_settings.MIXPANEL_MAX_EVENT_BYTES = 500
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_MAX_EVENT_BYTES', 1024 * 1024)
+
+    def test_rejected(self):
+        with mock.patch.object(tasks.event_tracker, 'retry') as retry:
+            self.assertRaises(tasks.PayloadTooLarge, tasks.event_tracker,
+                              'big', {'text': 'x' * 600})
+        self.assertFalse(retry.called)
+        self.assertFalse(self.mock_urlopen.called)
+
+    def test_truncated(self):
+        mp_settings.MIXPANEL_TRUNCATE_LENGTH = 255
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_TRUNCATE_LENGTH', 0)
+        self._test_any(tasks.event_tracker, 'big', {'text': 'x' * 600, 'n': 1}, data={
+            'event': 'big',
+            'properties': {'text': 'x' * 255, 'n': 1, 'token': 'testmixpanel'},
+            })
+
+
 class FailuresTestCase(TestCase):
     def test_failed_request(self):
         self.mock_urlopen.side_effect = urllib2.URLError("You're doing it wrong")
@@ -228,3 +312,1583 @@ class FailuresTestCase(TestCase):
         self.mock_urlopen.return_value.read.return_value = '0'
         result = tasks.event_tracker('event_foo')
         self.assertEqual(result, False)
+
+
+class BatchTrackerTest(TestCase):
+    def setUp(self):
+        super(BatchTrackerTest, self).setUp()
+        # Send batches in order, so mocked responses line up with them
+        mp_settings.MIXPANEL_SENDER_CONCURRENCY = 1
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SENDER_CONCURRENCY', 10)
+
+    def _sent_data(self, call):
+        request = call[0][0]
+        self.assertEqual(urlparse.urlparse(request.get_full_url()).query, '')
+        query = urlparse.parse_qs(request.get_data(), strict_parsing=True)
+        return json.loads(query['data'][0])
+
+    def test_batch(self):
+        events = [
+            {'event': 'clicked button'},
+            {'event': 'User logged in', 'properties': {'distinct_id': 1}},
+            {'event': 'Override token', 'properties': {'token': 'footoken'}},
+            ]
+        result = tasks.event_batch_tracker(events)
+        self.assertEqual(result, [True, True, True])
+        self.assertEqual(self.mock_urlopen.call_count, 1)
+        self.assertEqual(self._sent_data(self.mock_urlopen.call_args), [
+            {'event': 'clicked button',
+             'properties': {'token': 'testmixpanel'}},
+            {'event': 'User logged in',
+             'properties': {'distinct_id': 1, 'token': 'testmixpanel'}},
+            {'event': 'Override token',
+             'properties': {'token': 'footoken'}},
+            ])
+
+    def test_batch_chunks(self):
+        events = [{'event': 'e%d' % i} for i in range(120)]
+        result = tasks.event_batch_tracker(events)
+        self.assertEqual(result, [True] * 120)
+        sizes = [len(self._sent_data(c)) for c in self.mock_urlopen.call_args_list]
+        self.assertEqual(sizes, [50, 50, 20])
+
+    def test_batch_failed_response(self):
+        self.mock_urlopen.return_value.read.side_effect = ['1', '0']
+        events = [{'event': 'e%d' % i} for i in range(60)]
+        result = tasks.event_batch_tracker(events)
+        self.assertEqual(result, [True] * 50 + [False] * 10)
+
+    def test_batch_retries_unsent(self):
+        self.mock_urlopen.side_effect = [Mock(), urllib2.URLError("down")]
+        events = [{'event': 'e%d' % i} for i in range(60)]
+        with mock.patch.object(tasks.event_batch_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_batch_tracker, events)
+        self.assertEqual(retry.call_args[1]['args'], [events[50:]])
+
+    def test_batch_split_by_size(self):
+        mp_settings.MIXPANEL_MAX_REQUEST_BYTES = 1000
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_MAX_REQUEST_BYTES', 2 * 1024 * 1024)
+        events = [{'event': 'e', 'properties': {'text': 'x' * 300}}] * 7
+        self.assertEqual(tasks.event_batch_tracker(events), [True] * 7)
+        sizes = [len(self._sent_data(c)) for c in self.mock_urlopen.call_args_list]
+        self.assertEqual(sizes, [2, 2, 2, 1])
+
+    def test_batch_oversized_event(self):
+        mp_settings.MIXPANEL_MAX_EVENT_BYTES = 500
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_MAX_EVENT_BYTES', 1024 * 1024)
+        events = [{'event': 'a'}, {'event': 'big', 'properties': {'text': 'x' * 600}},
+                  {'event': 'c'}]
+        self.assertEqual(tasks.event_batch_tracker(events), [True, False, True])
+        self.assertEqual([e['event'] for e in self._sent_data(self.mock_urlopen.call_args)],
+                         ['a', 'c'])
+
+    def test_fanout(self):
+        users = ['u%d' % i for i in range(120)]
+        result = tasks.event_fanout_tracker('Seen', users, {'plan': 'pro', 'n': 1})
+        self.assertEqual(result, [True] * 120)
+        sent = [self._sent_data(c) for c in self.mock_urlopen.call_args_list]
+        self.assertEqual([len(events) for events in sent], [50, 50, 20])
+        self.assertDictEqual(sent[2][-1], {'event': 'Seen', 'properties': {
+            'distinct_id': 'u119', 'plan': 'pro', 'n': 1, 'token': 'testmixpanel'}})
+        self.assertEqual([e['properties']['distinct_id'] for e in sum(sent, [])], users)
+
+    def test_fanout_retries_failed_users(self):
+        self.mock_urlopen.side_effect = [Mock(), urllib2.URLError("down")]
+        users = range(60)
+        with mock.patch.object(tasks.event_fanout_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_fanout_tracker, 'Seen', users,
+                              {'plan': 'pro'}, token='footoken')
+        self.assertEqual(retry.call_args[1]['args'], ['Seen', users[50:]])
+        self.assertDictEqual(retry.call_args[1]['kwargs'],
+                             {'properties': {'plan': 'pro'}, 'token': 'footoken'})
+
+    def test_fanout_sampled(self):
+        mp_settings.MIXPANEL_SAMPLE_RATES = {'Seen': 0.5}
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SAMPLE_RATES', {})
+        users = range(20)
+        self.assertEqual(tasks.event_fanout_tracker('Seen', users), [True] * 20)
+        sent = self._sent_data(self.mock_urlopen.call_args)
+        self.assertEqual([e['properties']['distinct_id'] for e in sent],
+                         [u for u in users if filters.in_sample('Seen', u, 0.5)])
+        self.assertEqual(set(e['properties']['sample_rate'] for e in sent), set([0.5]))
+
+
+class EventBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.flushed = []
+        def flush(events):
+            self.flushed.append(events)
+            return [True] * len(events)
+        self.batcher = batch.EventBatcher(flush, max_size=3, max_age=10,
+                                          clock=lambda: self.now)
+
+    def test_size_trigger(self):
+        self.assertEqual(self.batcher.add('a'), None)
+        self.assertEqual(self.batcher.add('b', token='footoken'), None)
+        self.assertEqual(self.batcher.add('c', {'x': 1}), [True] * 3)
+        self.assertEqual(self.flushed, [[
+            {'event': 'a', 'properties': {}},
+            {'event': 'b', 'properties': {'token': 'footoken'}},
+            {'event': 'c', 'properties': {'x': 1}},
+            ]])
+        self.assertEqual(len(self.batcher), 0)
+
+    def test_time_trigger(self):
+        self.batcher.add('a')
+        self.now = 5
+        self.assertEqual(self.batcher.flush_if_due(), None)
+        self.now = 10
+        self.assertEqual(self.batcher.flush_if_due(), [True])
+        self.assertEqual(self.batcher.flush_if_due(), None)
+
+        self.batcher.add('b')
+        self.now = 25
+        self.assertEqual(self.batcher.add('c'), [True, True])
+
+    def test_flush(self):
+        self.assertEqual(self.batcher.flush(), [])
+        self.batcher.add('a')
+        self.assertEqual(self.batcher.flush(), [True])
+        self.assertEqual(self.flushed, [[{'event': 'a', 'properties': {}}]])
+
+    def test_timer(self):
+        flushed = threading.Event()
+        batcher = batch.EventBatcher(lambda events: flushed.set(), max_age=0.05)
+        batcher.add('a')
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(len(batcher), 0)
+
+    def test_exit(self):
+        self.batcher.add('a')
+        self.assertEqual(self.flushed, [])
+        batch._flush_all()
+        self.assertEqual(self.flushed, [[{'event': 'a', 'properties': {}}]])
+
+
+class PeopleBatchTrackerTest(TestCase):
+    def test_batch(self):
+        updates = [
+            {'$distinct_id': 1, '$set': {'name': 'Aron'}},
+            {'$distinct_id': 2, '$add': {'visits': 1}, '$token': 'footoken'},
+            ]
+        result = tasks.people_batch_tracker(updates)
+        self.assertEqual(result, [True, True])
+        request = self.mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_full_url(), 'https://api.mixpanel.com/engage/')
+        query = urlparse.parse_qs(request.get_data())
+        self.assertEqual(json.loads(query['data'][0]), [
+            {'$distinct_id': 1, '$set': {'name': 'Aron'}, '$token': 'testmixpanel'},
+            {'$distinct_id': 2, '$add': {'visits': 1}, '$token': 'footoken'},
+            ])
+
+
+    def test_split(self):
+        updates = [
+            {'$distinct_id': 1, '$add': {'visits': 1}, '$set': {'name': 'Aron'},
+             '$ignore_time': True},
+            {'$distinct_id': 2, '$delete': ''},
+            ]
+        self.assertEqual(tasks.people_batch_tracker(updates), [True] * 3)
+        query = urlparse.parse_qs(self.mock_urlopen.call_args[0][0].get_data())
+        self.assertEqual(json.loads(query['data'][0]), [
+            {'$distinct_id': 1, '$set': {'name': 'Aron'}, '$ignore_time': True,
+             '$token': 'testmixpanel'},
+            {'$distinct_id': 1, '$add': {'visits': 1}, '$ignore_time': True,
+             '$token': 'testmixpanel'},
+            {'$distinct_id': 2, '$delete': '', '$token': 'testmixpanel'},
+            ])
+
+
+class PeopleBatcherTest(unittest.TestCase):
+    def setUp(self):
+        mp_settings.MIXPANEL_API_TOKEN = 'testmixpanel'
+        self.now = 0
+        self.flushed = []
+        def flush(updates):
+            self.flushed.append(updates)
+            return [True] * len(updates)
+        self.batcher = batch.PeopleBatcher(flush, max_size=3, max_age=10,
+                                           clock=lambda: self.now)
+
+    def test_coalesce(self):
+        self.batcher.max_size = 10
+        self.batcher.set(1, {'name': 'Aron', 'plan': 'free'})
+        self.batcher.set(1, {'plan': 'premium'})
+        self.batcher.add(1, {'logins': 1})
+        self.batcher.add(1, {'logins': 1, 'visits': 2})
+        self.batcher.add(1, {'logins': 1}, token='footoken')
+        self.assertEqual(len(self.batcher), 3)
+        self.assertEqual(self.batcher.flush(), [True] * 3)
+        self.assertEqual(self.flushed, [[
+            {'$token': 'testmixpanel', '$distinct_id': 1,
+             '$set': {'name': 'Aron', 'plan': 'premium'}},
+            {'$token': 'testmixpanel', '$distinct_id': 1,
+             '$add': {'logins': 2, 'visits': 2}},
+            {'$token': 'footoken', '$distinct_id': 1, '$add': {'logins': 1}},
+            ]])
+
+    def test_coalesce_operations(self):
+        self.batcher.max_size = 20
+        tags = ['a']
+        self.batcher.update(1, {'$set_once': {'first': 1}, '$union': {'tags': tags}})
+        self.batcher.update(1, {'$set_once': {'first': 2, 'source': 'ad'},
+                                '$union': {'tags': ['a', 'b']}})
+        self.batcher.update(1, {'$append': {'actions': 'login'}})
+        self.batcher.update(1, {'$append': {'actions': 'login'}})
+        self.batcher.update(1, {'$unset': ['x'], '$delete': ''})
+        self.batcher.update(1, {'$unset': ['x', 'y'], '$delete': ''})
+        self.batcher.flush()
+        self.assertEqual(tags, ['a'])
+        self.assertEqual([dict((k, v) for k, v in u.items() if k.startswith('$')
+                               and k not in ('$token', '$distinct_id'))
+                          for u in self.flushed[0]], [
+            {'$set_once': {'first': 1}},
+            {'$union': {'tags': ['a']}},
+            {'$set_once': {'first': 2, 'source': 'ad'}},
+            {'$union': {'tags': ['a', 'b']}},
+            {'$append': {'actions': 'login'}},
+            {'$append': {'actions': 'login'}},
+            {'$unset': ['x']},
+            {'$delete': ''},
+            {'$unset': ['x', 'y']},
+            {'$delete': ''},
+            ])
+
+    def test_keep_order(self):
+        self.batcher.max_size = 10
+        self.batcher.set(1, {'credits': 0})
+        self.batcher.add(1, {'credits': 5})
+        self.batcher.set(2, {'credits': 1})
+        self.batcher.set(1, {'credits': 0})
+        self.batcher.set(1, {'plan': 'pro'})
+        self.batcher.flush()
+        self.assertEqual([(u['$distinct_id'], u.get('$set'), u.get('$add'))
+                          for u in self.flushed[0]], [
+            (1, {'credits': 0}, None),
+            (1, None, {'credits': 5}),
+            (2, {'credits': 1}, None),
+            (1, {'credits': 0, 'plan': 'pro'}, None),
+            ])
+
+    def test_keep_removals_in_place(self):
+        self.batcher.max_size = 10
+        self.batcher.set(1, {'plan': 'pro'})
+        self.batcher.update(1, {'$unset': ['plan']})
+        self.batcher.set(1, {'plan': 'free'})
+        self.batcher.update(1, {'$delete': ''})
+        self.batcher.update(1, {'$delete': ''})
+        self.batcher.set(1, {'name': 'x'})
+        self.batcher.flush()
+        self.assertEqual([dict((k, v) for k, v in u.items()
+                               if k not in ('$token', '$distinct_id'))
+                          for u in self.flushed[0]], [
+            {'$set': {'plan': 'pro'}},
+            {'$unset': ['plan']},
+            {'$set': {'plan': 'free'}},
+            {'$delete': ''},
+            {'$set': {'name': 'x'}},
+            ])
+
+    def test_triggers(self):
+        self.batcher.set(1, {'a': 1})
+        self.batcher.set(2, {'a': 1})
+        self.assertEqual(self.batcher.set(3, {'a': 1}), [True] * 3)
+        self.batcher.add(1, {'a': 1})
+        self.now = 10
+        self.assertEqual(self.batcher.flush_if_due(), [True])
+        self.assertEqual(len(self.batcher), 0)
+
+
+class EventBufferTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(tasks.event_batch_tracker, 'apply_async')
+        self.addCleanup(patcher.stop)
+        self.apply_async = patcher.start()
+
+    def test_context(self):
+        with buffer.EventBuffer(queue='mixpanel') as buf:
+            buf.add('a', {'distinct_id': 1})
+            buf.add('b', token='footoken')
+            self.assertFalse(self.apply_async.called)
+        self.apply_async.assert_called_once_with(args=[[
+            {'event': 'a', 'properties': {'distinct_id': 1}},
+            {'event': 'b', 'properties': {'token': 'footoken'}},
+            ]], queue='mixpanel')
+
+    def test_size(self):
+        buf = buffer.EventBuffer(max_size=2)
+        buf.add('a')
+        self.assertEqual(buf.add('b'), self.apply_async.return_value)
+        self.assertEqual(self.apply_async.call_count, 1)
+        self.assertEqual(buf.flush(), None)
+        self.assertEqual(self.apply_async.call_count, 1)
+
+    def test_track(self):
+        buffer.track('a')
+        buffer.track('b')
+        self.assertTrue(buffer.get_buffer() is buffer.get_buffer())
+        buffer.get_buffer().flush()
+        self.assertEqual(len(self.apply_async.call_args[1]['args'][0]), 2)
+
+    def test_track_per_token(self):
+        mp_settings.MIXPANEL_TOKEN_SETTINGS = {'hot': {'queue': 'mixpanel-hot'}}
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_TOKEN_SETTINGS', {})
+        buffer.track('a', token='hot')
+        buffer.track('b', token='cold')
+        buffer.track('c', token='hot')
+        self.assertEqual(len(buffer.flush()), 2)
+        calls = sorted((call[1] for call in self.apply_async.call_args_list),
+                       key=lambda kwargs: kwargs['kwargs']['token'])
+        self.assertEqual(calls, [
+            {'args': [[{'event': 'b', 'properties': {}}]], 'kwargs': {'token': 'cold'}},
+            {'args': [[{'event': 'a', 'properties': {}}, {'event': 'c', 'properties': {}}]],
+             'kwargs': {'token': 'hot'}, 'queue': 'mixpanel-hot'},
+            ])
+
+
+class FunnelSessionTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(tasks.event_batch_tracker, 'apply_async')
+        self.addCleanup(patcher.stop)
+        self.apply_async = patcher.start()
+
+    def test_ordered_batch(self):
+        with funnels.FunnelSession('f', 'done', {'distinct_id': 1, 'plan': 'pro'},
+                                   token='footoken', clock=lambda: 10.0) as session:
+            session.step('start')
+            session.step('middle', {'plan': 'free'})
+            session.step('done')
+        self.apply_async.assert_called_once_with(args=[[
+            {'event': 'mp_funnel', 'properties': {
+                'distinct_id': 1, 'plan': 'pro', 'funnel': 'f', 'goal': 'done',
+                'step': 'start', 'time': 10000}},
+            {'event': 'mp_funnel', 'properties': {
+                'distinct_id': 1, 'plan': 'free', 'funnel': 'f', 'goal': 'done',
+                'step': 'middle', 'time': 10001}},
+            {'event': 'mp_funnel', 'properties': {
+                'distinct_id': 1, 'plan': 'pro', 'funnel': 'f', 'goal': 'done',
+                'step': 'done', 'time': 10002}},
+            ]], kwargs={'token': 'footoken'})
+
+    def test_given_times_stay_monotonic(self):
+        session = funnels.FunnelSession('f', 'b', {'distinct_id': 1})
+        session.step('a', {'time': 5000})
+        session.step('b', {'time': 4000})
+        session.flush()
+        events = self.apply_async.call_args[1]['args'][0]
+        self.assertEqual([e['properties']['time'] for e in events], [5000, 5001])
+
+    def test_validated_up_front(self):
+        self.assertRaises(tasks.InvalidFunnelProperties,
+                          funnels.FunnelSession, 'f', 'b', {'plan': 'pro'})
+
+
+class ConcurrentSenderTest(TestCase):
+    def test_send_many(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+        def urlopen(url, data, timeout):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            response = Mock()
+            if 'bad' in url:
+                raise urllib2.URLError("down")
+            response.read.return_value = '0' if 'no' in url else '1'
+            return response
+        self.mock_urlopen.side_effect = urlopen
+        names = ['ok%d' % i for i in range(20)] + ['no', 'bad']
+        # Put the name in the endpoint so the fake urlopen can tell them apart
+        requests = [({'event': n}, '/%s/' % n) for n in names]
+
+        results = sender.ConcurrentSender(concurrency=4).send_many(requests)
+        self.assertEqual(results[:21], [True] * 20 + [False])
+        self.assertTrue(isinstance(results[21], tasks.FailedEventRequest))
+        self.assertEqual(self.mock_urlopen.call_count, 22)
+        self.assertTrue(1 < state['peak'] <= 4)
+
+    def test_unexpected_error(self):
+        self.mock_urlopen.side_effect = ValueError("boom")
+        requests = [({'event': 'a'}, '/track/')] * 3
+        self.assertRaises(ValueError,
+            sender.ConcurrentSender(concurrency=2).send_many, requests)
+
+
+class _Offset(datetime.tzinfo):
+    def __init__(self, hours):
+        self.offset = datetime.timedelta(hours=hours)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+class SerializerTest(unittest.TestCase):
+    props = {
+        'time': datetime.datetime(2013, 5, 1, 12, 30, 15, 250),
+        'aware': datetime.datetime(2013, 5, 1, 1, 30, 15, tzinfo=_Offset(2)),
+        'day': datetime.date(2013, 5, 1),
+        'price': decimal.Decimal('9.99'),
+        'id': uuid.UUID('c9533b5b-d69e-479a-ae5f-42dd7a9752a0'),
+        'tags': ('a', 'b'),
+        }
+    expected = {
+        'time': '2013-05-01T12:30:15',
+        'aware': '2013-04-30T23:30:15',
+        'day': '2013-05-01',
+        'price': 9.99,
+        'id': 'c9533b5b-d69e-479a-ae5f-42dd7a9752a0',
+        'tags': ['a', 'b'],
+        }
+
+    def _test_serializer(self, name):
+        try:
+            dumps = serializers.get_serializer(name)
+        except serializers.UnknownSerializer:
+            raise unittest.SkipTest("%s is not installed" % name)
+        data = dumps({'event': 'e', 'properties': self.props})
+        self.assertEqual(json.loads(data), {'event': 'e', 'properties': self.expected})
+
+    def test_simplejson(self):
+        self._test_serializer('simplejson')
+
+    def test_json(self):
+        self._test_serializer('json')
+
+    def test_ujson(self):
+        self._test_serializer('ujson')
+
+    def test_orjson(self):
+        self._test_serializer('orjson')
+
+    def test_compact(self):
+        self.assertEqual(serializers.get_serializer('json')({'a': [1, 2]}), '{"a":[1,2]}')
+
+    def test_unknown(self):
+        self.assertRaises(serializers.UnknownSerializer,
+                          serializers.get_serializer, 'pickle')
+        self.assertRaises(TypeError, serializers.dumps, {'a': object()})
+
+
+class PostRequestTest(TestCase):
+    def setUp(self):
+        super(PostRequestTest, self).setUp()
+        mp_settings.MIXPANEL_REQUEST_METHOD = 'POST'
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_REQUEST_METHOD', 'GET')
+
+    def _sent_request(self):
+        request = self.mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_method(), 'POST')
+        self.assertEqual(request.get_full_url(), 'https://api.mixpanel.com/track/')
+        return request
+
+    def test_post(self):
+        self.assertEqual(tasks.event_tracker('clicked button'), True)
+        request = self._sent_request()
+        self.assertEqual(request.get_header('Content-type'),
+                         'application/x-www-form-urlencoded')
+        self.assertFalse(request.has_header('Content-encoding'))
+        query = urlparse.parse_qs(request.get_data(), strict_parsing=True)
+        self.assertDictEqual(json.loads(query['data'][0]), {
+            'event': 'clicked button',
+            'properties': {'token': 'testmixpanel'},
+            })
+
+    def test_gzip(self):
+        mp_settings.MIXPANEL_GZIP_REQUESTS = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_GZIP_REQUESTS', False)
+
+        self.assertEqual(tasks.event_tracker('clicked button'), True)
+        request = self._sent_request()
+        self.assertEqual(request.get_header('Content-encoding'), 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO(request.get_data())).read()
+        query = urlparse.parse_qs(body, strict_parsing=True)
+        self.assertDictEqual(json.loads(query['data'][0]), {
+            'event': 'clicked button',
+            'properties': {'token': 'testmixpanel'},
+            })
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100
+        self.breaker = circuit.CircuitBreaker(threshold=2, reset_timeout=60,
+                                              clock=lambda: self.now)
+
+    def test_open_and_reset(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 60)
+
+        # Half-open: one trial request, which fails and re-opens the circuit
+        self.now = 160
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+        # A successful trial closes it
+        self.now = 220
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_lost_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 160
+        self.assertTrue(self.breaker.allow())
+        # The trial never reports back, e.g. its task hit a time limit
+        self.now = 200
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 20)
+        self.now = 220
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.now = 100000
+        self.assertTrue(self.breaker.allow())
+
+    def test_success_resets_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+    def test_state_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'circuit')
+        self.breaker.state_file = path
+        other = circuit.CircuitBreaker(threshold=2, reset_timeout=60,
+                                       state_file=path, clock=lambda: self.now)
+        self.assertTrue(other.allow())
+
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertFalse(other.allow())
+        self.assertEqual(other.retry_after(), 60)
+
+        self.now = 160
+        self.breaker.record_success()
+        self.now = 100
+        self.assertTrue(other.allow())
+
+
+class RetryTest(TestCase):
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        for name in ('MIXPANEL_RETRY_BACKOFF', 'MIXPANEL_RETRY_JITTER',
+                     'MIXPANEL_CIRCUIT_BREAKER', 'MIXPANEL_PARKING_QUEUE'):
+            self.addCleanup(setattr, mp_settings, name, getattr(mp_settings, name))
+        self.addCleanup(setattr, circuit, '_breaker', None)
+
+    def _retry(self, exc, retries=0):
+        task = tasks.event_tracker
+        task.push_request(args=['event_foo'], kwargs={}, retries=retries,
+                          called_directly=False, is_eager=False, id='abc')
+        self.addCleanup(task.pop_request)
+        with mock.patch.object(task, 'retry') as retry:
+            with mock.patch.object(task, 'subtask_from_request') as subtask:
+                result = tasks._retry(task, exc)
+        return result, retry, subtask
+
+    def test_fixed_delay(self):
+        result, retry, subtask = self._retry(tasks.FailedEventRequest(), retries=3)
+        retry.assert_called_once_with(args=None, kwargs=None, exc=mock.ANY,
+                                      countdown=mp_settings.MIXPANEL_RETRY_DELAY)
+
+    def test_backoff(self):
+        mp_settings.MIXPANEL_RETRY_BACKOFF = True
+        self.assertEqual(tasks._retry_delay(0), 300)
+        self.assertEqual(tasks._retry_delay(2), 1200)
+        self.assertEqual(tasks._retry_delay(10), 3600)
+
+    def test_jitter(self):
+        mp_settings.MIXPANEL_RETRY_JITTER = True
+        delays = set(tasks._retry_delay(0) for i in range(20))
+        self.assertTrue(len(delays) > 1)
+        self.assertTrue(all(150 <= d <= 300 for d in delays))
+
+    def test_apply_retries(self):
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_MAX_RETRIES',
+                        mp_settings.MIXPANEL_MAX_RETRIES)
+        mp_settings.MIXPANEL_MAX_RETRIES = 2
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        result = tasks.event_tracker.apply(('e',))
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertTrue(isinstance(result.result, tasks.FailedEventRequest))
+        self.assertEqual(self.mock_urlopen.call_count, 3)
+
+        self.mock_urlopen.reset_mock()
+        self.mock_urlopen.side_effect = [urllib2.URLError("down"), Mock()]
+        tasks.event_tracker.apply(('e',))
+        self.assertEqual(self.mock_urlopen.call_count, 2)
+
+    def test_circuit_open(self):
+        mp_settings.MIXPANEL_CIRCUIT_BREAKER = True
+        breaker = circuit.get_breaker()
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        for i in range(breaker.threshold):
+            self.assertRaises(tasks.FailedEventRequest, tasks.event_tracker, 'e')
+        self.mock_urlopen.reset_mock()
+        self.assertRaises(tasks.CircuitOpen, tasks.event_tracker, 'e')
+        self.assertFalse(self.mock_urlopen.called)
+
+    def test_parking(self):
+        mp_settings.MIXPANEL_CIRCUIT_BREAKER = True
+        mp_settings.MIXPANEL_PARKING_QUEUE = 'mixpanel.parked'
+        breaker = circuit.get_breaker()
+        for i in range(breaker.threshold):
+            breaker.record_failure()
+
+        result, retry, subtask = self._retry(tasks.CircuitOpen(), retries=2)
+        self.assertFalse(retry.called)
+        self.assertTrue(isinstance(result, RetryTaskError))
+        self.assertEqual(subtask.call_args[1]['queue'], 'mixpanel.parked')
+        self.assertEqual(subtask.call_args[1]['retries'], 2)
+        self.assertTrue(0 < subtask.call_args[1]['countdown'] <= 60)
+        self.assertTrue(subtask.return_value.apply_async.called)
+
+
+def _http_error(code, body='', headers=''):
+    return urllib2.HTTPError('https://api.mixpanel.com/track/', code, 'error',
+                             mimetools.Message(StringIO(headers + '\r\n')), StringIO(body))
+
+
+class ResponseTest(TestCase):
+    def test_client_error(self):
+        self.mock_urlopen.side_effect = _http_error(400, '{"error": "bad data", "status": 0}')
+        with mock.patch.object(tasks.event_tracker, 'retry') as retry:
+            try:
+                tasks.event_tracker('e')
+            except tasks.RejectedRequest as e:
+                self.assertEqual(e.status, 400)
+                self.assertTrue('bad data' in str(e))
+            else:
+                self.fail("RejectedRequest not raised")
+        self.assertFalse(retry.called)
+
+    def test_retry_after(self):
+        self.mock_urlopen.side_effect = _http_error(503, headers='Retry-After: 120\r\n')
+        with mock.patch.object(tasks.event_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_tracker, 'e')
+        self.assertEqual(retry.call_args[1]['countdown'], 120)
+        self.assertEqual(retry.call_args[1]['exc'].status, 503)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(tasks._parse_retry_after('30'), 30)
+        self.assertEqual(tasks._parse_retry_after(None), None)
+        date = email.utils.formatdate(time.time() + 60)
+        self.assertTrue(55 <= tasks._parse_retry_after(date) <= 60)
+
+    def test_pooled_rate_limited(self):
+        mp_settings.MIXPANEL_CONNECTION_POOL = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_CONNECTION_POOL', False)
+        with mock.patch.object(pool, 'get_pool') as get_pool:
+            get_pool.return_value.request.return_value = (429, '', {'retry-after': '5'})
+            try:
+                tasks._send_request({'event': 'e'})
+            except tasks.FailedEventRequest as e:
+                self.assertEqual((e.status, e.retry_after), (429, 5))
+            else:
+                self.fail("FailedEventRequest not raised")
+
+    def test_batch_rejected_chunk(self):
+        mp_settings.MIXPANEL_SENDER_CONCURRENCY = 1
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SENDER_CONCURRENCY', 10)
+        self.mock_urlopen.side_effect = [_http_error(400), self.mock_urlopen.return_value]
+        events = [{'event': 'e%d' % i} for i in range(60)]
+        self.assertEqual(tasks.event_batch_tracker(events), [False] * 50 + [True] * 10)
+
+    def test_verbose(self):
+        mp_settings.MIXPANEL_VERBOSE = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_VERBOSE', False)
+        self.mock_urlopen.return_value.read.return_value = '{"status": 1, "error": null}'
+        self.assertEqual(tasks.event_tracker('e'), True)
+        query = urlparse.parse_qs(urlparse.urlparse(self.mock_urlopen.call_args[0][0]).query)
+        self.assertEqual(query['verbose'], ['1'])
+
+        self.mock_urlopen.return_value.read.return_value = '{"status": 0, "error": "bad token"}'
+        self.assertEqual(tasks.event_tracker('e'), False)
+
+        self.mock_urlopen.return_value.read.return_value = (
+            '{"code": 400, "status": "Bad Request", "failed_records": [{"index": 1}]}')
+        self.assertEqual(tasks._send_request([{'event': 'a'}, {'event': 'b'}], post=True),
+                         [True, False])
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = spool.Spool(self.directory, segment_bytes=200, max_bytes=10000)
+        self.sent = []
+
+    def _send(self, batch):
+        self.sent.append(batch)
+
+    def _files(self, suffix):
+        return sorted(n for n in os.listdir(self.directory) if n.endswith(suffix))
+
+    def test_replay(self):
+        for i in range(5):
+            self.spool.append({'event': 'e%d' % i}, '/track/')
+        self.spool.append({'$distinct_id': 1}, '/engage/')
+        self.spool.append({'event': 'e5'}, '/track/')
+
+        self.assertEqual(self.spool.replay(self._send, batch_size=3), 7)
+        self.assertEqual(self.sent, [
+            [({'event': 'e0'}, '/track/'), ({'event': 'e1'}, '/track/'),
+             ({'event': 'e2'}, '/track/')],
+            [({'event': 'e3'}, '/track/'), ({'event': 'e4'}, '/track/')],
+            [({'$distinct_id': 1}, '/engage/')],
+            [({'event': 'e5'}, '/track/')],
+            ])
+        self.assertEqual(self.spool.replay(self._send), 0)
+
+    def test_failure_resumes(self):
+        for i in range(4):
+            self.spool.append({'event': 'e%d' % i}, '/track/')
+        def send(batch):
+            if batch[0][0]['event'] == 'e2':
+                raise tasks.FailedEventRequest("down")
+            self.sent.append(batch)
+        self.assertRaises(tasks.FailedEventRequest,
+                          self.spool.replay, send, batch_size=2)
+        self.assertEqual(self.spool.replay(self._send, batch_size=2), 2)
+        self.assertEqual([b[0][0]['event'] for b in self.sent], ['e0', 'e2'])
+
+    def test_limit(self):
+        for i in range(4):
+            self.spool.append({'event': 'e%d' % i}, '/track/')
+        self.assertEqual(self.spool.replay(self._send, batch_size=10, limit=3), 3)
+        self.assertEqual(self.spool.replay(self._send, batch_size=10), 1)
+
+    def test_compaction(self):
+        for i in range(20):
+            self.spool.append({'event': 'event number %d' % i}, '/track/')
+        self.assertTrue(len(self._files('.seg')) > 1)
+        self.assertEqual(len(self._files('.log')), 1)
+
+        self.assertEqual(self.spool.replay(self._send), 20)
+        self.assertEqual(self._files('.seg'), [])
+        # The segment still being written to is kept
+        self.assertEqual(len(self._files('.log')), 1)
+
+    def test_partial_line(self):
+        self.spool.append({'event': 'e0'}, '/track/')
+        with open(os.path.join(self.directory, self._files('.log')[0]), 'a') as f:
+            f.write('{"endpoint": "/tra')
+        self.assertEqual(self.spool.replay(self._send), 1)
+
+    def test_full(self):
+        self.spool.max_bytes = 100
+        self.spool.append({'event': 'e0'}, '/track/')
+        self.assertRaises(spool.SpoolFull, self.spool.append,
+                          {'event': 'x' * 100}, '/track/')
+
+    def test_full_until_replayed_elsewhere(self):
+        self.spool.max_bytes = 1000
+        with self.assertRaises(spool.SpoolFull):
+            for i in range(100):
+                self.spool.append({'event': 'e%d' % i}, '/track/')
+        # Replayed by another process, which leaves our segment alone
+        other = spool.Spool(self.directory)
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(other.replay(self._send), i)
+        self.spool.append({'event': 'e%d' % i}, '/track/')
+
+
+
+class SpoolTaskTest(TestCase):
+    def setUp(self):
+        super(SpoolTaskTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        mp_settings.MIXPANEL_SPOOL_DIR = directory
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SPOOL_DIR', None)
+
+    def test_exhausted_retries(self):
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        task = tasks.event_tracker
+        task.push_request(args=['e'], kwargs={}, retries=task.max_retries,
+                          called_directly=False, is_eager=False, id='abc')
+        self.addCleanup(task.pop_request)
+        self.assertRaises(Ignore, task.run, 'event_foo')
+
+        self.mock_urlopen.side_effect = None
+        self.assertEqual(tasks.spool_replay(), 1)
+        request = self.mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_full_url(), 'https://api.mixpanel.com/track/')
+        query = urlparse.parse_qs(request.get_data())
+        self.assertEqual(json.loads(query['data'][0]), [
+            {'event': 'event_foo', 'properties': {'token': 'testmixpanel'}}])
+
+    def test_apply_spools_when_exhausted(self):
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_MAX_RETRIES',
+                        mp_settings.MIXPANEL_MAX_RETRIES)
+        mp_settings.MIXPANEL_MAX_RETRIES = 1
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        tasks.event_tracker.apply(('event_foo',))
+        self.assertEqual(self.mock_urlopen.call_count, 2)
+
+        self.mock_urlopen.side_effect = None
+        self.assertEqual(tasks.spool_replay(), 1)
+
+    def test_retries_left(self):
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        task = tasks.event_tracker
+        task.push_request(args=['e'], kwargs={}, retries=0,
+                          called_directly=False, is_eager=False, id='abc')
+        self.addCleanup(task.pop_request)
+        with mock.patch.object(task, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, task.run, 'event_foo')
+        self.assertEqual(tasks.spool_replay(), 0)
+
+    def test_replay_failure(self):
+        spool.get_spool().append({'event': 'e'}, '/track/')
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        self.assertEqual(tasks.spool_replay(), 0)
+        self.mock_urlopen.side_effect = None
+        self.assertEqual(tasks.spool_replay(), 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.slept = []
+        def sleep(seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+        self.bucket = ratelimit.TokenBucket(10, 5, clock=lambda: self.now,
+                                            sleep=sleep)
+
+    def test_burst(self):
+        for i in range(5):
+            self.assertEqual(self.bucket.acquire(), 0)
+        self.assertEqual(self.bucket.acquire(), 0.1)
+
+    def test_refill(self):
+        self.bucket.acquire(5)
+        self.now += 0.3
+        self.assertEqual(self.bucket.acquire(3), 0)
+        self.now += 100
+        self.bucket.acquire(5)
+        self.assertEqual(self.slept, [])
+
+    def test_sustained_rate(self):
+        for i in range(105):
+            self.bucket.acquire()
+        # The burst goes out at once, then 10 per second
+        self.assertAlmostEqual(self.now, 10)
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+        self.limiter = ratelimit.RateLimiter(
+            endpoint_limits={'/track/': (100, 100)},
+            token_limits={'footoken': (10, 10)})
+        self.acquired = []
+        def acquire(bucket, n=1):
+            self.acquired.append((bucket.rate, n))
+            return 0
+        patcher = mock.patch.object(ratelimit.TokenBucket, 'acquire', acquire)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_throttle(self):
+        self.limiter.throttle({'event': 'e', 'properties': {'token': 'footoken'}}, '/track/')
+        self.assertEqual(self.acquired, [(100, 1), (10, 1)])
+
+    def test_batch(self):
+        events = [{'event': 'e', 'properties': {'token': t}}
+                  for t in ('footoken', 'bartoken', 'footoken')]
+        self.limiter.throttle(events, '/track/')
+        self.assertEqual(self.acquired, [(100, 3), (10, 2)])
+
+    def test_unlimited(self):
+        self.limiter.throttle({'$token': 'bartoken', '$set': {}}, '/engage/')
+        self.limiter.throttle({'$token': 'footoken', '$set': {}}, '/engage/')
+        self.assertEqual(self.acquired, [(10, 1)])
+
+    def test_send_request(self):
+        mp_settings.MIXPANEL_RATE_LIMITS = {'/track/': (5, 5)}
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_RATE_LIMITS', {})
+        tasks.event_tracker('clicked button')
+        self.assertEqual(self.acquired, [(5, 1)])
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.connection_class = Mock(side_effect=self._connection)
+        self.pool = pool.ConnectionPool('api.example.com', size=2,
+            idle_timeout=60, timeout=5, reconnect_on_reset=True,
+            connection_class=self.connection_class, clock=lambda: self.now)
+
+    def _connection(self, host, timeout):
+        conn = Mock()
+        response = conn.getresponse.return_value
+        response.status = 200
+        response.read.return_value = '1'
+        response.will_close = False
+        return conn
+
+    def test_reuse(self):
+        self.assertEqual(self.pool.request('GET', '/track/?data=x'), (200, '1', {}))
+        self.assertEqual(self.pool.request('GET', '/track/?data=y'), (200, '1', {}))
+        self.assertEqual(self.connection_class.call_count, 1)
+        self.connection_class.assert_called_with('api.example.com', timeout=5)
+
+    def test_idle_eviction(self):
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        self.now = 61
+        self.pool.request('GET', '/track/')
+        self.assertEqual(self.connection_class.call_count, 2)
+        self.assertTrue(conn.close.called)
+
+    def test_server_close(self):
+        def connection(host, timeout):
+            conn = self._connection(host, timeout)
+            conn.getresponse.return_value.will_close = True
+            return conn
+        self.connection_class.side_effect = connection
+        self.pool.request('GET', '/track/')
+        self.assertEqual(self.pool._idle, [])
+
+    def test_reconnect_on_reset(self):
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        conn.request.side_effect = socket.error(104, 'Connection reset by peer')
+        self.assertEqual(self.pool.request('GET', '/track/'), (200, '1', {}))
+        self.assertTrue(conn.close.called)
+        self.assertEqual(self.connection_class.call_count, 2)
+
+        self.pool.reconnect_on_reset = False
+        self.pool._idle[0][0].request.side_effect = socket.error(104, 'reset')
+        self.assertRaises(socket.error, self.pool.request, 'GET', '/track/')
+
+    def test_no_resend_once_sent(self):
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        conn.getresponse.side_effect = socket.timeout('timed out')
+        self.assertRaises(socket.timeout, self.pool.request, 'POST', '/track/', 'data=x')
+        self.assertEqual(conn.request.call_count, 2)
+        self.assertEqual(self.connection_class.call_count, 1)
+
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        conn.getresponse.side_effect = socket.error(104, 'Connection reset by peer')
+        self.assertRaises(socket.error, self.pool.request, 'POST', '/track/', 'data=x')
+        self.assertEqual(self.connection_class.call_count, 2)
+
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        conn.getresponse.side_effect = httplib.BadStatusLine("''")
+        self.assertEqual(self.pool.request('POST', '/track/', 'data=x'), (200, '1', {}))
+        self.assertEqual(self.connection_class.call_count, 4)
+
+    def test_fork(self):
+        self.pool.request('GET', '/track/')
+        conn = self.pool._idle[0][0]
+        with mock.patch('os.getpid', return_value=self.pool._pid + 1):
+            self.pool.request('GET', '/track/')
+        self.assertEqual(self.connection_class.call_count, 2)
+        self.assertFalse(conn.close.called)
+
+
+class PooledRequestTest(TestCase):
+    def setUp(self):
+        super(PooledRequestTest, self).setUp()
+        mp_settings.MIXPANEL_CONNECTION_POOL = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_CONNECTION_POOL', False)
+        patcher = mock.patch.object(pool, 'get_pool')
+        self.addCleanup(patcher.stop)
+        self.mock_request = patcher.start().return_value.request
+        self.mock_request.return_value = (200, '1', {})
+
+    def test_event(self):
+        self.assertEqual(tasks.event_tracker('clicked button'), True)
+        self.assertFalse(self.mock_urlopen.called)
+        method, path, body, headers, timeout = self.mock_request.call_args[0]
+        self.assertEqual(method, 'GET')
+        query = urlparse.parse_qs(urlparse.urlparse(path).query)
+        self.assertDictEqual(json.loads(base64.b64decode(query['data'][0])), {
+            'event': 'clicked button',
+            'properties': {'token': 'testmixpanel'},
+            })
+
+    def test_batch_post(self):
+        tasks.event_batch_tracker([{'event': 'clicked button'}])
+        method, path, body, headers, timeout = self.mock_request.call_args[0]
+        self.assertEqual((method, path), ('POST', '/track/'))
+        self.assertTrue(body.startswith('data='))
+
+    def test_failed_status(self):
+        self.mock_request.return_value = (502, 'Bad Gateway', {})
+        self.assertRaises(tasks.FailedEventRequest,
+                          tasks.event_tracker, 'event_foo')
+
+    def test_connection_error(self):
+        self.mock_request.side_effect = socket.error(111, 'Connection refused')
+        self.assertRaises(tasks.FailedEventRequest,
+                          tasks.event_tracker, 'event_foo')
+
+
+class TransportTest(TestCase):
+    def setUp(self):
+        super(TransportTest, self).setUp()
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_TRANSPORT', None)
+        patcher = mock.patch.object(transports, '_transport', None)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_default(self):
+        self.assertTrue(isinstance(transports.get_transport(), transports.UrllibTransport))
+        mp_settings.MIXPANEL_CONNECTION_POOL = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_CONNECTION_POOL', False)
+        self.assertTrue(isinstance(transports.get_transport(), transports.PooledTransport))
+
+    def test_memory(self):
+        mp_settings.MIXPANEL_TRANSPORT = 'memory'
+        self.assertEqual(tasks.event_tracker('a', {'distinct_id': 1}), True)
+        self.assertEqual(tasks.event_batch_tracker([{'event': 'b'}, {'event': 'c'}]),
+                         [True, True])
+        self.assertFalse(self.mock_urlopen.called)
+        transport = transports.get_transport()
+        self.assertEqual(transport.count, 2)
+        sent = [(endpoint, json.loads(data)) for endpoint, data in transport.sent()]
+        self.assertEqual(sent, [
+            ('/track/', {'event': 'a', 'properties': {'distinct_id': 1,
+                                                      'token': 'testmixpanel'}}),
+            ('/track/', [{'event': 'b', 'properties': {'token': 'testmixpanel'}},
+                         {'event': 'c', 'properties': {'token': 'testmixpanel'}}]),
+            ])
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'requests.jsonl')
+        mp_settings.MIXPANEL_TRANSPORT = 'file'
+        mp_settings.MIXPANEL_TRANSPORT_FILE = path
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_TRANSPORT_FILE', None)
+        mp_settings.MIXPANEL_GZIP_REQUESTS = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_GZIP_REQUESTS', False)
+
+        tasks.event_tracker('a')
+        tasks.people_tracker(1, set={'plan': 'pro'})
+        tasks.event_batch_tracker([{'event': 'b'}])
+        transports.get_transport().close()
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['endpoint'] for line in lines], ['/track/', '/engage/', '/track/'])
+        self.assertDictEqual(lines[1]['data']['$set'], {'plan': 'pro'})
+        self.assertEqual(lines[2]['data'], [{'event': 'b', 'properties': {'token': 'testmixpanel'}}])
+
+    def test_http_errors(self):
+        self.mock_urlopen.side_effect = _http_error(503, headers='Retry-After: 120\r\n')
+        self.assertEqual(transports.UrllibTransport().request('GET', '/track/?data=e30='),
+                         (503, '', {'retry-after': '120'}))
+
+
+class ImporterTest(TestCase):
+    def setUp(self):
+        super(ImporterTest, self).setUp()
+        mp_settings.MIXPANEL_API_KEY = 'testkey'
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_API_KEY', None)
+
+    def _sent_events(self):
+        events = []
+        for call in self.mock_urlopen.call_args_list:
+            request = call[0][0]
+            self.assertEqual(request.get_full_url(), 'https://api.mixpanel.com/import/')
+            query = urlparse.parse_qs(request.get_data(), strict_parsing=True)
+            self.assertEqual(query['api_key'], ['testkey'])
+            events.append(json.loads(query['data'][0]))
+        return events
+
+    def test_import(self):
+        lines = ['{"event": "e%d", "properties": {"time": %d}}\n' % (i, i)
+                 for i in range(7)]
+        lines.insert(3, '\n')
+        progress = Mock()
+        stats = importer.import_events(importer.read_events(lines),
+                                       batch_size=3, senders=1, progress=progress)
+        self.assertEqual((stats.sent, stats.rejected, stats.failed), (7, 0, 0))
+        self.assertEqual(self.mock_urlopen.call_count, 3)
+        # One round of up to two batches per sender
+        self.assertEqual(progress.call_count, 2)
+        batches = self._sent_events()
+        self.assertEqual([len(b) for b in batches], [3, 3, 1])
+        self.assertDictEqual(batches[0][1], {
+            'event': 'e1', 'properties': {'time': 1, 'token': 'testmixpanel'}})
+
+    def test_failures(self):
+        responses = iter([urllib2.URLError("down"), '0', '1'])
+        def urlopen(url, data, timeout):
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return Mock(**{'read.return_value': response})
+        self.mock_urlopen.side_effect = urlopen
+        events = [{'event': 'e', 'properties': {'time': 1}}] * 5
+        stats = importer.import_events(events, batch_size=2, senders=1)
+        self.assertEqual((stats.sent, stats.rejected, stats.failed), (1, 2, 2))
+
+    def test_missing_api_key(self):
+        mp_settings.MIXPANEL_API_KEY = None
+        self.assertRaises(importer.MissingApiKey, importer.import_events, [])
+
+
+class RoutingTest(TestCase):
+    def setUp(self):
+        super(RoutingTest, self).setUp()
+        mp_settings.MIXPANEL_TOKEN_SETTINGS = {
+            'hot': {'queue': 'mixpanel-hot', 'batch_size': 2, 'timeout': 1},
+            'testmixpanel': {'queue': 'mixpanel-default'},
+            }
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_TOKEN_SETTINGS', {})
+
+    def test_router(self):
+        router = routing.TokenRouter()
+        route = router.route_for_task
+        self.assertDictEqual(route('mixpanel.tasks.event_tracker', ['e'], {'token': 'hot'}),
+                             {'queue': 'mixpanel-hot'})
+        self.assertDictEqual(route('mixpanel.tasks.people_tracker', ['id', None, None, None, 'hot']),
+                             {'queue': 'mixpanel-hot'})
+        self.assertDictEqual(route('mixpanel.tasks.event_batch_tracker', [[]]),
+                             {'queue': 'mixpanel-default'})
+        self.assertEqual(route('mixpanel.tasks.event_tracker', ['e'], {'token': 'cold'}), None)
+        self.assertEqual(route('mixpanel.tasks.spool_replay', [], {}), None)
+
+    def test_batch_size_and_timeout(self):
+        tasks.event_batch_tracker([{'event': 'e'}] * 3, token='hot')
+        self.assertEqual(self.mock_urlopen.call_count, 2)
+        self.assertEqual(self.mock_urlopen.call_args[0][2], 1)
+
+        tasks.event_tracker('e')
+        self.assertEqual(self.mock_urlopen.call_args[0][2], mp_settings.MIXPANEL_API_TIMEOUT)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        mp_settings.MIXPANEL_METRICS = 'prometheus'
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_METRICS', None)
+        # Start every test with empty metrics
+        patcher = mock.patch.object(metrics, '_backend', None)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_prometheus(self):
+        tasks.event_batch_tracker([{'event': 'a'}, {'event': 'b'}])
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        self.assertRaises(tasks.FailedEventRequest, tasks.event_tracker, 'c')
+
+        backend = metrics.get_metrics()
+        self.assertTrue(isinstance(backend, metrics.PrometheusBackend))
+        lines = backend.render().splitlines()
+        self.assertTrue('mixpanel_events_sent_total 2' in lines)
+        self.assertTrue('mixpanel_events_failed_total 1' in lines)
+        self.assertTrue('mixpanel_events_retried_total 1' in lines)
+        self.assertTrue('mixpanel_batch_size_bucket{le="1"} 1' in lines)
+        self.assertTrue('mixpanel_batch_size_bucket{le="2"} 2' in lines)
+        self.assertTrue('mixpanel_batch_size_sum 3' in lines)
+        self.assertTrue('mixpanel_request_seconds_count 2' in lines)
+        self.assertTrue('# TYPE mixpanel_serialization_seconds histogram' in lines)
+
+    def test_enqueued(self):
+        with mock.patch('celery.task.base.Task.apply_async'):
+            tasks.event_tracker.delay('a')
+            tasks.funnel_event_tracker.apply_async(['f', 's', 'g', {'distinct_id': 1}])
+            tasks.event_fanout_tracker.delay('b', [1, 2, 3])
+            tasks.event_batch_tracker.apply_async(kwargs={'events': [{'event': 'c'}] * 4})
+            tasks.people_tracker.delay(1, {'a': 1})
+            tasks.people_batch_tracker.delay([{'$distinct_id': 1, '$set': {'a': 1}}] * 2)
+            tasks.spool_replay.delay()
+            # Retries are enqueued again but count once
+            tasks.event_tracker.apply_async(['a'], retries=1)
+            with buffer.EventBuffer() as buf:
+                buf.add('d')
+        lines = metrics.get_metrics().render().splitlines()
+        self.assertTrue('mixpanel_events_enqueued_total 13' in lines)
+
+    def test_statsd(self):
+        backend = metrics.StatsdBackend('statsd.local', 8125, 'mp')
+        backend._socket = Mock()
+        backend.incr('mixpanel_events_sent_total', 3)
+        backend.observe('mixpanel_request_seconds', 0.25)
+        backend.observe('mixpanel_batch_size', 50)
+        self.assertEqual([call[0] for call in backend._socket.sendto.call_args_list], [
+            ('mp.mixpanel_events_sent_total:3|c', ('statsd.local', 8125)),
+            ('mp.mixpanel_request:250.0|ms', ('statsd.local', 8125)),
+            ('mp.mixpanel_batch_size:50|h', ('statsd.local', 8125)),
+            ])
+
+    def test_log_events(self):
+        mp_settings.MIXPANEL_LOG_EVENTS = False
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_LOG_EVENTS', True)
+        with mock.patch.object(tasks, 'log') as log:
+            tasks.event_tracker('a')
+        self.assertFalse(log.info.called)
+
+
+class EventRecordTest(TestCase):
+    def test_fields(self):
+        event = events.Event('Signed up', {'distinct_id': 42, 'time': 1, 'plan': 'pro'},
+                             token='footoken')
+        self.assertEqual((event.name, event.token, event.distinct_id, event.time),
+                         ('Signed up', 'footoken', 42, 1))
+        self.assertDictEqual(event.properties, {'plan': 'pro'})
+        self.assertEqual(events.Event('e').properties, None)
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_encode(self):
+        props = {'distinct_id': u'\xe9', 'token': 'footoken', 'plan': 'pro',
+                 'price': decimal.Decimal('1.5'), 'tags': ['a']}
+        event = events.Event('Signed up', props)
+        self.assertDictEqual(json.loads(event.encode()),
+                             {'event': 'Signed up', 'properties': props})
+        self.assertEqual(events.Event('e').encode(), '{"event":"e","properties":{}}')
+
+    def test_dict_compatibility(self):
+        data = {'event': 'e', 'properties': {'token': 'footoken', 'a': 1}}
+        event = events.Event.from_dict(data)
+        self.assertTrue(event == data)
+        self.assertEqual(event['event'], 'e')
+        self.assertEqual(routing.params_token([event]), 'footoken')
+        self.assertDictEqual(events.as_dict(event), data)
+
+    def test_interned_keys(self):
+        a = events.Event(''.join(['Vie', 'wed']), {''.join(['ur', 'l']): 1})
+        b = events.Event(''.join(['Vie', 'wed']), {''.join(['ur', 'l']): 2})
+        self.assertTrue(a.name is b.name)
+        self.assertTrue(a.properties.keys()[0] is b.properties.keys()[0])
+
+    def test_pickle(self):
+        import pickle
+        event = events.Event('e', {'distinct_id': 1, 'a': 2}, token='footoken')
+        for protocol in range(3):
+            self.assertEqual(pickle.loads(pickle.dumps(event, protocol)), event)
+
+    def test_batcher_sends_records(self):
+        batcher = batch.EventBatcher(max_size=2)
+        self.assertEqual(batcher.add('a', {'distinct_id': 1}), None)
+        self.assertEqual(batcher.add('b', token='footoken'), [True, True])
+        request = self.mock_urlopen.call_args[0][0]
+        query = urlparse.parse_qs(request.get_data(), strict_parsing=True)
+        self.assertEqual(json.loads(query['data'][0]), [
+            {'event': 'a', 'properties': {'distinct_id': 1, 'token': 'testmixpanel'}},
+            {'event': 'b', 'properties': {'token': 'footoken'}},
+            ])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        c = cache.LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertTrue('a' in c)
+        self.assertFalse('b' in c)
+        self.assertEqual(len(c), 2)
+
+    def test_ttl(self):
+        now = [0]
+        c = cache.LRUCache(10, ttl=5, clock=lambda: now[0])
+        c.set('a', 1)
+        now[0] = 4
+        self.assertEqual(c.get('a'), 1)
+        now[0] = 5
+        self.assertEqual(c.get('a', 'expired'), 'expired')
+        self.assertEqual(len(c), 0)
+
+
+class FilterTest(TestCase):
+    def setUp(self):
+        super(FilterTest, self).setUp()
+        for name, value in [('MIXPANEL_SAMPLE_RATES', {'Viewed page': 0.5}),
+                            ('MIXPANEL_DEDUPE_CACHE_SIZE', 100)]:
+            self.addCleanup(setattr, mp_settings, name, getattr(mp_settings, name))
+            setattr(mp_settings, name, value)
+        patcher = mock.patch.object(filters, '_cache', None)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_sampling(self):
+        kept = [filters.in_sample('Viewed page', i, 0.5) for i in range(1000)]
+        self.assertTrue(400 < sum(kept) < 600)
+        self.assertEqual(kept, [filters.in_sample('Viewed page', i, 0.5) for i in range(1000)])
+        self.assertTrue(filters.in_sample('Viewed page', 1, 1))
+
+        events = [{'event': 'Viewed page', 'properties': {'distinct_id': i}} for i in range(20)]
+        results = tasks.event_batch_tracker(events)
+        self.assertEqual(results, [True] * 20)
+        sent = json.loads(urlparse.parse_qs(
+            self.mock_urlopen.call_args[0][0].get_data())['data'][0])
+        self.assertEqual([e['properties']['distinct_id'] for e in sent],
+                         [i for i in range(20) if kept[i]])
+        self.assertEqual(sent[0]['properties']['sample_rate'], 0.5)
+
+    def test_dedupe(self):
+        props = {'$insert_id': 'abc'}
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        self.assertRaises(tasks.FailedEventRequest, tasks.event_tracker, 'a', props)
+        self.mock_urlopen.side_effect = None
+
+        # Failed events aren't remembered
+        self.assertEqual(tasks.event_tracker('a', props), True)
+        self.assertEqual(self.mock_urlopen.call_count, 2)
+        self.assertEqual(tasks.event_tracker('a', props), True)
+        self.assertEqual(self.mock_urlopen.call_count, 2)
+
+        # Nor are they sent twice in one batch, but other tokens' are
+        events = [{'event': 'b', 'properties': {'$insert_id': 'def'}}] * 2 + [
+            {'event': 'a', 'properties': {'$insert_id': 'abc', 'token': 'other'}}]
+        self.assertEqual(tasks.event_batch_tracker(events), [True] * 3)
+        sent = json.loads(urlparse.parse_qs(
+            self.mock_urlopen.call_args[0][0].get_data())['data'][0])
+        self.assertEqual([e['event'] for e in sent], ['b', 'a'])
+
+
+def _user_properties(distinct_id):
+    return {'plan': 'pro', 'distinct_id': 'overridden'}
+
+
+class PropertiesTest(TestCase):
+    def setUp(self):
+        super(PropertiesTest, self).setUp()
+        self.host = Mock(return_value='web1')
+        mp_settings.MIXPANEL_SUPER_PROPERTIES = {'env': 'prod', 'host': self.host}
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SUPER_PROPERTIES', {})
+
+    def test_super_properties(self):
+        self.assertDictEqual(tasks._build_props({'env': 'dev'}, 'footoken'), {
+            'env': 'dev', 'host': 'web1', 'token': 'footoken'})
+        self.assertDictEqual(tasks._build_props(None, None), {
+            'env': 'prod', 'host': 'web1', 'token': 'testmixpanel'})
+        self.assertEqual(self.host.call_count, 1)
+
+        properties.register(version='1.2')
+        self.addCleanup(properties.unregister, 'version')
+        self.assertEqual(tasks._build_props(None, None)['version'], '1.2')
+
+    def test_enrichment(self):
+        mp_settings.MIXPANEL_PROPERTY_ENRICHER = 'mixpanel.tests:_user_properties'
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_PROPERTY_ENRICHER', None)
+        patcher = mock.patch.object(properties, '_cache', None)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        with mock.patch('mixpanel.tests._user_properties',
+                        side_effect=_user_properties) as enricher:
+            for i in range(2):
+                self.assertDictEqual(tasks._build_props({'distinct_id': 7}, None), {
+                    'env': 'prod', 'host': 'web1', 'plan': 'pro',
+                    'distinct_id': 7, 'token': 'testmixpanel'})
+            enricher.assert_called_once_with(7)
+
+            enricher.side_effect = ValueError("db down")
+            self.assertEqual(tasks._build_props({'distinct_id': 8}, None)['env'], 'prod')
+
+
+class StampTest(TestCase):
+    def setUp(self):
+        super(StampTest, self).setUp()
+        mp_settings.MIXPANEL_STAMP_EVENTS = True
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_STAMP_EVENTS', False)
+
+    def _sent(self):
+        url = self.mock_urlopen.call_args[0][0]
+        query = urlparse.parse_qs(urlparse.urlparse(url).query)
+        return json.loads(base64.b64decode(query['data'][0]))
+
+    def test_stamped(self):
+        with mock.patch('time.time', return_value=1367411415.5):
+            tasks.event_tracker('e', {'distinct_id': 1})
+        props = self._sent()['properties']
+        self.assertEqual(props['time'], 1367411415500)
+        self.assertTrue(0 < len(props['$insert_id']) <= 36)
+
+        tasks.event_tracker('e', {'time': 5, '$insert_id': 'abc'})
+        props = self._sent()['properties']
+        self.assertEqual((props['time'], props['$insert_id']), (5, 'abc'))
+
+    def test_stamped_when_enqueued(self):
+        with mock.patch('celery.task.base.Task.apply_async') as apply_async:
+            with mock.patch('time.time', return_value=1367411415.5):
+                tasks.event_tracker.delay('e', {'distinct_id': 1})
+                tasks.funnel_event_tracker.apply_async(['f', 's', 'g', {'distinct_id': 1}])
+                tasks.event_fanout_tracker.apply_async(['e', [1, 2]], {'token': 't'})
+                tasks.people_tracker.delay(1, {'a': 1})
+        calls = apply_async.call_args_list
+        stamped = [calls[0][0][0][1], calls[1][0][0][3], calls[2][0][1]['properties']]
+        self.assertEqual([props['time'] for props in stamped], [1367411415500] * 3)
+        self.assertEqual(len(set(props['$insert_id'] for props in stamped)), 3)
+        self.assertEqual(calls[3][0][:2], ((1, {'a': 1}), {}))
+
+        # Workers keep the stamps they were given
+        tasks.event_tracker(*calls[0][0][0])
+        self.assertDictEqual(self._sent()['properties'], dict(stamped[0], token='testmixpanel'))
+
+    def test_disabled(self):
+        mp_settings.MIXPANEL_STAMP_EVENTS = False
+        self.assertDictEqual(tasks._build_props({}, None), {'token': 'testmixpanel'})
+
+    def test_insert_ids(self):
+        ids = set(properties.insert_id() for i in range(1000))
+        self.assertEqual(len(ids), 1000)
+        first = properties.insert_id()
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertNotEqual(properties.insert_id()[:20], first[:20])
+
+    def test_generator(self):
+        mp_settings.MIXPANEL_INSERT_ID_GENERATOR = 'uuid:uuid4'
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_INSERT_ID_GENERATOR', None)
+        insert_id = tasks._build_props({}, None)['$insert_id']
+        self.assertEqual(str(uuid.UUID(str(insert_id))), str(insert_id))
+
+    def test_retry_keeps_stamps(self):
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        with mock.patch.object(tasks.event_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_tracker, 'e', {'a': 1})
+        retried = retry.call_args[1]['kwargs']['properties']
+        self.assertEqual(sorted(retried), ['$insert_id', 'a', 'time'])
+
+        self.mock_urlopen.side_effect = None
+        tasks.event_tracker('e', retried)
+        props = self._sent()['properties']
+        self.assertEqual((props['time'], props['$insert_id']),
+                         (retried['time'], retried['$insert_id']))
+
+    def test_batch_retry_keeps_stamps(self):
+        self.mock_urlopen.side_effect = urllib2.URLError("down")
+        events = [{'event': 'a'}, {'event': 'b', 'properties': {'x': 1}}]
+        with mock.patch.object(tasks.event_batch_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_batch_tracker, events)
+        retried = retry.call_args[1]['args'][0]
+        self.assertEqual([sorted(e['properties']) for e in retried],
+                         [['$insert_id', 'time'], ['$insert_id', 'time', 'x']])
+
+    def test_fanout_encoded_once(self):
+        mp_settings.MIXPANEL_SENDER_CONCURRENCY = 1
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SENDER_CONCURRENCY', 10)
+        with mock.patch.object(tasks, '_encode', wraps=tasks._encode) as encode:
+            tasks.event_fanout_tracker('e', range(100), {'$insert_id': 'abc'})
+        self.assertEqual(encode.call_count, 1)
+        sent = json.loads(urlparse.parse_qs(
+            self.mock_urlopen.call_args[0][0].get_data())['data'][0])
+        self.assertEqual([(e['properties']['distinct_id'], e['properties']['$insert_id'])
+                          for e in sent],
+                         [(user, tasks._fanout_insert_id('abc', user))
+                          for user in range(50, 100)])
+
+    def test_fanout_ids(self):
+        mp_settings.MIXPANEL_SENDER_CONCURRENCY = 1
+        self.addCleanup(setattr, mp_settings, 'MIXPANEL_SENDER_CONCURRENCY', 10)
+        self.mock_urlopen.side_effect = [Mock(), urllib2.URLError("down")]
+        with mock.patch.object(tasks.event_fanout_tracker, 'retry') as retry:
+            retry.return_value = RetryTaskError()
+            self.assertRaises(RetryTaskError, tasks.event_fanout_tracker, 'e', range(60))
+        calls = self.mock_urlopen.call_args_list
+        sent = [json.loads(urlparse.parse_qs(c[0][0].get_data())['data'][0]) for c in calls]
+        ids = [e['properties']['$insert_id'] for e in sent[0] + sent[1]]
+        self.assertEqual(len(set(ids)), 60)
+
+        self.mock_urlopen.side_effect = None
+        kwargs = retry.call_args[1]['kwargs']
+        tasks.event_fanout_tracker('e', range(50, 60), **kwargs)
+        resent = json.loads(urlparse.parse_qs(
+            self.mock_urlopen.call_args[0][0].get_data())['data'][0])
+        self.assertEqual([e['properties']['$insert_id'] for e in resent], ids[50:])
+
+
+class ConfTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(conf.reload)
+        patcher = mock.patch.dict(os.environ, {
+            'MIXPANEL_MAX_RETRIES': '10',
+            'MIXPANEL_API_KEY': '12345',
+            'MIXPANEL_VERBOSE': 'true',
+            'MIXPANEL_RATE_LIMITS': '{"/track/": [400, 800]}',
+            })
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_reload(self):
+        with mock.patch.object(conf, '_celery_config',
+                               return_value={'MIXPANEL_MAX_RETRIES': 3,
+                                             'MIXPANEL_BATCH_SIZE': 20}):
+            conf.reload()
+        self.assertEqual(mp_settings.MIXPANEL_MAX_RETRIES, 10)
+        self.assertEqual(mp_settings.MIXPANEL_BATCH_SIZE, 20)
+        self.assertEqual(mp_settings.MIXPANEL_API_KEY, '12345')
+        self.assertEqual(mp_settings.MIXPANEL_VERBOSE, True)
+        self.assertEqual(mp_settings.MIXPANEL_RATE_LIMITS, {'/track/': [400, 800]})
+        # Read when retrying rather than at import
+        self.assertEqual(tasks.event_tracker.max_retries, 10)
+
+        del os.environ['MIXPANEL_MAX_RETRIES']
+        conf.reload()
+        self.assertEqual(mp_settings.MIXPANEL_MAX_RETRIES, 5)
+        self.assertEqual(mp_settings.MIXPANEL_BATCH_SIZE, 50)
+
+    def test_loaded_by_clients(self):
+        os.environ['MIXPANEL_BUFFER_MAX_EVENTS'] = '2'
+        for create in (buffer.EventBuffer, lambda: sender.ConcurrentSender(),
+                       lambda: importer.import_events([])):
+            with mock.patch.object(conf, '_loaded', None):
+                create()
+                self.assertEqual(mp_settings.MIXPANEL_API_KEY, '12345')
+            conf.reload()
+        with mock.patch.object(conf, '_loaded', None):
+            self.assertEqual(buffer.EventBuffer().max_size, 2)
+
+    def test_hooks(self):
+        conf.load()
+        hook = Mock()
+        conf.on_reload(hook)
+        self.addCleanup(conf._hooks.remove, hook)
+        conf.load()
+        self.assertFalse(hook.called)
+        conf.reload()
+        self.assertEqual(hook.call_count, 1)
+
+    def test_lazy_http_imports(self):
+        # Celery's own imports may load ssl and urllib already, so the
+        # modules mixpanel imports itself are checked too
+        modules = subprocess.check_output([sys.executable, '-c', textwrap.dedent("""
+            import __builtin__, sys
+            http = ("urllib", "urllib2", "httplib", "gzip", "ssl", "email.utils")
+            imported = set()
+            real_import = __builtin__.__import__
+            def record(name, globals=None, *args, **kwargs):
+                if (globals or {}).get("__name__", "").startswith("mixpanel"):
+                    imported.add(name)
+                return real_import(name, globals, *args, **kwargs)
+            __builtin__.__import__ = record
+            import celery.task, celery.signals
+            loaded = set(sys.modules)
+            import mixpanel.tasks
+            print sorted(m for m in http if m in imported or
+                         m in sys.modules and m not in loaded)
+            """)])
+        self.assertEqual(modules.strip(), '[]')
@@ -0,0 +1,214 @@
+"""Pluggable transports delivering the tracking requests
+
+MIXPANEL_TRANSPORT names the transport the tasks send their requests with:
+
+``'urllib'``
+    A new connection to ``MIXPANEL_API_SERVER`` per request.
+``'pooled'``
+    Keep-alive connections from the :mod:`mixpanel.pool`.
+``'memory'``
+    Keeps the requests in memory and accepts them, without any network.
+``'file'``
+    Writes the data of each request as a line of JSON to
+    MIXPANEL_TRANSPORT_FILE, or to standard output, and accepts it.
+
+The last two run the whole pipeline, from enqueueing to serialization, at
+full volume without sending anything to Mixpanel, e.g. in staging or to
+measure the pipeline's own overhead.
+"""
+from __future__ import absolute_import
+
+import base64
+import collections
+import os
+import sys
+import threading
+import urlparse
+from cStringIO import StringIO
+
+from celery.utils.imports import symbol_by_name
+
+from . import conf
+from .conf import settings as mp_settings
+
+TRANSPORTS = {
+    'urllib': 'mixpanel.transports:UrllibTransport',
+    'pooled': 'mixpanel.transports:PooledTransport',
+    'memory': 'mixpanel.transports:MemoryTransport',
+    'file': 'mixpanel.transports:FileTransport',
+}
+
+
+class Transport(object):
+    """
+    Sends requests to the api server. Transports implement :meth:`request`
+    and must be safe to use from several threads.
+    """
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """
+        Performs a request for ``path``, which includes the querystring.
+        Returns a ``(status, content, headers)`` tuple, ``headers`` being a
+        dict with lowercase names, and raises ``socket.error`` or
+        ``urllib2.URLError`` if the server couldn't be reached.
+        """
+        raise NotImplementedError
+
+
+class UrllibTransport(Transport):
+    """
+    Opens a new connection for each request with ``urllib2``.
+    """
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        import urllib2
+
+        url = '%s://%s%s' % (mp_settings.MIXPANEL_API_SCHEME,
+                             mp_settings.MIXPANEL_API_SERVER, path)
+        if body is not None:
+            url = urllib2.Request(url, body, headers or {})
+        try:
+            response = urllib2.urlopen(url, None, timeout)
+        except urllib2.HTTPError as e:
+            return e.code, e.read(), _lower(e.headers)
+        return 200, response.read(), {}
+
+
+class PooledTransport(Transport):
+    """
+    Sends the requests on the keep-alive connections of
+    :func:`mixpanel.pool.get_pool`.
+    """
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        from . import pool
+        return pool.get_pool().request(method, path, body, headers, timeout)
+
+
+class MemoryTransport(Transport):
+    """
+    Keeps the last ``max_requests`` requests as ``(method, path, body,
+    headers)`` tuples in :attr:`requests`, and answers them with
+    ``response``. :attr:`count` is the number of requests ever received.
+    """
+
+    def __init__(self, max_requests=10000, response='1'):
+        self.requests = collections.deque(maxlen=max_requests)
+        self.response = response
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        with self._lock:
+            self.requests.append((method, path, body, headers))
+            self.count += 1
+        return 200, self.response, {}
+
+    def sent(self):
+        """
+        Returns the kept requests as ``(endpoint, data)`` pairs, ``data``
+        being the serialized events or updates.
+        """
+        with self._lock:
+            requests = list(self.requests)
+        return [request_data(*request) for request in requests]
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+            self.count = 0
+
+
+class FileTransport(Transport):
+    """
+    Appends a ``{"endpoint": ..., "data": ...}`` line of JSON to ``path``
+    for each request, ``data`` holding the serialized events or updates,
+    and accepts it. ``path`` defaults to MIXPANEL_TRANSPORT_FILE, and
+    ``None`` or ``'-'`` write to standard output.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or mp_settings.MIXPANEL_TRANSPORT_FILE
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        from . import serializers
+
+        endpoint, data = request_data(method, path, body, headers)
+        # The data already is JSON, so it is written as it is
+        line = '{"endpoint":%s,"data":%s}\n' % (serializers.dumps(endpoint), data)
+        with self._lock:
+            f = self._open()
+            f.write(line)
+            f.flush()
+        return 200, '1', {}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._file is not sys.stdout:
+                self._file.close()
+            self._file = None
+
+    def _open(self):
+        # Each process of a prefork pool appends with a file of its own
+        pid = os.getpid()
+        if self._file is None or self._pid != pid:
+            if self.path in (None, '-'):
+                self._file = sys.stdout
+            else:
+                self._file = open(self.path, 'ab')
+            self._pid = pid
+        return self._file
+
+
+def request_data(method, path, body=None, headers=None):
+    """
+    Returns the endpoint of a tracking request and the serialized data it
+    carries, undoing the gzip compression, form encoding and base64
+    encoding :func:`~mixpanel.tasks._send_request` applies.
+    """
+    endpoint, _, querystring = path.partition('?')
+    if body is None:
+        data = urlparse.parse_qs(querystring)[mp_settings.MIXPANEL_DATA_VARIABLE][0]
+        return endpoint, base64.b64decode(data)
+    if (headers or {}).get('Content-Encoding') == 'gzip':
+        import gzip
+        body = gzip.GzipFile(fileobj=StringIO(body)).read()
+    return endpoint, urlparse.parse_qs(body)[mp_settings.MIXPANEL_DATA_VARIABLE][0]
+
+def _lower(headers):
+    return dict((name.lower(), value) for name, value in (headers or {}).items())
+
+
+_transport = None
+_transport_name = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """
+    Returns the process's transport, as named by MIXPANEL_TRANSPORT. If it is
+    not set, the ``'pooled'`` transport is used when MIXPANEL_CONNECTION_POOL
+    is set, and the ``'urllib'`` one otherwise.
+    """
+    global _transport, _transport_name
+    name = mp_settings.MIXPANEL_TRANSPORT
+    if not name:
+        name = 'pooled' if mp_settings.MIXPANEL_CONNECTION_POOL else 'urllib'
+    if _transport is not None and _transport_name == name:
+        return _transport
+    with _transport_lock:
+        if _transport is None or _transport_name != name:
+            _transport = symbol_by_name(name, TRANSPORTS)()
+            _transport_name = name
+        return _transport
+
+@conf.on_reload
+def _reset():
+    # Settings of the transport, such as its file, may have changed
+    global _transport
+    with _transport_lock:
+        if isinstance(_transport, FileTransport):
+            _transport.close()
+        _transport = None